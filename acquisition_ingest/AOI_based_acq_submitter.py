@@ -7,28 +7,55 @@ from __future__ import print_function
 from builtins import str
 from datetime import datetime
 import json
-import pandas as pd
-import numpy as np
+import netrc
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 from hysds_commons.job_utils import submit_mozart_job
+import scrape_apihub_opensearch
+from time_windows import split_window
+from aoi_index import AOIIndex
+import query_geometry
+import s1_name
+from deadline import get_session
 
+# maximum number of SciHub results handed to a single acquisition_ingest-aoi job
+MAX_JOB_RESULTS = 5000
 
-def get_time_segments(start_time, end_time):
-    segments = np.arange(start_time, end_time, dtype='M8[M]')
-    time_segments = list()
-    time_segments.append(start_time)
-    for date in segments[1:]:
-        ts = pd.to_datetime(str(date))
-        d = ts.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-        time_segments.append(d)
-    time_segments.append(end_time)
 
-    ttl = len(time_segments)
-    segment_pairs = list()
-    num = 0
-    while num < ttl - 1:
-        segment_pairs.append([time_segments[num], time_segments[num + 1]])
-        num += 1
-    return segment_pairs
+def get_scihub_auth(netrc_file=None):
+    """
+    SciHub credentials of the .netrc that the job spec mounts into the
+    submitter, the same the acquisition_ingest jobs log in with.
+    :param netrc_file: .netrc path, ~/.netrc if None
+    :return: (user, password) tuple
+    """
+    host = urlparse(scrape_apihub_opensearch.url).netloc
+    auth = netrc.netrc(netrc_file).authenticators(host)
+    if auth is None:
+        raise RuntimeError("No credentials for {} in .netrc".format(host))
+    return auth[0], auth[2]
+
+
+def get_time_segments(start_time, end_time, polygon, auth, max_results=MAX_JOB_RESULTS):
+    """
+    Split the AOI time range into job segments by SciHub result density.
+    :param start_time: start time in ISO8601 format
+    :param end_time: end time in ISO8601 format
+    :param polygon: AOI geojson polygon
+    :param auth: SciHub (user, password) tuple for the count probes
+    :param max_results: maximum number of results per segment
+    :return: list of [start time, end time] pairs
+    """
+    session = get_session()
+    session.auth = auth
+
+    def count_fn(st, et):
+        query = scrape_apihub_opensearch.get_query("aoi_scrape", st, et, polygon)
+        return scrape_apihub_opensearch.count_results(session, query)
+
+    return split_window(start_time, end_time, count_fn, max_results)
 
 
 def get_job_params(aoi_name, job_type, starttime, endtime, polygon, dataset_version):
@@ -115,41 +142,105 @@ def get_job_params(aoi_name, job_type, starttime, endtime, polygon, dataset_vers
     return rule, params
 
 
-if __name__ == "__main__":
-    '''
-    Main program that is run by cron to submit a scraper job
-    '''
-    qtype = "opensearch"
-    ctx = json.loads(open("_context.json", "r").read())
-    aoi_name = ctx.get("AOI_name")
+def get_multi_aoi_job_params(job_type, starttime, endtime, aois, dataset_version):
+
+    rule = {
+        "rule_name": "{}-{}".format(job_type.lstrip('job-'), len(aois)),
+        "queue": "factotum-job_worker-apihub_scraper_throttled",
+        "priority": 6,
+        "kwargs": '{}'
+    }
+    params = [
+        {
+            "name": "ds_cfg",
+            "from": "value",
+            "value": "datasets.json"
+        },
+        {
+            "name": "starttime",
+            "from": "value",
+            "value": starttime
+        },
+        {
+            "name": "endtime",
+            "from": "value",
+            "value": endtime
+        },
+        {
+            "name": "aois_flag",
+            "from": "value",
+            "value": "--aois"
+        },
+        {
+            "name": "aois",
+            "from": "value",
+            "value": json.dumps(aois, separators=(',', ':'))
+        },
+        {
+            "name": "ds_flag",
+            "from": "value",
+            "value": "--dataset_version"
+        },
+        {
+            "name": "ds_version",
+            "from": "value",
+            "value": dataset_version
+        },
+        {
+            "name": "ingest_flag",
+            "from": "value",
+            "value": "--ingest"
+        },
+        {
+            "name": "report_flag",
+            "from": "value",
+            "value": "--report"
+        }
+    ]
+
+    return rule, params
+
+
+def submit_multi_aoi_jobs(ctx, tag, auth):
+    """
+    Submit acquisition_ingest-multi_aoi jobs that scrape all AOIs of the context
+    together, one job per time segment of their combined time range. Each job
+    gets the AOIs whose own time range overlaps its segment, with that time
+    range, so that no AOI is scraped or reported outside of it.
+    """
+    aoi_names = ctx.get("AOI_name")
+    locations = [json.loads(l) if isinstance(l, str) else l for l in ctx.get("spatial_extent")]
+    aois = [{"aoi_name": name, "location": location, "starttime": st, "endtime": et}
+            for name, location, st, et in zip(aoi_names, locations, ctx.get("start_time"), ctx.get("end_time"))]
+    starttime = min(ctx.get("start_time"), key=s1_name.parse_iso)
+    endtime = max(ctx.get("end_time"), key=s1_name.parse_iso)
     dataset_version = ctx.get("dataset_version")
-    starttime = ctx.get("start_time")
-    endtime = ctx.get("end_time")
-    polygon = ctx.get("spatial_extent")
-    tag = ctx.get("container_specification").get("version")
-    job_type = "job-acquisition_ingest-aoi"
+    job_type = "job-acquisition_ingest-multi_aoi"
     job_spec = "{}:{}".format(job_type, tag)
 
-    segments = get_time_segments(starttime, endtime)
-    for segment in segments:
-        start_time = segment[0]
-        end_time = segment[1]
+    index = AOIIndex(aoi_names, [scrape_apihub_opensearch.convert_geojson(l) for l in locations])
+    region = json.dumps(index.get_region())
+    for start_time, end_time in get_time_segments(starttime, endtime, region, auth):
+        segment_aois = [aoi for aoi in aois
+                        if s1_name.parse_iso(aoi["starttime"]) <= s1_name.parse_iso(end_time) and
+                        s1_name.parse_iso(aoi["endtime"]) >= s1_name.parse_iso(start_time)]
+        # a gap between the AOIs' time ranges
+        if not segment_aois:
+            continue
         rtime = datetime.utcnow()
-        job_name = "%s-%s-%s-%s-%s" % (job_spec, aoi_name,
-                                       start_time.replace("-", "").replace(":", ""),
-                                       end_time.replace("-", "").replace(":", ""),
-                                       rtime.strftime("%d_%b_%Y_%H:%M:%S"))
+        job_name = "%s-%d_AOIs-%s-%s-%s" % (job_spec, len(segment_aois),
+                                           start_time.replace("-", "").replace(":", ""),
+                                           end_time.replace("-", "").replace(":", ""),
+                                           rtime.strftime("%d_%b_%Y_%H:%M:%S"))
         job_name = job_name.lstrip('job-')
 
-        # Setup input arguments here
-        rule, params = get_job_params(aoi_name=aoi_name,
-                                      job_type=job_type,
-                                      starttime=start_time,
-                                      endtime=end_time,
-                                      polygon=polygon,
-                                      dataset_version=dataset_version)
+        rule, params = get_multi_aoi_job_params(job_type=job_type,
+                                                starttime=start_time,
+                                                endtime=end_time,
+                                                aois=segment_aois,
+                                                dataset_version=dataset_version)
 
-        print("submitting job of type {} for {}".format(job_spec, qtype))
+        print("submitting job of type {} for {} AOIs".format(job_spec, len(segment_aois)))
         print(json.dumps(params))
 
         submit_mozart_job({}, rule,
@@ -159,3 +250,58 @@ if __name__ == "__main__":
                               "job-specification": job_spec
                           },
                           job_name=job_name)
+
+
+if __name__ == "__main__":
+    '''
+    Main program that is run by cron to submit a scraper job
+    '''
+    qtype = "opensearch"
+    ctx = json.loads(open("_context.json", "r").read())
+    tag = ctx.get("container_specification").get("version")
+    auth = get_scihub_auth()
+
+    # several AOIs selected together: scrape them with shared queries
+    if isinstance(ctx.get("AOI_name"), list):
+        submit_multi_aoi_jobs(ctx, tag, auth)
+    else:
+        aoi_name = ctx.get("AOI_name")
+        dataset_version = ctx.get("dataset_version")
+        starttime = ctx.get("start_time")
+        endtime = ctx.get("end_time")
+        polygon = ctx.get("spatial_extent")
+        job_type = "job-acquisition_ingest-aoi"
+        job_spec = "{}:{}".format(job_type, tag)
+
+        # count probes use the same coarse AOI geometry as the scrape queries
+        query_polygon = json.dumps(query_geometry.get_query_geometry(
+            scrape_apihub_opensearch.convert_geojson(polygon), aoi_id=aoi_name))
+        segments = get_time_segments(starttime, endtime, query_polygon, auth)
+        for segment in segments:
+            start_time = segment[0]
+            end_time = segment[1]
+            rtime = datetime.utcnow()
+            job_name = "%s-%s-%s-%s-%s" % (job_spec, aoi_name,
+                                           start_time.replace("-", "").replace(":", ""),
+                                           end_time.replace("-", "").replace(":", ""),
+                                           rtime.strftime("%d_%b_%Y_%H:%M:%S"))
+            job_name = job_name.lstrip('job-')
+
+            # Setup input arguments here
+            rule, params = get_job_params(aoi_name=aoi_name,
+                                          job_type=job_type,
+                                          starttime=start_time,
+                                          endtime=end_time,
+                                          polygon=polygon,
+                                          dataset_version=dataset_version)
+
+            print("submitting job of type {} for {}".format(job_spec, qtype))
+            print(json.dumps(params))
+
+            submit_mozart_job({}, rule,
+                              hysdsio={
+                                  "id": "internal-temporary-wiring",
+                                  "params": params,
+                                  "job-specification": job_spec
+                              },
+                              job_name=job_name)
@@ -0,0 +1,99 @@
+"""
+Compact in-memory form of a scraped SciHub acquisition.
+
+A massaged met dict carries the parsed geojson location and bbox next to
+every OpenSearch field, and its dataset JSON copies the location again.
+AcquisitionRecord keeps the footprint as its WKT string and the bbox as a
+bounds tuple, and only builds the met and dataset JSON when it is ingested.
+"""
+
+import shapely.wkt
+import geojson
+
+
+# met fields derived from other fields when serializing
+DERIVED_FIELDS = ("location", "bbox", "data_product_name", "archive_filename", "source")
+
+
+class AcquisitionRecord(object):
+    """Acquisition fields needed to create the acquisition dataset."""
+
+    __slots__ = ("id", "title", "sensing_start", "sensing_stop", "ingestion_date", "track_number",
+                 "orbit_number", "direction", "platform", "footprint", "bbox", "properties")
+
+    def __init__(self, id, title, sensing_start, sensing_stop, ingestion_date, track_number, orbit_number,
+                 direction, platform, footprint, bbox, properties=()):
+        self.id = id
+        self.title = title
+        self.sensing_start = sensing_start
+        self.sensing_stop = sensing_stop
+        self.ingestion_date = ingestion_date
+        self.track_number = track_number
+        self.orbit_number = orbit_number
+        self.direction = direction
+        self.platform = platform
+        self.footprint = footprint
+        self.bbox = bbox
+        # remaining OpenSearch fields, kept as a flat tuple of (name, value) pairs
+        self.properties = properties
+
+    @classmethod
+    def from_met(cls, met):
+        """
+        Build a record from a met dict produced by massage_result().
+        :param met: massaged met dict
+        :return: AcquisitionRecord
+        """
+        coords = met["bbox"]
+        bbox = (coords[0][0], coords[0][1], coords[2][0], coords[2][1])
+        named = ("id", "title", "sensingStart", "sensingStop", "ingestiondate", "track_number",
+                 "orbitNumber", "direction", "platform", "footprint")
+        properties = tuple((k, v) for k, v in met.items() if k not in named and k not in DERIVED_FIELDS)
+        return cls(met["id"], met["title"], met["sensingStart"], met["sensingStop"], met.get("ingestiondate"),
+                   met["track_number"], met["orbitNumber"], met["direction"], met["platform"], met["footprint"],
+                   bbox, properties)
+
+    @property
+    def data_product_name(self):
+        return "acquisition-%s" % self.title
+
+    def to_met(self):
+        """Serialize to the met JSON dict massage_result() produced."""
+        met = dict(self.properties)
+        met.update({
+            "id": self.id,
+            "title": self.title,
+            "sensingStart": self.sensing_start,
+            "sensingStop": self.sensing_stop,
+            "track_number": self.track_number,
+            "orbitNumber": self.orbit_number,
+            "direction": self.direction,
+            "platform": self.platform,
+            "footprint": self.footprint,
+            "data_product_name": self.data_product_name,
+            "archive_filename": "%s.zip" % self.title,
+            "source": "esa_scihub",
+        })
+        if self.ingestion_date is not None:
+            met["ingestiondate"] = self.ingestion_date
+        g = shapely.wkt.loads(self.footprint)
+        met["location"] = geojson.Feature(geometry=g, properties={}).geometry
+        min_x, min_y, max_x, max_y = self.bbox
+        met["bbox"] = [[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]]
+        return met
+
+    def to_dataset(self, version, location=None):
+        """
+        Serialize to the HySDS dataset JSON dict.
+        :param version: dataset version
+        :param location: geojson location, parsed from the footprint if not given
+        """
+        if location is None:
+            location = geojson.Feature(geometry=shapely.wkt.loads(self.footprint), properties={}).geometry
+        return {
+            "version": version,
+            "label": self.id,
+            "location": location,
+            "starttime": self.sensing_start,
+            "endtime": self.sensing_stop,
+        }
@@ -0,0 +1,62 @@
+"""
+Spatial index over AOI geometries for assigning scraped acquisitions to AOIs.
+
+Lets several AOIs share one SciHub query over their combined bounding box:
+each result footprint is matched against the AOIs locally with an STRtree
+over the prepared AOI geometries.
+"""
+
+import shapely
+from shapely.strtree import STRtree
+from shapely.geometry import box, mapping
+from shapely.prepared import prep
+import footprints
+
+
+class AOIIndex(object):
+    """STRtree over AOI geometries."""
+
+    def __init__(self, names, geoms):
+        """
+        :param names: AOI names
+        :param geoms: shapely geometries of the AOIs, in the order of names
+        """
+        self.names = list(names)
+        self.geoms = list(geoms)
+        self.tree = STRtree(self.geoms)
+        if footprints.VECTORIZED:
+            for geom in self.geoms:
+                shapely.prepare(geom)
+        else:
+            self.prepared = [prep(geom) for geom in self.geoms]
+            self.index_by_id = dict((id(geom), i) for i, geom in enumerate(self.geoms))
+
+    def get_region(self):
+        """
+        Bounding box of all AOIs.
+        :return: geojson polygon dict
+        """
+        bounds = [geom.bounds for geom in self.geoms]
+        region = box(min(b[0] for b in bounds), min(b[1] for b in bounds),
+                     max(b[2] for b in bounds), max(b[3] for b in bounds))
+        return mapping(region)
+
+    def match(self, geoms):
+        """
+        Find the AOIs each footprint intersects.
+        :param geoms: footprints parsed with footprints.parse_footprints()
+        :return: list with the list of intersecting AOI names of each footprint
+        """
+        matches = [[] for _ in range(len(geoms))]
+        if footprints.VECTORIZED:
+            if len(geoms):
+                geom_index, aoi_index = self.tree.query(geoms, predicate="intersects")
+                for i, j in zip(geom_index.tolist(), aoi_index.tolist()):
+                    matches[i].append(j)
+        else:
+            for i, geom in enumerate(geoms):
+                for candidate in self.tree.query(geom):
+                    j = self.index_by_id[id(candidate)]
+                    if self.prepared[j].intersects(geom):
+                        matches[i].append(j)
+        return [[self.names[j] for j in sorted(m)] for m in matches]
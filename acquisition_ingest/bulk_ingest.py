@@ -0,0 +1,244 @@
+"""
+Batched ingest of acquisition datasets.
+
+Ingesting acquisitions one at a time writes a dataset directory to a temp dir,
+runs a dataset ingest on it and sends a processed-queue notification per
+product. Acquisition datasets carry nothing beyond their met and dataset JSON,
+so BulkIngester builds the GRQ documents in memory, adds the fields the GRQ
+update API derives on indexing (center, city, creation_timestamp), looking up
+the cities of a whole batch with one geonames _msearch, indexes the batch with
+one ES _bulk request and sends their processed-queue notifications over one
+connection.
+
+Bulk mode writes and publishes no dataset directories: the acquisitions it
+ingests have no urls and no files in the dataset store.
+"""
+
+import re
+import json
+import logging
+from datetime import datetime
+from shapely.geometry import shape
+import hysds.orchestrator
+from hysds.celery import app
+from deadline import get_session
+from scrape_acquisition_opensearch import prepare_acq_met
+
+
+logger = logging.getLogger('bulk_ingest')
+logger.setLevel(logging.INFO)
+
+# number of acquisitions ingested per batch
+BULK_SIZE = 500
+
+# geonames index GRQ looks up the cities of a dataset in
+GEONAMES_INDEX = "geonames"
+
+# GRQ keeps the most populated cities of at least this population
+CITY_POPULATION = 1000000
+CITY_COUNT = 20
+
+_dataset_configs = {}
+
+
+def get_dataset_config(ds_cfg, id):
+    """
+    Find the datasets.json entry that recognizes a dataset ID.
+    :param ds_cfg: HySDS datasets.json file
+    :param id: dataset ID
+    :return: dataset config dict
+    """
+    if ds_cfg not in _dataset_configs:
+        with open(ds_cfg) as f:
+            _dataset_configs[ds_cfg] = [(re.compile(cfg['match_pattern']), cfg)
+                                        for cfg in json.load(f)['datasets']]
+    for pattern, cfg in _dataset_configs[ds_cfg]:
+        if pattern.search("/{}".format(id)):
+            return cfg
+    raise RuntimeError("No dataset in {} matches {}".format(ds_cfg, id))
+
+
+def get_grq_doc(id, ds, met, cfg):
+    """
+    GRQ document for an acquisition dataset, as dataset ingest builds it for a
+    dataset without files, with the center and creation_timestamp the GRQ
+    update API adds. BulkIngester.add_cities() sets the city.
+    """
+    doc = {
+        "id": id,
+        "objectid": id,
+        "metadata": met,
+        "dataset": cfg['ipath'].split('/')[1],
+        "ipath": cfg['ipath'],
+        "system_version": ds['version'],
+        "dataset_level": cfg['level'],
+        "dataset_type": cfg['type'],
+        "urls": [],
+        "browse_urls": [],
+        "images": [],
+        "prov": {},
+    }
+    doc.update(ds)
+    if 'center' not in doc and 'location' in doc:
+        center = shape(doc['location']).centroid
+        doc['center'] = {"type": "point", "coordinates": [center.x, center.y]}
+    doc['creation_timestamp'] = "{}Z".format(datetime.utcnow().isoformat())
+    return doc
+
+
+def get_cities_query(location):
+    """
+    Geonames query GRQ runs for the city field: the most populated cities
+    within the dataset's location.
+    :param location: geojson geometry
+    """
+    return {
+        "size": CITY_COUNT,
+        "sort": {"population": {"order": "desc"}},
+        "query": {
+            "filtered": {
+                "query": {
+                    "bool": {
+                        "must": [
+                            {"term": {"feature_class": "P"}},
+                            {"range": {"population": {"gte": CITY_POPULATION}}}
+                        ]
+                    }
+                },
+                "filter": {
+                    "geo_shape": {
+                        "location": {
+                            "shape": {
+                                "type": location['type'].lower(),
+                                "coordinates": location['coordinates']
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+class BulkIngester(object):
+    """Buffer prepared acquisitions and ingest them in batches."""
+
+    def __init__(self, ds_es_url, ds_cfg, bulk_size=BULK_SIZE, session=None, grq_es_url=None):
+        """
+        :param ds_es_url: ElasticSearch URL for acquisition dataset, e.g.
+                          http://localhost:9200/grq_v2.0_acquisition-s1-iw_slc/acquisition-S1-IW_SLC
+        :param ds_cfg: HySDS datasets.json file
+        :param bulk_size: number of acquisitions per _bulk request
+        :param session: requests session to index with
+        :param grq_es_url: GRQ ElasticSearch URL holding the geonames index, GRQ_ES_URL by default
+        """
+        self.bulk_url = "{}/_bulk".format(ds_es_url.rstrip('/'))
+        self.cities_url = "{}/{}/_msearch".format((grq_es_url or app.conf["GRQ_ES_URL"]).rstrip('/'),
+                                                  GEONAMES_INDEX)
+        self.ds_cfg = ds_cfg
+        self.bulk_size = bulk_size
+        self.session = session or get_session()
+        self.pending = []
+
+    def add(self, ds, met):
+        """
+        Queue an acquisition, ingesting the batch once it is full.
+        :return: list of met dicts that failed to ingest
+        """
+        self.pending.append((ds, met))
+        if len(self.pending) >= self.bulk_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Ingest all queued acquisitions.
+        :return: list of met dicts that failed to ingest
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return []
+
+        docs = []
+        failed = []
+        for ds, met in pending:
+            try:
+                id = prepare_acq_met(met)
+                docs.append((get_grq_doc(id, ds, met, get_dataset_config(self.ds_cfg, id)), met))
+            except Exception as e:
+                logger.error("Failed to prepare {}: {}".format(met.get('title'), e))
+                failed.append(met)
+        if not docs:
+            return failed
+
+        try:
+            docs, no_cities = self.add_cities(docs)
+            failed.extend(no_cities)
+            items = self.index([doc for doc, met in docs]) if docs else []
+        except Exception as e:
+            logger.error("Bulk index of {} acquisitions failed: {}".format(len(docs), e))
+            return failed + [met for doc, met in docs]
+
+        indexed = []
+        for (doc, met), item in zip(docs, items):
+            result = item['index']
+            if result.get('error') or result.get('status', 200) >= 300:
+                logger.error("Failed to index {}: {}".format(doc['id'], result.get('error')))
+                failed.append(met)
+            else:
+                indexed.append(doc)
+        logger.info("Bulk indexed {} of {} acquisitions".format(len(indexed), len(pending)))
+
+        try:
+            self.notify(indexed)
+        except Exception as e:
+            # indexed but not evaluated, treat as missing so that they are picked up again
+            logger.error("Failed to queue {} indexed acquisitions: {}".format(len(indexed), e))
+            failed.extend(doc['metadata'] for doc in indexed)
+        return failed
+
+    def add_cities(self, docs):
+        """
+        Set the city field of a batch of documents with one geonames _msearch.
+        :param docs: list of (doc, met) tuples
+        :return: tuple of ((doc, met) tuples with cities, met dicts whose lookup failed)
+        """
+        lines = []
+        for doc, met in docs:
+            lines.append(json.dumps({}))
+            lines.append(json.dumps(get_cities_query(doc['location'])))
+        r = self.session.post(self.cities_url, data="\n".join(lines) + "\n")
+        r.raise_for_status()
+        with_cities = []
+        failed = []
+        for (doc, met), result in zip(docs, r.json()['responses']):
+            if result.get('error'):
+                logger.error("Failed to look up the cities of {}: {}".format(doc['id'], result['error']))
+                failed.append(met)
+                continue
+            doc['city'] = [hit['_source'] for hit in result['hits']['hits']]
+            with_cities.append((doc, met))
+        return with_cities, failed
+
+    def index(self, docs):
+        """
+        Index documents with one _bulk request.
+        :return: list of _bulk response items, in the order of docs
+        """
+        lines = []
+        for doc in docs:
+            lines.append(json.dumps({"index": {"_id": doc['id']}}))
+            lines.append(json.dumps(doc))
+        r = self.session.post(self.bulk_url, data="\n".join(lines) + "\n")
+        r.raise_for_status()
+        return r.json()['items']
+
+    def notify(self, docs):
+        """Send the processed-queue notification of each dataset over a single connection."""
+        if not docs:
+            return
+        with app.producer_or_acquire() as producer:
+            for doc in docs:
+                payload = {'job_type': "dataset:%s" % doc['ipath'], 'payload': doc}
+                hysds.orchestrator.submit_job.apply_async((payload,), queue=app.conf.DATASET_PROCESSED_QUEUE,
+                                                          producer=producer)
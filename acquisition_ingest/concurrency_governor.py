@@ -0,0 +1,192 @@
+"""
+Host wide cap on concurrent connections to an upstream, shared by all jobs.
+
+SciHub rejects requests with 503 once a user has too many connections open,
+and every scraper and IPF container on a worker opens its own. Callers take a
+lease from a counting semaphore before each upstream request and release it
+once the response has been read, so jobs wait for a free slot locally instead
+of burning retries on 503s.
+
+The semaphore is a directory of slot files, one lease being an exclusive
+flock on one of them. The kernel drops the lock when the holding process
+exits, so a killed job never leaks a slot. Waiting for a slot is bounded by
+the time budget of the running job, see deadline.py. Containers share the semaphore by
+mounting the same host directory (SCIHUB_LEASE_DIR). Where the directory can't
+be used, an in-process semaphore with the same interface stands in; tests can
+install one with set_governor().
+"""
+
+import os
+import time
+import errno
+import fcntl
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from rate_limiter import get_limiter
+from deadline import DeadlineExceeded, get_deadline
+
+
+logger = logging.getLogger('concurrency_governor')
+logger.setLevel(logging.INFO)
+
+# directory of the slot files, shared by the containers of a worker host
+LEASE_DIR = os.environ.get("SCIHUB_LEASE_DIR", "/home/ops/scihub_leases")
+
+# concurrent connections allowed per upstream
+MAX_CONNECTIONS = int(os.environ.get("SCIHUB_MAX_CONNECTIONS", 4))
+
+# seconds between attempts to take a slot
+POLL_INTERVAL = 0.5
+
+# waits for a slot longer than this many seconds are logged
+SLOW_WAIT = 10.0
+
+# registry of governors shared within the process, keyed by upstream name
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+class LeaseTimeout(Exception):
+    pass
+
+
+class LeaseSemaphore(object):
+    """Counting semaphore handing out leases, see FileLeaseSemaphore and LocalLeaseSemaphore."""
+
+    def __init__(self, name, slots, poll_interval=POLL_INTERVAL):
+        self.name = name
+        self.slots = slots
+        self.poll_interval = poll_interval
+
+    def try_acquire(self):
+        """Take a slot if one is free, return its token or None."""
+        raise NotImplementedError
+
+    def release(self, token):
+        raise NotImplementedError
+
+    def acquire(self, timeout=None):
+        """
+        Block until a slot is free and take it. Raises LeaseTimeout after
+        timeout, and DeadlineExceeded once the job's time budget runs out.
+        :param timeout: seconds to wait at most, None to wait as long as the time budget allows
+        :return: token to release the slot with
+        """
+        deadline = get_deadline()
+        start = time.time()
+        while True:
+            token = self.try_acquire()
+            if token is not None:
+                waited = time.time() - start
+                if waited > SLOW_WAIT:
+                    logger.info("Waited {:.1f}s for a {} connection slot".format(waited, self.name))
+                return token
+            if timeout is not None and time.time() - start >= timeout:
+                raise LeaseTimeout("No {} connection slot free after {}s".format(self.name, timeout))
+            remaining = deadline.remaining()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded("Job time budget exhausted waiting for a {} connection slot".format(self.name))
+            time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """Hold a slot for the duration of a with block."""
+        token = self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release(token)
+
+
+class FileLeaseSemaphore(LeaseSemaphore):
+    """Semaphore shared by all processes on a host through flock()ed slot files."""
+
+    def __init__(self, name, slots, lock_dir=None, poll_interval=POLL_INTERVAL):
+        super(FileLeaseSemaphore, self).__init__(name, slots, poll_interval)
+        self.lock_dir = lock_dir = lock_dir or LEASE_DIR
+        # a directory of the container's own can't be shared with the other jobs, so it is never created here
+        if not os.path.isdir(lock_dir):
+            raise IOError(errno.ENOENT, "Lease directory not mounted", lock_dir)
+        if not os.access(lock_dir, os.W_OK):
+            raise IOError(errno.EACCES, "Lease directory not writable", lock_dir)
+
+    def get_slot_path(self, slot):
+        return os.path.join(self.lock_dir, "{}.{}.lock".format(self.name, slot))
+
+    def try_acquire(self):
+        # start at a random slot so waiting processes don't all contend for slot 0
+        first = random.randrange(self.slots)
+        for i in range(self.slots):
+            fd = os.open(self.get_slot_path((first + i) % self.slots), os.O_CREAT | os.O_RDWR, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+        return None
+
+    def release(self, token):
+        try:
+            fcntl.flock(token, fcntl.LOCK_UN)
+        finally:
+            os.close(token)
+
+
+class LocalLeaseSemaphore(LeaseSemaphore):
+    """In-process stand-in for FileLeaseSemaphore, for tests and hosts without a lease directory."""
+
+    def __init__(self, name, slots, poll_interval=POLL_INTERVAL):
+        super(LocalLeaseSemaphore, self).__init__(name, slots, poll_interval)
+        self._semaphore = threading.BoundedSemaphore(slots)
+
+    def try_acquire(self):
+        return True if self._semaphore.acquire(False) else None
+
+    def release(self, token):
+        self._semaphore.release()
+
+
+def get_governor(name="scihub", slots=None):
+    """
+    Return the lease semaphore of an upstream, creating it on first use.
+    :param name: upstream name
+    :param slots: concurrent connections, MAX_CONNECTIONS by default, only used on creation
+    :return: LeaseSemaphore
+    """
+    with _governors_lock:
+        if name not in _governors:
+            slots = slots or MAX_CONNECTIONS
+            try:
+                _governors[name] = FileLeaseSemaphore(name, slots)
+            except (IOError, OSError) as e:
+                logger.warning("Can't use lease directory {} ({}), limiting {} connections per process only".format(
+                    LEASE_DIR, e, name))
+                _governors[name] = LocalLeaseSemaphore(name, slots)
+        return _governors[name]
+
+
+def admit(name="scihub"):
+    """
+    Wait for a connection slot and a rate limiter token of an upstream, e.g.
+    as the admit function of hedged_requests.hedged_request().
+    :param name: upstream name
+    :return: function releasing the slot
+    """
+    governor = get_governor(name)
+    token = governor.acquire()
+    try:
+        get_limiter(name).acquire()
+    except Exception:
+        governor.release(token)
+        raise
+    return lambda: governor.release(token)
+
+
+def set_governor(name, governor):
+    """Install the lease semaphore of an upstream, e.g. a LocalLeaseSemaphore in tests."""
+    with _governors_lock:
+        _governors[name] = governor
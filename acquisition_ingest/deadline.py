@@ -0,0 +1,185 @@
+"""
+Job time budget and the request timeouts derived from it.
+
+A request without a timeout can hang on a dead socket until HySDS kills the
+job at its time_limit, losing all its work. The deadline of a job is its soft
+time limit from _context.json, counted from when the job started, less a
+margin kept for checkpointing and exiting. Every SciHub, ASF and GRQ call
+gets a timeout capped by the time left, and the long loops stop at the
+deadline, record how far they got and exit cleanly. Calls made after the
+deadline, i.e. the checkpoint writes, may use what is left of the margin.
+
+Outside of a HySDS job there is no _context.json soft time limit and only the
+per-call caps apply.
+"""
+
+import json
+import time
+import logging
+import threading
+import requests
+
+
+logger = logging.getLogger('deadline')
+logger.setLevel(logging.INFO)
+
+# seconds before the soft time limit to stop and checkpoint
+DEADLINE_MARGIN = 120
+
+# upper bound of a single request's timeout in seconds
+REQUEST_TIMEOUT = 180
+
+# shortest timeout given to a request while time is left
+MIN_TIMEOUT = 5
+
+# process start, the best estimate of the job start available to the job
+_started = time.time()
+
+_deadline = None
+_deadline_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    """Point in time by which a job has to be wrapping up."""
+
+    def __init__(self, expires_at=None, margin=DEADLINE_MARGIN):
+        """
+        :param expires_at: epoch seconds of the soft time limit, None for no limit
+        :param margin: seconds before expires_at to stop at
+        """
+        self.expires_at = expires_at
+        self.margin = margin
+
+    @classmethod
+    def from_context(cls, ctx=None, margin=DEADLINE_MARGIN):
+        """
+        Deadline of the running job from its soft time limit.
+        :param ctx: job context, read from _context.json if None
+        :return: Deadline, without a limit if the context has none
+        """
+        if ctx is None:
+            try:
+                with open("_context.json") as f:
+                    ctx = json.load(f)
+            except (IOError, OSError, ValueError):
+                ctx = {}
+        soft_time_limit = ctx.get("soft_time_limit") or \
+            (ctx.get("job_specification") or {}).get("soft_time_limit")
+        if not soft_time_limit:
+            return cls(margin=margin)
+        # keep at least half the budget for work on short jobs
+        margin = min(margin, int(soft_time_limit) / 2.0)
+        logger.info("Soft time limit {}s, stopping {}s before it".format(soft_time_limit, margin))
+        return cls(_started + int(soft_time_limit), margin)
+
+    def remaining(self):
+        """Seconds left until the deadline, None if there is no limit."""
+        if self.expires_at is None:
+            return None
+        return self.expires_at - self.margin - time.time()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def check(self):
+        """Raise DeadlineExceeded if the deadline has passed."""
+        if self.expired():
+            raise DeadlineExceeded("Job time budget exhausted")
+
+    def get_timeout(self, cap=REQUEST_TIMEOUT):
+        """
+        Timeout for a call: cap, or less if the deadline is closer. Past the
+        deadline, the time left until the soft time limit itself.
+        Raises DeadlineExceeded if the soft time limit has passed.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        if remaining <= 0:
+            remaining += self.margin
+            if remaining <= 0:
+                raise DeadlineExceeded("Job time budget exhausted")
+        return max(min(cap, remaining), min(cap, MIN_TIMEOUT))
+
+
+def get_deadline():
+    """Return the deadline of the running job, read from _context.json on first use."""
+    global _deadline
+    with _deadline_lock:
+        if _deadline is None:
+            _deadline = Deadline.from_context()
+        return _deadline
+
+
+def set_deadline(deadline):
+    """Install the deadline of the running job, e.g. a Deadline() without limit in tests."""
+    global _deadline
+    with _deadline_lock:
+        _deadline = deadline
+
+
+def get_timeout(cap=REQUEST_TIMEOUT):
+    """Timeout for a call of the running job, see Deadline.get_timeout()."""
+    return get_deadline().get_timeout(cap)
+
+
+class UntilDeadline(object):
+    """
+    Iterate until the deadline of the running job passes, e.g. over the pages
+    of a scrape. An error of the underlying iterator once the deadline has
+    passed, e.g. a request timed out by it, ends the iteration too. stopped
+    tells if the iteration was cut short.
+    """
+
+    def __init__(self, iterable, what="items"):
+        self.iterable = iterable
+        self.what = what
+        self.stopped = False
+
+    def __iter__(self):
+        deadline = get_deadline()
+        iterator = iter(self.iterable)
+        while True:
+            if deadline.expired():
+                self.stopped = True
+            else:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                except Exception:
+                    if not deadline.expired():
+                        raise
+                    self.stopped = True
+            if self.stopped:
+                logger.warning("Job time budget exhausted, stopping before all {} were processed".format(self.what))
+                return
+            yield item
+
+
+class DeadlineSession(requests.Session):
+    """Session giving every request a timeout bounded by the running job's deadline."""
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        super(DeadlineSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = get_timeout(self.timeout)
+        return super(DeadlineSession, self).request(method, url, **kwargs)
+
+
+def get_session(pool_size=1, timeout=REQUEST_TIMEOUT):
+    """DeadlineSession with enough pooled connections for pool_size concurrent requests."""
+    session = DeadlineSession(timeout)
+    if pool_size > 1:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
@@ -0,0 +1,140 @@
+"""
+Batch processing of acquisition footprints.
+
+Takes a whole page of WKT footprints at a time: parsing, envelopes and
+coordinate extraction run as shapely 2.x array operations, and only the
+final GeoJSON lists are built in Python. Results are the same as running
+each footprint through shapely.wkt.loads and geojson.Feature. With shapely
+1.x every footprint is processed on its own.
+"""
+
+import numpy as np
+import shapely
+import shapely.wkt
+import geojson
+import geojson.geometry
+
+
+# shapely 2.x array functions
+VECTORIZED = hasattr(shapely, "from_wkt")
+
+# decimals geojson rounds coordinates to, None for geojson versions that don't round
+PRECISION = getattr(geojson.geometry, "DEFAULT_PRECISION", None)
+
+POLYGON_TYPE_ID = 3
+
+
+def _round(values):
+    if PRECISION is None:
+        return values
+    return [round(v, PRECISION) for v in values]
+
+
+def _to_geojson(geom):
+    return geojson.Feature(geometry=geom, properties={}).geometry
+
+
+def parse_footprints(wkts):
+    """
+    Parse WKT footprints.
+    :param wkts: list of WKT strings
+    :return: array (or list, with shapely 1.x) of shapely geometries
+    """
+    if VECTORIZED:
+        return shapely.from_wkt(np.array(wkts, dtype=object))
+    return [shapely.wkt.loads(wkt) for wkt in wkts]
+
+
+def get_bboxes(geoms):
+    """
+    Envelopes of parsed footprints, as massage_result() stores them in the met bbox.
+    :param geoms: result of parse_footprints()
+    :return: list of closed [min_x, min_y] ... [min_x, min_y] rings
+    """
+    if VECTORIZED:
+        bounds = shapely.bounds(geoms).tolist()
+    else:
+        bounds = [g.bounds for g in geoms]
+    bboxes = []
+    for b in bounds:
+        min_x, min_y, max_x, max_y = _round(b)
+        bboxes.append([[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]])
+    return bboxes
+
+
+def _simple_polygons(geoms):
+    """Indices of the polygons without holes, which are handled in bulk."""
+    if not VECTORIZED or len(geoms) == 0:
+        return np.array([], dtype=int)
+    mask = (shapely.get_type_id(geoms) == POLYGON_TYPE_ID) & (shapely.get_num_interior_rings(geoms) == 0)
+    return np.flatnonzero(mask)
+
+
+def _exterior_rings(geoms):
+    """Exterior ring of each polygon as a list of [x, y]."""
+    coords, index = shapely.get_coordinates(shapely.get_exterior_ring(geoms), return_index=True)
+    flat = _round(coords.ravel().tolist())
+    counts = np.bincount(index, minlength=len(geoms)).tolist()
+    rings = []
+    pos = 0
+    for count in counts:
+        end = pos + 2 * count
+        rings.append([flat[i:i + 2] for i in range(pos, end, 2)])
+        pos = end
+    return rings
+
+
+def get_locations(geoms):
+    """
+    GeoJSON geometries of parsed footprints, as massage_result() stores them in the met location.
+    :param geoms: result of parse_footprints()
+    :return: list of GeoJSON geometry dicts
+    """
+    simple = _simple_polygons(geoms)
+    locations = [None] * len(geoms)
+    if len(simple):
+        for i, ring in zip(simple.tolist(), _exterior_rings(geoms[simple])):
+            locations[i] = {"type": "Polygon", "coordinates": [ring]}
+    for i, geom in enumerate(geoms):
+        if locations[i] is None:
+            locations[i] = _to_geojson(geom)
+    return locations
+
+
+def signed_areas(rings):
+    """
+    Signed area of each ring in one pass, positive for clockwise rings.
+    :param rings: list of lists of [x, y]
+    :return: numpy array of areas
+    """
+    if not rings:
+        return np.zeros(0)
+    counts = np.array([len(ring) for ring in rings])
+    xy = np.array([point for ring in rings for point in ring], dtype=float)
+    starts = np.cumsum(counts) - counts
+    ring_start = np.repeat(starts, counts)
+    following = ring_start + (np.arange(len(xy)) - ring_start + 1) % np.repeat(counts, counts)
+    terms = xy[:, 1] * xy[following, 0] - xy[following, 1] * xy[:, 0]
+    return np.add.reduceat(terms, starts) / 2.0
+
+
+def get_es_locations(geoms):
+    """
+    GeoJSON geometries of parsed footprints, prepared for ES the way the ASF
+    scraper does it: a repeated final vertex is dropped and polygons are
+    reversed if their ring is clockwise.
+    :param geoms: result of parse_footprints()
+    :return: list of GeoJSON geometry dicts
+    """
+    locations = get_locations(geoms)
+    polygons = [location for location in locations if location["type"] == "Polygon"]
+    rings = []
+    for location in polygons:
+        ring = location["coordinates"][0]
+        if ring[-1] == ring[-2]:
+            del ring[-1]
+        rings.append(ring)
+    for location, area in zip(polygons, signed_areas(rings).tolist()):
+        if area > 0:
+            location["coordinates"][0] = location["coordinates"][0][::-1]
+    return locations
@@ -0,0 +1,161 @@
+"""
+Streaming scan/scroll over GRQ indexes.
+
+Hits are yielded page by page as they come back from ES instead of being
+gathered into a list first, all requests go over one pooled keep-alive
+session, and scroll contexts are cleared as soon as the iteration finishes,
+fails or is abandoned. Large indexes can be scanned by several workers at
+once, each scrolling its own subset of the shards.
+"""
+
+import json
+import logging
+import threading
+import requests
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+from deadline import get_session
+
+
+logger = logging.getLogger('grq_scroll')
+logger.setLevel(logging.INFO)
+
+# how long ES keeps a scroll context alive between requests
+KEEP_ALIVE = "60m"
+
+# hits per shard per scroll request
+PAGE_SIZE = 10000
+
+# keep-alive connections kept per host
+POOL_SIZE = 10
+
+# how often a blocked slice worker checks whether the scroll was abandoned
+POLL_INTERVAL = 1.0
+
+_DONE = object()
+
+# pooled keep-alive session shared by all GRQ callers
+grq_session = get_session(POOL_SIZE)
+
+
+def clear_scroll(es_url, scroll_id, session=grq_session):
+    """Free a scroll context on the ES side."""
+    try:
+        session.delete("{}/_search/scroll".format(es_url), data=scroll_id)
+    except requests.exceptions.RequestException as e:
+        logger.warning("Failed to clear scroll: {}".format(e))
+
+
+def get_shards(es_url, index, session=grq_session):
+    """
+    Shard numbers of an index or index pattern.
+    :return: sorted list of shard numbers
+    """
+    r = session.get("{}/{}/_search_shards".format(es_url, index))
+    r.raise_for_status()
+    return sorted(set(group[0]["shard"] for group in r.json()["shards"]))
+
+
+def _scan(es_url, index, query, params, session):
+    """Generator of the pages of hits of one scan/scroll."""
+    r = session.post("{}/{}/_search".format(es_url, index), params=params, data=json.dumps(query))
+    r.raise_for_status()
+    res = r.json()
+    scroll_id = res.get("_scroll_id")
+    if scroll_id is None:
+        if res["hits"]["total"]:
+            logger.warning("_scroll_id not found in scan result for the query:\n{}".format(json.dumps(query)))
+        return
+    try:
+        # a scan returns its first hits with the first scroll request
+        if res["hits"]["hits"]:
+            yield res["hits"]["hits"]
+        while res["hits"]["total"]:
+            r = session.post("{}/_search/scroll".format(es_url), params={"scroll": KEEP_ALIVE}, data=scroll_id)
+            r.raise_for_status()
+            res = r.json()
+            scroll_id = res.get("_scroll_id", scroll_id)
+            if len(res["hits"]["hits"]) == 0:
+                break
+            yield res["hits"]["hits"]
+    finally:
+        clear_scroll(es_url, scroll_id, session)
+
+
+def _scan_slice(es_url, index, query, params, session, pages, stop):
+    """Run one slice of a parallel scan, handing its pages to the consumer."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    scan = _scan(es_url, index, query, params, session)
+    try:
+        for hits in scan:
+            if not put(hits):
+                break
+        put(_DONE)
+    except Exception as e:
+        put(e)
+    finally:
+        scan.close()
+
+
+def scroll(es_url, index, query, source=None, size=PAGE_SIZE, slices=1, session=None):
+    """
+    Iterate over all hits of a query with scan/scroll.
+    :param es_url: GRQ ES url
+    :param index: index or index pattern
+    :param query: ES query body
+    :param source: _source includes (list of fields, False for none), None to return the whole _source
+    :param size: hits per shard per scroll request
+    :param slices: number of workers scanning the shards in parallel, hits then come in no particular order
+    :param session: requests session, the shared pooled session by default
+    :return: generator of hits
+    """
+    es_url = es_url.rstrip('/')
+    session = session or grq_session
+    if source is not None:
+        query = dict(query, _source=source)
+    params = {"search_type": "scan", "scroll": KEEP_ALIVE, "size": size}
+
+    if slices <= 1:
+        for hits in _scan(es_url, index, query, params, session):
+            for hit in hits:
+                yield hit
+        return
+
+    # ES 1.x/2.x have no sliced scroll, so each worker scans a set of shards
+    shards = get_shards(es_url, index, session)
+    groups = [shards[i::slices] for i in range(min(slices, len(shards)))]
+    pages = Queue(maxsize=2 * len(groups))
+    stop = threading.Event()
+    workers = []
+    for group in groups:
+        slice_params = dict(params, preference="_shards:{}".format(",".join(str(shard) for shard in group)))
+        worker = threading.Thread(target=_scan_slice,
+                                  args=(es_url, index, query, slice_params, session, pages, stop))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    try:
+        running = len(workers)
+        while running:
+            item = pages.get()
+            if item is _DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                for hit in item:
+                    yield hit
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,290 @@
+"""
+Hedged requests across the SciHub apihub and dhus mirrors.
+
+Both mirrors serve the same products and search index, but either can stall
+for minutes at times. A hedged request goes to the preferred mirror first and,
+if no usable response has arrived after a delay, to the other mirror too; the
+first usable response wins. The delay is a high percentile of the latencies
+seen recently, so only the slowest few percent of requests are duplicated.
+A request that fails or gets a server error is hedged at once.
+
+Waiting for a connection slot or a rate limiter token is local queueing, not
+upstream latency: each attempt is admitted before its timer starts, the hedge
+delay runs from when the preferred request was actually sent, and a request
+that fails before it was sent is not hedged. Requests can't be aborted once
+sent, so the losing request runs to the end of its headers and its response
+is then closed, which drops a streamed body. An attempt still waiting to be
+admitted when the race is decided is dropped unsent.
+
+Latency history is kept per request kind and persisted next to the SciHub
+connection slot files, so short jobs start from what earlier jobs saw. New
+samples are written out in batches and at exit, merged under a file lock
+with those the other jobs of the host wrote meanwhile.
+"""
+
+import os
+import json
+import math
+import time
+import fcntl
+import atexit
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import concurrency_governor
+
+
+logger = logging.getLogger('hedged_requests')
+logger.setLevel(logging.INFO)
+
+MIRRORS = ("/apihub/", "/dhus/")
+
+# concurrent requests in flight across all hedged calls of a process
+MAX_IN_FLIGHT = 16
+
+# how often to check if the preferred request has been sent, to start the hedge delay
+SEND_POLL_INTERVAL = 0.1
+
+# persist the latency history after this many new samples or seconds, whichever comes first
+SAVE_EVERY = 20
+SAVE_INTERVAL = 60
+
+# registry of latency trackers shared within the process, keyed by request kind
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+_executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT)
+
+
+class LatencyTracker(object):
+    """Recent response times of a kind of request and the hedge delay derived from them."""
+
+    def __init__(self, name, percentile=95, window=200, min_samples=20, initial_delay=10.0,
+                 min_delay=0.5, max_delay=60.0, state_dir=None, save_every=SAVE_EVERY,
+                 save_interval=SAVE_INTERVAL):
+        """
+        :param name: request kind, e.g. scihub-search
+        :param percentile: latency percentile to hedge at
+        :param window: number of recent response times kept
+        :param min_samples: samples needed before the percentile is used
+        :param initial_delay: hedge delay in seconds until then
+        :param min_delay: lower bound of the hedge delay
+        :param max_delay: upper bound of the hedge delay
+        :param state_dir: directory to persist the history in, None to keep it in memory
+        :param save_every: new samples after which the history is persisted
+        :param save_interval: seconds after which new samples are persisted
+        """
+        self.name = name
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.samples = deque(maxlen=window)
+        self.state_file = os.path.join(state_dir, "{}.latency.json".format(name)) if state_dir else None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._unsaved = []
+        self._saved_at = time.time()
+        self.samples.extend(self.load())
+        if self.state_file:
+            atexit.register(self.save)
+
+    def load(self):
+        """Samples persisted by this and other jobs, oldest first."""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return []
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Ignoring latency history {}: {}".format(self.state_file, e))
+            return []
+
+    def save(self):
+        """Append the samples recorded since the last save to the persisted history."""
+        with self._save_lock:
+            with self._lock:
+                new, self._unsaved = self._unsaved, []
+                self._saved_at = time.time()
+            if not self.state_file or not new:
+                return
+            tmp_file = "{}.{}.tmp".format(self.state_file, os.getpid())
+            try:
+                with open("{}.lock".format(self.state_file), "a") as lock:
+                    # other jobs may have saved since this one loaded, keep their samples too
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    samples = (self.load() + new)[-self.samples.maxlen:]
+                    with open(tmp_file, "w") as f:
+                        json.dump(samples, f)
+                    os.rename(tmp_file, self.state_file)
+            except (IOError, OSError) as e:
+                logger.warning("Failed to save latency history {}: {}".format(self.state_file, e))
+                return
+        with self._lock:
+            self.samples.clear()
+            self.samples.extend(samples + self._unsaved)
+
+    def add(self, elapsed):
+        """Record a response time in seconds, persisting the history every so often."""
+        with self._lock:
+            self.samples.append(round(elapsed, 3))
+            if not self.state_file:
+                return
+            self._unsaved.append(round(elapsed, 3))
+            due = len(self._unsaved) >= self.save_every or time.time() - self._saved_at >= self.save_interval
+        if due:
+            self.save()
+
+    def get_delay(self):
+        """Seconds to wait for the preferred mirror before hedging."""
+        with self._lock:
+            samples = sorted(self.samples)
+        if len(samples) < self.min_samples:
+            return self.initial_delay
+        delay = samples[max(int(math.ceil(self.percentile / 100.0 * len(samples))) - 1, 0)]
+        return min(max(delay, self.min_delay), self.max_delay)
+
+
+def get_tracker(name, **kwargs):
+    """
+    Return the process wide latency tracker of a request kind, creating it on first use.
+    :param name: request kind, e.g. scihub-search
+    :param kwargs: LatencyTracker arguments, only used on creation
+    :return: LatencyTracker
+    """
+    with _trackers_lock:
+        if name not in _trackers:
+            state_dir = concurrency_governor.LEASE_DIR
+            if not os.path.isdir(state_dir) or not os.access(state_dir, os.W_OK):
+                state_dir = None
+            kwargs.setdefault("state_dir", state_dir)
+            _trackers[name] = LatencyTracker(name, **kwargs)
+        return _trackers[name]
+
+
+def get_mirror_urls(url):
+    """
+    Urls of the same resource on both SciHub mirrors.
+    :param url: apihub or dhus url
+    :return: list with url first, then its other mirror if it has one
+    """
+    for mirror in MIRRORS:
+        if mirror in url:
+            return [url] + [url.replace(mirror, other, 1) for other in MIRRORS if other != mirror]
+    return [url]
+
+
+def is_usable(response):
+    """Any response but a server error or throttling settles the request."""
+    return response.status_code < 500 and response.status_code != 429
+
+
+def _discard(future):
+    """Close the response of a request that lost the race."""
+    if future.cancelled() or future.exception() is not None or future.result() is None:
+        return
+    future.result().close()
+
+
+def _release_on_close(response, release):
+    """Hold what admit took until a streamed response is closed."""
+    close = response.close
+    released = []
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                release()
+
+    response.close = close_and_release
+
+
+def hedged_request(send, urls, tracker, usable=is_usable, admit=None, stream=False):
+    """
+    Send a request to the first url, and to the next if the first hasn't
+    given a usable response within the tracker's hedge delay.
+    :param send: function sending the request to a url and returning the response
+    :param urls: mirror urls, preferred first, e.g. from get_mirror_urls()
+    :param tracker: LatencyTracker of this kind of request
+    :param usable: function telling if a response settles the request
+    :param admit: function waiting until a request may be sent, returning the function
+                  to release what it took, e.g. concurrency_governor.admit
+    :param stream: the response is streamed, release what admit took when it is closed
+    :return: the first usable response, else the response of the first url
+    """
+    settled = threading.Event()
+    sent_at = {}
+
+    def timed_send(url):
+        release = admit() if admit else None
+        if settled.is_set():
+            # the race was decided while this request waited to be admitted
+            if release:
+                release()
+            return None
+        sent_at[url] = start = time.time()
+        try:
+            response = send(url)
+        except Exception:
+            if release:
+                release()
+            raise
+        tracker.add(time.time() - start)
+        if release:
+            if stream:
+                _release_on_close(response, release)
+            else:
+                release()
+        return response
+
+    if len(urls) == 1:
+        return timed_send(urls[0])
+
+    delay = tracker.get_delay()
+    futures = [_executor.submit(timed_send, urls[0])]
+    pending = set(futures)
+    winner = None
+    try:
+        while pending:
+            timeout = None
+            if len(futures) < len(urls):
+                # the hedge delay runs from when the preferred request was sent
+                sent = sent_at.get(urls[0])
+                timeout = SEND_POLL_INTERVAL if sent is None else max(delay - (time.time() - sent), 0)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None and usable(future.result()):
+                    winner = future
+                    return winner.result()
+            if len(futures) < len(urls):
+                sent = sent_at.get(urls[0])
+                if sent is None:
+                    # still waiting to be admitted, or failed before it was sent
+                    continue
+                if not done and time.time() - sent < delay:
+                    continue
+                url = urls[len(futures)]
+                if not done:
+                    logger.info("No response after {:.1f}s, hedging with {}".format(delay, url))
+                future = _executor.submit(timed_send, url)
+                futures.append(future)
+                pending.add(future)
+        # nothing usable: the first url's response, or its error
+        for future in futures:
+            if future.exception() is None:
+                winner = future
+                return winner.result()
+        return futures[0].result()
+    finally:
+        settled.set()
+        for future in futures:
+            if future is not winner:
+                future.cancel()
+                future.add_done_callback(_discard)
@@ -0,0 +1,102 @@
+"""
+Persisted ingestion-date high-water mark for incremental keep-up scraping.
+
+The cursor holds the last fully processed SciHub ingestiondate and lives as a
+document in GRQ so that it survives across jobs and workers. Writes use ES
+optimistic concurrency so overlapping jobs can never move the cursor back.
+"""
+
+import json
+import logging
+from datetime import timedelta
+import dateutil.parser
+from hysds.celery import app
+from grq_scroll import grq_session
+
+
+logger = logging.getLogger('ingest_cursor')
+logger.setLevel(logging.INFO)
+
+CURSOR_INDEX = "acquisition_ingest_state"
+CURSOR_TYPE = "cursor"
+
+# re-query this much before the cursor to pick up late indexed products
+DEFAULT_OVERLAP = timedelta(minutes=30)
+
+
+def get_cursor_url(name):
+    rest_url = app.conf["GRQ_ES_URL"][:-1] if app.conf["GRQ_ES_URL"].endswith('/') else app.conf["GRQ_ES_URL"]
+    return "{}/{}/{}/{}".format(rest_url, CURSOR_INDEX, CURSOR_TYPE, name)
+
+
+def get_cursor(name, session=grq_session):
+    """
+    Read a cursor.
+    :param name: cursor name, e.g. acquisition_ingest-scihub_hourly
+    :param session: requests session to read it over
+    :return: tuple of (ingestiondate string or None, ES document version or None)
+    """
+    r = session.get(get_cursor_url(name))
+    if r.status_code == 404:
+        logger.info("No cursor {} found".format(name))
+        return None, None
+    r.raise_for_status()
+    doc = r.json()
+    return doc["_source"]["ingestiondate"], doc["_version"]
+
+
+def get_query_start(ingestiondate, overlap=DEFAULT_OVERLAP):
+    """
+    Start time of the next query window for a cursor value.
+    :param ingestiondate: cursor value
+    :param overlap: timedelta to step back from the cursor
+    :return: ISO8601 start time
+    """
+    start = dateutil.parser.parse(ingestiondate).replace(tzinfo=None) - overlap
+    return "{}Z".format(start.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3])
+
+
+def get_high_water_mark(ingestion_dates, failed_ingestion_dates):
+    """
+    Cursor value after a run: the newest ingestion date seen, or the oldest
+    one that failed so that it is queried again on the next run.
+    :param ingestion_dates: ingestiondate of every product in the run
+    :param failed_ingestion_dates: ingestiondate of every product that failed
+    :return: ingestiondate string, None if there were no products
+    """
+    if failed_ingestion_dates:
+        return min(failed_ingestion_dates, key=dateutil.parser.parse)
+    if ingestion_dates:
+        return max(ingestion_dates, key=dateutil.parser.parse)
+    return None
+
+
+def advance_cursor(name, ingestiondate, version, session=grq_session):
+    """
+    Move a cursor forward. The write is conditional on the document version
+    read before the run, so a concurrent update makes this a no-op.
+    :param name: cursor name
+    :param ingestiondate: new cursor value
+    :param version: version returned by get_cursor(), None if the cursor did not exist
+    :param session: requests session to write it over
+    :return: True if the cursor was written
+    """
+    current, current_version = get_cursor(name, session)
+    if current is not None and dateutil.parser.parse(ingestiondate) <= dateutil.parser.parse(current):
+        logger.info("Cursor {} already at {}, not moving it back to {}".format(name, current, ingestiondate))
+        return False
+    if current_version != version:
+        logger.info("Cursor {} was updated by another run, leaving it at {}".format(name, current))
+        return False
+
+    if version is None:
+        url = "{}?op_type=create".format(get_cursor_url(name))
+    else:
+        url = "{}?version={}".format(get_cursor_url(name), version)
+    r = session.put(url, data=json.dumps({"ingestiondate": ingestiondate}))
+    if r.status_code == 409:
+        logger.info("Cursor {} was updated by another run, leaving it".format(name))
+        return False
+    r.raise_for_status()
+    logger.info("Advanced cursor {} to {}".format(name, ingestiondate))
+    return True
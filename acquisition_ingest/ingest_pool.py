@@ -0,0 +1,134 @@
+"""
+Bounded thread pool for running dataset ingests concurrently.
+
+Results come back in submission order on the caller's thread, so reports
+and the still missing list come out the same as with serial ingest and need
+no locking. An ingest that hasn't finished within the timeout of its
+submission is reported as failed, whether it is still queued or running.
+
+A timed out ingest that is running can't be stopped, and its thread is lost
+to the pool. So that ingests queued behind hung ones still get to run, the
+pool then moves its queued ingests to a new executor and leaves the old one's
+threads to finish in the background. Past a limit of abandoned executors the
+ingests are taken to be hanging on something that won't recover, and the
+pool reports all remaining and later ingests as failed without running them.
+"""
+
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError
+
+
+logger = logging.getLogger('ingest_pool')
+logger.setLevel(logging.INFO)
+
+# seconds from submission within which an ingest has to finish
+INGEST_TIMEOUT = 300
+
+# how often to check a running ingest against its timeout
+POLL_INTERVAL = 1.0
+
+# executors with hung ingests abandoned before the pool gives up
+MAX_ABANDONED = 3
+
+
+def _failed(error):
+    """Future of an ingest that is not run."""
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+class IngestPool(object):
+    """Run ingests on a thread pool and report their results in order."""
+
+    def __init__(self, workers, timeout=INGEST_TIMEOUT, max_abandoned=MAX_ABANDONED):
+        """
+        :param workers: number of concurrent ingests
+        :param timeout: seconds from submission within which an ingest has to finish
+        :param max_abandoned: executors with hung ingests to replace before failing all ingests
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.max_abandoned = max_abandoned
+        self.abandoned = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = deque()
+
+    def submit(self, key, fn, *args):
+        """
+        Queue fn(*args). Blocks while too many ingests are outstanding.
+        :param key: value reported back with the result
+        :return: list of (key, result) of finished ingests, in submission order
+        """
+        if self.executor is None:
+            future = _failed(RuntimeError("Ingest pool gave up after {} hung thread pools".format(self.abandoned)))
+        else:
+            future = self.executor.submit(fn, *args)
+        self.pending.append([key, time.time() + self.timeout, fn, args, future])
+        results = []
+        while len(self.pending) >= 2 * self.workers or (self.pending and self.pending[0][4].done()):
+            results.append(self._pop())
+        return results
+
+    def close(self):
+        """
+        Wait for all queued ingests.
+        :return: list of (key, result) of the remaining ingests, in submission order
+        """
+        results = []
+        while self.pending:
+            results.append(self._pop())
+        # don't wait on threads of timed out ingests
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        return results
+
+    def _pop(self):
+        """Wait for the oldest ingest. Its result is False if it raised or timed out."""
+        key, deadline, fn, args, future = self.pending.popleft()
+        while True:
+            try:
+                return key, future.result(timeout=max(min(POLL_INTERVAL, deadline - time.time()), 0))
+            except TimeoutError:
+                if time.time() < deadline:
+                    continue
+                if future.cancel():
+                    logger.error("Ingest not started within {}s".format(self.timeout))
+                else:
+                    logger.error("Ingest timed out after {}s".format(self.timeout))
+                    self._replace_executor()
+                return key, False
+            except Exception as e:
+                logger.error("Ingest failed: {}".format(e))
+                return key, False
+
+    def _replace_executor(self):
+        """
+        Move the queued ingests off the executor holding a hung ingest to a new
+        one, or fail them once max_abandoned executors have been abandoned.
+        """
+        if self.executor is None:
+            return
+        self.abandoned += 1
+        if self.abandoned > self.max_abandoned:
+            logger.error("Ingests hung on {} thread pools, failing the {} queued ingests and all later ones".format(
+                self.abandoned, len(self.pending)))
+            error = RuntimeError("Ingest pool gave up after {} hung thread pools".format(self.abandoned))
+            for item in self.pending:
+                if item[4].cancel():
+                    item[4] = _failed(error)
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            return
+        hung, self.executor = self.executor, ThreadPoolExecutor(max_workers=self.workers)
+        moved = 0
+        for item in self.pending:
+            key, deadline, fn, args, future = item
+            # only ingests that haven't started can be cancelled and moved
+            if future.cancel():
+                item[4] = self.executor.submit(fn, *args)
+                moved += 1
+        logger.warning("Moved {} queued ingests to a new thread pool".format(moved))
+        hung.shutdown(wait=False)
@@ -0,0 +1,112 @@
+"""
+Coarse query geometries for AOIs.
+
+Complex AOIs with thousands of vertices make for very long OpenSearch URLs
+and slow ES geo_shape filters. The upstream queries use a simpler geometry
+that contains the AOI instead, and the results are intersected with the
+exact AOI locally. Prepared geometries are cached on disk by AOI id so that
+repeated runs for the same AOI reuse them. The cache directory is mounted from
+the host (AOI_QUERY_GEOMETRY_DIR) so that it outlives the job containers;
+where it isn't, the cache falls back to the temp directory of the job.
+"""
+
+import os
+import hashlib
+import logging
+import tempfile
+import shapely.wkt
+from shapely.geometry import box, mapping
+
+
+logger = logging.getLogger('query_geometry')
+logger.setLevel(logging.INFO)
+
+# exact: the AOI as is, simplify: AOI simplified within the tolerance,
+# hull: convex hull of the AOI, bbox: bounding box of the AOI
+MODES = ("exact", "simplify", "hull", "bbox")
+DEFAULT_MODE = "simplify"
+
+# simplification tolerance in degrees
+DEFAULT_TOLERANCE = 0.01
+
+# directory of the cached query geometries, shared by the containers of a worker host
+CACHE_DIR = os.environ.get("AOI_QUERY_GEOMETRY_DIR", "/home/ops/aoi_query_geometry")
+
+_cache_dir = None
+
+
+def get_cache_dir():
+    """Cache directory, the temp directory if CACHE_DIR isn't mounted or writable."""
+    global _cache_dir
+    if _cache_dir is None:
+        if os.path.isdir(CACHE_DIR) and os.access(CACHE_DIR, os.W_OK):
+            _cache_dir = CACHE_DIR
+        else:
+            _cache_dir = os.path.join(tempfile.gettempdir(), "aoi_query_geometry")
+            logger.warning("Can't use query geometry cache {}, caching in {} for this job only".format(
+                CACHE_DIR, _cache_dir))
+    return _cache_dir
+
+
+def prepare(geom, mode=DEFAULT_MODE, tolerance=DEFAULT_TOLERANCE):
+    """
+    Coarse geometry that contains geom.
+    :param geom: shapely AOI geometry
+    :param mode: one of MODES
+    :param tolerance: simplification tolerance in degrees
+    :return: shapely geometry
+    """
+    if mode == "exact":
+        return geom
+    if mode == "simplify":
+        # simplifying moves the boundary by at most the tolerance, so grow it by that much first
+        return geom.buffer(tolerance).simplify(tolerance, preserve_topology=True)
+    if mode == "hull":
+        return geom.convex_hull
+    if mode == "bbox":
+        return box(*geom.bounds)
+    raise RuntimeError("Unrecognized query geometry mode: %s" % mode)
+
+
+def count_vertices(geom):
+    return sum(len(polygon.exterior.coords) for polygon in getattr(geom, "geoms", [geom]))
+
+
+def get_cache_path(aoi_id, geom, mode, tolerance):
+    # the geometry is part of the key so that an edited AOI isn't served a stale query geometry
+    key = hashlib.sha1("{}|{}|{}".format(geom.wkb_hex, mode, tolerance).encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir(), "{}-{}.wkt".format(aoi_id, key))
+
+
+def get_query_geometry(geom, mode=DEFAULT_MODE, tolerance=DEFAULT_TOLERANCE, aoi_id=None):
+    """
+    Coarse query geometry of an AOI, read from and written to the cache if aoi_id is given.
+    :param geom: shapely AOI geometry
+    :param mode: one of MODES
+    :param tolerance: simplification tolerance in degrees
+    :param aoi_id: AOI id to cache under
+    :return: geojson geometry dict
+    """
+    if aoi_id is None or mode == "exact":
+        return mapping(prepare(geom, mode, tolerance))
+
+    cache_path = get_cache_path(aoi_id, geom, mode, tolerance)
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            logger.info("Using cached query geometry {}".format(cache_path))
+            return mapping(shapely.wkt.loads(f.read()))
+
+    query_geom = prepare(geom, mode, tolerance)
+    logger.info("Prepared {} query geometry for {}: {} vertices, AOI has {}".format(
+        mode, aoi_id, count_vertices(query_geom), count_vertices(geom)))
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o755)
+        tmp_path = "{}.{}".format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(query_geom.wkt)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        logger.warning("Failed to cache query geometry for {}: {}".format(aoi_id, e))
+    return mapping(query_geom)
@@ -0,0 +1,121 @@
+"""
+Adaptive token bucket rate limiter shared by all SciHub/ApiHub callers.
+
+The bucket refill rate grows additively after fast successful responses and
+is cut multiplicatively when the upstream throttles (429/503), errors out or
+responds slowly, so requests run at the highest rate the upstream tolerates.
+"""
+
+import time
+import logging
+import threading
+import requests
+
+
+logger = logging.getLogger('rate_limiter')
+logger.setLevel(logging.INFO)
+
+# status codes SciHub uses to signal it is overloaded
+THROTTLE_CODES = (429, 503)
+
+# registry of limiters shared within the process, keyed by upstream name
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class AdaptiveRateLimiter(object):
+    """Token bucket with an AIMD-adjusted refill rate (requests/second)."""
+
+    def __init__(self, name, rate=1/3.0, min_rate=0.05, max_rate=4.0, burst=1,
+                 increase=0.05, decrease=0.5, slow_response=30.0):
+        """
+        :param name: upstream name, used in log messages
+        :param rate: initial refill rate in requests per second
+        :param min_rate: lower bound of the refill rate
+        :param max_rate: upper bound of the refill rate
+        :param burst: bucket capacity, i.e. max requests issued back to back
+        :param increase: rate added after every fast successful response
+        :param decrease: factor the rate is multiplied by on throttling
+        :param slow_response: response time in seconds treated as overload
+        """
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_response = slow_response
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """Block until a token is available and consume it."""
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def feedback(self, status_code, elapsed):
+        """
+        Adjust the refill rate from the outcome of a request.
+        :param status_code: HTTP status code, None if the request failed
+        :param elapsed: response time in seconds
+        """
+        with self._lock:
+            if status_code is None or status_code in THROTTLE_CODES or elapsed > self.slow_response:
+                rate = max(self.min_rate, self.rate * self.decrease)
+                # drop any saved up tokens so the slowdown takes effect at once
+                self._tokens = min(self._tokens, 0)
+                logger.info("{} throttled (status: {}, elapsed: {:.1f}s), rate {:.3f} -> {:.3f} req/s".format(
+                    self.name, status_code, elapsed, self.rate, rate))
+                self.rate = rate
+            elif status_code < 400:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def request(self, method, *args, **kwargs):
+        """
+        Issue a request through the limiter, e.g. limiter.request(session.get, url).
+        :param method: requests callable, e.g. session.get or session.head
+        :return: the response
+        """
+        self.acquire()
+        return self.issue(method, *args, **kwargs)
+
+    def issue(self, method, *args, **kwargs):
+        """
+        Issue a request whose token has already been taken with acquire() and
+        adjust the rate from its outcome.
+        :param method: requests callable, e.g. session.get or session.head
+        :return: the response
+        """
+        start = time.time()
+        try:
+            response = method(*args, **kwargs)
+        except requests.exceptions.RequestException:
+            self.feedback(None, time.time() - start)
+            raise
+        self.feedback(response.status_code, time.time() - start)
+        return response
+
+
+def get_limiter(name="scihub", **kwargs):
+    """
+    Return the process wide limiter for an upstream, creating it on first use.
+    :param name: upstream name
+    :param kwargs: AdaptiveRateLimiter arguments, only used on creation
+    :return: AdaptiveRateLimiter
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveRateLimiter(name, **kwargs)
+        return _limiters[name]
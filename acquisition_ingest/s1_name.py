@@ -0,0 +1,82 @@
+"""
+Sentinel-1 product name and timestamp parsing.
+
+S1 product names follow MMM_BB_TTTR_LFPP_YYYYMMDDTHHMMSS_YYYYMMDDTHHMMSS_OOOOOO_DDDDDD_CCCC,
+e.g. S1A_IW_SLC__1SDV_20150909T163711_20150909T163746_007640_00A97E_A69D.
+"""
+
+import re
+from collections import namedtuple
+from datetime import datetime
+import dateutil.parser
+from dateutil.tz import tzutc
+
+
+S1_NAME_RE = re.compile(r'(?P<spacecraft>S1\w)_(?P<mode>\w{2})_(?P<product_type>[A-Z]{3})(?P<resolution>[\w])_'
+                        r'(?P<level>\d)(?P<product_class>\w)(?P<polarisation>\w{2})_'
+                        r'(?P<start>\d{8}T\d{6})_(?P<stop>\d{8}T\d{6})_'
+                        r'(?P<orbit>\d{6})_(?P<datatake>\w{6})_(?P<crc>\w{4})')
+
+# fixed layout of ISO8601 timestamps in SciHub and GRQ metadata: 2019-05-01T12:30:00[.fff...][Z]
+ISO_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6})\d*)?Z?$')
+
+S1Name = namedtuple("S1Name", ["spacecraft", "mode", "product_type", "resolution", "level", "product_class",
+                               "polarisation", "start", "stop", "orbit", "datatake", "crc"])
+
+def _format_name_time(compact):
+    """20150909T163711 -> 2015-09-09T16:37:11"""
+    return "{}-{}-{}T{}:{}:{}".format(compact[0:4], compact[4:6], compact[6:8],
+                                      compact[9:11], compact[11:13], compact[13:15])
+
+
+def parse_name(name):
+    """
+    Parse an S1 product name (or a name starting with one, e.g. with .zip or .SAFE).
+    :param name: product name
+    :return: S1Name with start/stop formatted as YYYY-MM-DDTHH:MM:SS, None if it doesn't match
+    """
+    m = S1_NAME_RE.match(name)
+    if m is None:
+        return None
+    g = m.groupdict()
+    return S1Name(g["spacecraft"], g["mode"], g["product_type"], g["resolution"].strip("_"), g["level"],
+                  g["product_class"], g["polarisation"], _format_name_time(g["start"]),
+                  _format_name_time(g["stop"]), int(g["orbit"]), g["datatake"], g["crc"])
+
+
+def parse_names(names):
+    """
+    Batch form of parse_name().
+    :param names: list of product names
+    :return: list of S1Name (or None), in the order of names
+    """
+    match = S1_NAME_RE.match
+    results = []
+    for name in names:
+        m = match(name)
+        if m is None:
+            results.append(None)
+            continue
+        g = m.groups()
+        results.append(S1Name(g[0], g[1], g[2], g[3].strip("_"), g[4], g[5], g[6], _format_name_time(g[7]),
+                              _format_name_time(g[8]), int(g[9]), g[10], g[11]))
+    return results
+
+
+def parse_iso(time_str):
+    """
+    Parser for the fixed ISO8601 layout of SciHub/GRQ timestamps, falling
+    back to dateutil for anything else.
+    :param time_str: e.g. 2019-05-01T12:30:00.123Z
+    :return: naive datetime in UTC
+    """
+    m = ISO_RE.match(time_str)
+    if m is not None:
+        year, month, day, hour, minute, second, fraction = m.groups()
+        microsecond = int((fraction + "000000")[:6]) if fraction else 0
+        dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond)
+    else:
+        dt = dateutil.parser.parse(time_str)
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(tzutc()).replace(tzinfo=None)
+    return dt
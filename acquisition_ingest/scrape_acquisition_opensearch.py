@@ -13,7 +13,6 @@ from datetime import datetime, timedelta
 from tabulate import tabulate
 from requests.packages.urllib3.exceptions import (InsecureRequestWarning,
                                                   InsecurePlatformWarning)
-import dateutil.parser
 import ast
 import shapely.wkt
 from shapely.geometry import Polygon, MultiPolygon
@@ -23,6 +22,11 @@ import hysds.orchestrator
 from hysds.celery import app
 from hysds.dataset_ingest import ingest
 from osaka.main import get
+from rate_limiter import get_limiter
+from concurrency_governor import admit
+from hedged_requests import hedged_request, get_mirror_urls, get_tracker
+from deadline import DeadlineSession
+import s1_name
 
 # from notify_by_email import send_email
 
@@ -76,14 +80,15 @@ def get_accurate_times(filename_str, starttime_str, endtime_str):
     starttime -- starttime string from SciHub metadata
     endtime -- endtime string from SciHub metadata
     '''
-    match_pattern = "(?P<spacecraft>S1\w)_IW_SLC__(?P<misc>.*?)_(?P<s_year>\d{4})(?P<s_month>\d{2})(?P<s_day>\d{2})T(?P<s_hour>\d{2})(?P<s_minute>\d{2})(?P<s_seconds>\d{2})_(?P<e_year>\d{4})(?P<e_month>\d{2})(?P<e_day>\d{2})T(?P<e_hour>\d{2})(?P<e_minute>\d{2})(?P<e_seconds>\d{2})(?P<misc2>.*?)$"
-    m = re.match(match_pattern, filename_str)
-    metadata_st = dateutil.parser.parse(starttime_str).strftime('%Y-%m-%dT%H:%M:%S')
-    metadata_et = dateutil.parser.parse(endtime_str).strftime('%Y-%m-%dT%H:%M:%S')
-    file_st = "{}-{}-{}T{}:{}:{}".format(m.group("s_year"), m.group("s_month"), m.group("s_day"), m.group("s_hour"),
-                                         m.group("s_minute"), m.group("s_seconds"))
-    file_et = "{}-{}-{}T{}:{}:{}".format(m.group("e_year"), m.group("e_month"), m.group("e_day"), m.group("e_hour"),
-                                         m.group("e_minute"), m.group("e_seconds"))
+    name = s1_name.parse_name(filename_str)
+    if name is None:
+        raise RuntimeError("Failed to parse S1 product name: %s" % filename_str)
+    metadata_start = s1_name.parse_iso(starttime_str)
+    metadata_end = s1_name.parse_iso(endtime_str)
+    metadata_st = metadata_start.strftime('%Y-%m-%dT%H:%M:%S')
+    metadata_et = metadata_end.strftime('%Y-%m-%dT%H:%M:%S')
+    file_st = name.start
+    file_et = name.stop
 
     if metadata_st != file_st:
         logger.info("Start Timestamps Mismatch detected \n For {} \n Start time in File Name: {} \n Start time in meta"
@@ -92,14 +97,10 @@ def get_accurate_times(filename_str, starttime_str, endtime_str):
         logger.info("End Timestamps Mismatch detected \n For {} \n End time in File Name: {} \n End time in meta"
                     "data: {} \n".format(filename_str, file_et, metadata_et))
 
-    start_microseconds = dateutil.parser.parse(starttime_str).strftime('.%f').rstrip('0').ljust(4,
-                                                                                                '0') + 'Z'  # milliseconds + postfix from metadata
-    end_microseconds = dateutil.parser.parse(endtime_str).strftime('.%f').rstrip('0').ljust(4,
-                                                                                            '0') + 'Z'  # milliseconds + postfix from metadata
-    starttime = "{}-{}-{}T{}:{}:{}{}".format(m.group("s_year"), m.group("s_month"), m.group("s_day"), m.group("s_hour"),
-                                             m.group("s_minute"), m.group("s_seconds"), start_microseconds)
-    endtime = "{}-{}-{}T{}:{}:{}{}".format(m.group("e_year"), m.group("e_month"), m.group("e_day"), m.group("e_hour"),
-                                           m.group("e_minute"), m.group("e_seconds"), end_microseconds)
+    start_microseconds = metadata_start.strftime('.%f').rstrip('0').ljust(4, '0') + 'Z' # milliseconds + postfix from metadata
+    end_microseconds = metadata_end.strftime('.%f').rstrip('0').ljust(4, '0') + 'Z' # milliseconds + postfix from metadata
+    starttime = file_st + start_microseconds
+    endtime = file_et + end_microseconds
     return starttime, endtime
 
 
@@ -200,20 +201,25 @@ def get_dataset_json(met, version):
     }
 
 
+def prepare_acq_met(met):
+    """Add ingest-time fields to the met JSON. Return the dataset ID."""
+
+    # append source to met
+    met['query_api'] = "opensearch"
+    # set IPF version to None
+    met['processing_version'] = None
+    return "acquisition-{}-esa_scihub".format(met["title"])
+
+
 def create_acq_dataset(ds, met, root_ds_dir=".", browse=False):
     """Create acquisition dataset. Return tuple of (dataset ID, dataset dir)."""
 
     # create dataset dir
-    id = "acquisition-{}-esa_scihub".format(met["title"])
+    id = prepare_acq_met(met)
     root_ds_dir = os.path.abspath(root_ds_dir)
     ds_dir = os.path.join(root_ds_dir, id)
     if not os.path.isdir(ds_dir): os.makedirs(ds_dir, 0o755)
 
-    # append source to met
-    met['query_api'] = "opensearch"
-    # set IPF version to None
-    met['processing_version'] = None
-
     # dump dataset and met JSON
     ds_file = os.path.join(ds_dir, "%s.dataset.json" % id)
     met_file = os.path.join(ds_dir, "%s.met.json" % id)
@@ -260,7 +266,7 @@ def scrape(ds_es_url, ds_cfg, identifier, user=None, password=None,
     """Query ApiHub (OpenSearch) for S1 SLC scenes and generate acquisition datasets."""
 
     # get session
-    session = requests.session()
+    session = DeadlineSession()
     if None not in (user, password): session.auth = (user, password)
 
     # set query
@@ -275,7 +281,11 @@ def scrape(ds_es_url, ds_cfg, identifier, user=None, password=None,
 
     query_params = {"q": query, "rows": 1, "format": "json"}
     logger.info("query: %s" % json.dumps(query_params, indent=2))
-    response = session.get(url, params=query_params, verify=False)
+
+    def send(search_url):
+        return get_limiter("scihub").issue(session.get, search_url, params=query_params, verify=False)
+
+    response = hedged_request(send, get_mirror_urls(url), get_tracker("scihub-search"), admit=admit)
     logger.info("query_url: %s" % response.url)
     if response.status_code != 200:
         logger.error("Error: %s\n%s" % (response.status_code, response.text))
@@ -6,19 +6,38 @@ acquisition datasets.
 
 from builtins import str
 from builtins import map
-import os, time, re, requests, json, logging, traceback, argparse
-import shutil, tempfile, backoff
+import os, re, requests, json, logging, traceback, argparse
+import shutil, tempfile, backoff, threading
 from subprocess import check_call
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 from datetime import datetime, timedelta
 from tabulate import tabulate
 from requests.packages.urllib3.exceptions import (InsecureRequestWarning,
                                                   InsecurePlatformWarning)
-import dateutil.parser
 import ast
 import shapely.wkt
 from shapely.geometry import Polygon, MultiPolygon
 import geojson
 import scrape_acquisition_opensearch
+import s1_name
+import ingest_cursor
+import time_windows
+import footprints
+from acquisition_record import AcquisitionRecord
+from bulk_ingest import BulkIngester
+from ingest_pool import IngestPool, INGEST_TIMEOUT
+from aoi_index import AOIIndex
+import query_geometry
+import grq_scroll
+from rate_limiter import get_limiter
+from concurrency_governor import admit
+from hedged_requests import hedged_request, get_mirror_urls, get_tracker
+from deadline import DeadlineExceeded, UntilDeadline, get_deadline, get_session
 from hysds.celery import app
 from hysds.dataset_ingest import ingest
 from osaka.main import get
@@ -62,6 +81,11 @@ VALIDATE_QUERY_TEMPLATE = 'IW AND producttype:SLC AND platformname:Sentinel-1 AN
 
 AOI_BASED_QUERY_TEMPLATE = VALIDATE_QUERY_TEMPLATE
 
+PAGE_SIZE = 100
+
+# windows with more results than this are split into smaller sub-windows
+MAX_WINDOW_RESULTS = 2000
+
 
 # regexes
 PLATFORM_RE = re.compile(r'S1(.+?)_')
@@ -80,14 +104,15 @@ def get_accurate_times(filename_str, starttime_str, endtime_str):
     starttime_str -- starttime string from SciHub metadata
     endtime_str -- endtime string from SciHub metadata
     """
-    match_pattern = "(?P<spacecraft>S1\w)_IW_SLC__(?P<misc>.*?)_(?P<s_year>\d{4})(?P<s_month>\d{2})(?P<s_day>\d{2})T(?P<s_hour>\d{2})(?P<s_minute>\d{2})(?P<s_seconds>\d{2})_(?P<e_year>\d{4})(?P<e_month>\d{2})(?P<e_day>\d{2})T(?P<e_hour>\d{2})(?P<e_minute>\d{2})(?P<e_seconds>\d{2})(?P<misc2>.*?)$"
-    m = re.match(match_pattern, filename_str)
-    metadata_st = dateutil.parser.parse(starttime_str).strftime('%Y-%m-%dT%H:%M:%S')
-    metadata_et = dateutil.parser.parse(endtime_str).strftime('%Y-%m-%dT%H:%M:%S')
-    file_st = "{}-{}-{}T{}:{}:{}".format(m.group("s_year"), m.group("s_month"), m.group("s_day"), m.group("s_hour"),
-                                           m.group("s_minute"), m.group("s_seconds"))
-    file_et = "{}-{}-{}T{}:{}:{}".format(m.group("e_year"), m.group("e_month"), m.group("e_day"), m.group("e_hour"),
-                                         m.group("e_minute"), m.group("e_seconds"))
+    name = s1_name.parse_name(filename_str)
+    if name is None:
+        raise RuntimeError("Failed to parse S1 product name: %s" % filename_str)
+    metadata_start = s1_name.parse_iso(starttime_str)
+    metadata_end = s1_name.parse_iso(endtime_str)
+    metadata_st = metadata_start.strftime('%Y-%m-%dT%H:%M:%S')
+    metadata_et = metadata_end.strftime('%Y-%m-%dT%H:%M:%S')
+    file_st = name.start
+    file_et = name.stop
 
     if metadata_st != file_st:
         logger.info("Start Timestamps Mismatch detected \n For {} \n Start time in File Name: {} \n Start time in meta"
@@ -96,14 +121,14 @@ def get_accurate_times(filename_str, starttime_str, endtime_str):
         logger.info("End Timestamps Mismatch detected \n For {} \n End time in File Name: {} \n End time in meta"
                     "data: {} \n".format(filename_str, file_et, metadata_et))
 
-    start_microseconds = dateutil.parser.parse(starttime_str).strftime('.%f').rstrip('0').ljust(4, '0') + 'Z' # milliseconds + postfix from metadata
-    end_microseconds = dateutil.parser.parse(endtime_str).strftime('.%f').rstrip('0').ljust(4, '0') + 'Z' # milliseconds + postfix from metadata
-    starttime = "{}-{}-{}T{}:{}:{}{}".format(m.group("s_year"), m.group("s_month"), m.group("s_day"), m.group("s_hour"), m.group("s_minute"), m.group("s_seconds"), start_microseconds)
-    endtime = "{}-{}-{}T{}:{}:{}{}".format(m.group("e_year"), m.group("e_month"), m.group("e_day"), m.group("e_hour"), m.group("e_minute"), m.group("e_seconds"), end_microseconds)
+    start_microseconds = metadata_start.strftime('.%f').rstrip('0').ljust(4, '0') + 'Z' # milliseconds + postfix from metadata
+    end_microseconds = metadata_end.strftime('.%f').rstrip('0').ljust(4, '0') + 'Z' # milliseconds + postfix from metadata
+    starttime = file_st + start_microseconds
+    endtime = file_et + end_microseconds
     return starttime, endtime
 
 
-def list_status(starttime, endtime, prods_count, prods_missing, ids_by_track, ds_es_url):
+def list_status(starttime, endtime, prods_count, prods_missing, track_counts, ds_es_url):
     # print number of products missing
     msg = "Global data availability for %s through %s:\n" % (starttime, endtime)
     table_stats = [["total on apihub", prods_count],
@@ -113,7 +138,7 @@ def list_status(starttime, endtime, prods_count, prods_missing, ids_by_track, ds
 
     # print counts by track
     msg += "\n\nApiHub (OpenSearch) product count by track:\n"
-    msg += tabulate([(i, len(ids_by_track[i])) for i in ids_by_track], tablefmt="grid")
+    msg += tabulate([(i, track_counts[i]) for i in track_counts], tablefmt="grid")
 
     # print missing products
     msg += "\n\nMissing products:\n"
@@ -124,8 +149,12 @@ def list_status(starttime, endtime, prods_count, prods_missing, ids_by_track, ds
     logger.info(msg)
 
 
-def massage_result(res):
-    """Massage result JSON into HySDS met json."""
+def massage_result(res, footprint=True):
+    """
+    Massage result JSON into HySDS met json.
+    :param res: OpenSearch result entry, massaged in place
+    :param footprint: set location and bbox from the footprint, massage_results() does it for a whole page
+    """
 
     # set int fields
     for i in res['int']:
@@ -173,9 +202,10 @@ def massage_result(res):
     res["track_number"] = track_number
     del res['trackNumber']
     # extract footprint and save as bbox and geojson polygon
-    g = shapely.wkt.loads(res['footprint'])
-    res['location'] = geojson.Feature(geometry=g, properties={}).geometry
-    res['bbox'] = geojson.Feature(geometry=g.envelope, properties={}).geometry.coordinates[0]
+    if footprint:
+        g = shapely.wkt.loads(res['footprint'])
+        res['location'] = geojson.Feature(geometry=g, properties={}).geometry
+        res['bbox'] = geojson.Feature(geometry=g.envelope, properties={}).geometry.coordinates[0]
 
     # set platform
     match = PLATFORM_RE.search(res['title'])
@@ -193,6 +223,38 @@ def massage_result(res):
            logger.info("WARNING: Failed to verify S1B relative orbit number and track number. Orbit:{}, Track: {}".format(res.get('orbitNumber', ''), res.get('track_number', '')))
     
 
+def massage_results(entries):
+    """
+    Massage a page of result JSON into HySDS met json, processing the footprints in one batch.
+    :param entries: OpenSearch result entries, massaged in place
+    :return: parsed footprints of the entries
+    """
+    for res in entries:
+        massage_result(res, footprint=False)
+    geoms = footprints.parse_footprints([res['footprint'] for res in entries])
+    for res, location, bbox in zip(entries, footprints.get_locations(geoms), footprints.get_bboxes(geoms)):
+        res['location'] = location
+        res['bbox'] = bbox
+    return geoms
+
+
+def filter_aoi(entries, geoms, aoi):
+    """
+    Drop massaged entries whose footprint doesn't intersect the AOI, for
+    results of a query with a coarse AOI geometry.
+    :param entries: massaged entries
+    :param geoms: parsed footprints of the entries
+    :param aoi: AOIIndex of the exact AOI, None to keep all entries
+    :return: list of entries in the AOI
+    """
+    if aoi is None:
+        return entries
+    kept = [met for met, match in zip(entries, aoi.match(geoms)) if match]
+    if len(kept) < len(entries):
+        logger.info("Dropped {} results outside the AOI".format(len(entries) - len(kept)))
+    return kept
+
+
 def get_dataset_json(met, version):
     """Generated HySDS dataset JSON from met JSON."""
 
@@ -295,41 +357,18 @@ def get_existing_acqs(start_time, end_time, location=False):
         }
         query["query"]["filtered"]["filter"] = geo_shape
 
-    acq_ids = set()
-    rest_url = app.conf["GRQ_ES_URL"][:-1] if app.conf["GRQ_ES_URL"].endswith('/') else app.conf["GRQ_ES_URL"]
-    es_url = "{}/{}/_search?search_type=scan&scroll=60&size=10000".format(rest_url, index)
-    r = requests.post(es_url, data=json.dumps(query))
-
-    if r.status_code == 404:
+    try:
+        return set(hit["_source"]["metadata"]["id"] for hit in
+                   grq_scroll.scroll(app.conf["GRQ_ES_URL"], index, query, source=["metadata.id"]))
+    except requests.exceptions.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
         logger.error("%s index does not exist, creating index" % index)
-        create_acq_index_url = "%s/%s" % (rest_url, index)
-        requests.put(create_acq_index_url)
+        create_acq_index_url = "%s/%s" % (app.conf["GRQ_ES_URL"].rstrip('/'), index)
+        grq_scroll.grq_session.put(create_acq_index_url)
         logger.info("created index: %s" % index)
         return set()
 
-    r.raise_for_status()
-    scan_result = r.json()
-    count = scan_result['hits']['total']
-    if count == 0:
-        return set()
-    if '_scroll_id' not in scan_result:
-        print("_scroll_id not found in scan_result. Returning empty array for the query :\n%s" % query)
-        return set()
-    scroll_id = scan_result['_scroll_id']
-    hits = []
-    while True:
-        r = requests.post('%s/_search/scroll?scroll=60m' % rest_url, data=scroll_id)
-        res = r.json()
-        scroll_id = res['_scroll_id']
-        if len(res['hits']['hits']) == 0:
-            break
-        hits.extend(res['hits']['hits'])
-
-    for item in hits:
-        acq_ids.add(item.get("_source").get("metadata").get("id"))
-
-    return acq_ids
-
 
 def create_report(starttime, endtime, polygon, still_missing, aoi_name=None, version="v0.1"):
     """
@@ -369,108 +408,491 @@ def create_report(starttime, endtime, polygon, still_missing, aoi_name=None, ver
         json.dump(met, f, indent=2, sort_keys=True)
 
 
-def scrape(ds_es_url, ds_cfg, starttime, endtime, polygon=False, user=None, password=None,
-           version="v2.0", ingest_missing=False, create_only=False, browse=False, purpose="scrape", report=False):
-    """Query ApiHub (OpenSearch) for S1 SLC scenes and generate acquisition datasets."""
-
-    # get session
-    session = requests.session()
-    if None not in (user, password): session.auth = (user, password)
+def query_page(session, query, offset, rows=PAGE_SIZE, orderby=None):
+    """
+    Fetch a single OpenSearch result page.
+    :param session: requests session
+    :param query: OpenSearch query string
+    :param offset: start offset of the page
+    :param rows: page size
+    :param orderby: optional sort order, e.g. "ingestiondate asc"
+    :return: tuple of (total results reported by OpenSearch, list of entries)
+    """
+    query_params = {"q": query, "rows": rows, "format": "json", "start": offset}
+    if orderby is not None:
+        query_params["orderby"] = orderby
+    logger.info("query: %s" % json.dumps(query_params, indent=2))
+
+    def send(search_url):
+        return get_limiter("scihub").issue(session.get, search_url, params=query_params, verify=False)
+
+    response = hedged_request(send, get_mirror_urls(url), get_tracker("scihub-search"), admit=admit)
+    logger.info("query_url: %s" % response.url)
+    if response.status_code != 200:
+        logger.error("Error: %s\n%s" % (response.status_code, response.text))
+    response.raise_for_status()
+    results = response.json()
+    total_results = int(results['feed']['opensearch:totalResults'])
+    entries = results['feed'].get('entry', None)
+    if entries is None:
+        return total_results, []
+    if isinstance(entries, dict): entries = [entries]  # if one entry, scihub doesn't return a list
+    return total_results, entries
+
+
+def count_results(session, query):
+    """
+    Cheap count probe for a query, requesting no entries.
+    :param session: requests session
+    :param query: OpenSearch query string
+    :return: total number of results
+    """
+    total_results, entries = query_page(session, query, 0, rows=0)
+    return total_results
 
-    ctx = json.loads(open("_context.json", "r").read())
 
-    # set query
+def get_query(purpose, starttime, endtime, polygon=False):
+    """
+    Build the OpenSearch query string of a time window.
+    :param purpose: scrape, validate or aoi_scrape
+    :param starttime: window start in ISO8601 format
+    :param endtime: window end in ISO8601 format
+    :param polygon: optional geojson polygon constraint
+    :return: OpenSearch query string
+    """
     if purpose == "scrape":
         query = QUERY_TEMPLATE.format(starttime, endtime)
     elif purpose == "validate":
         query = VALIDATE_QUERY_TEMPLATE.format(starttime, endtime)
     elif purpose == "aoi_scrape":
         query = AOI_BASED_QUERY_TEMPLATE.format(starttime, endtime)
+    else:
+        raise RuntimeError("Unrecognized purpose: %s" % purpose)
 
     if polygon:
         query += ' ( footprint:"Intersects({})")'.format(convert_to_wkt(polygon))
-        existing_acqs = get_existing_acqs(start_time=starttime, end_time=endtime, location=json.loads(polygon))
+    return query
+
+
+def get_pages(session, query, page_workers=1, orderby=None):
+    """
+    Generator over the OpenSearch result pages of a query, in offset order.
+    With page_workers > 1, the total result count is read from the first page
+    and the remaining pages are fetched concurrently over the shared session.
+    Request pacing is left to the shared SciHub rate limiter.
+    :param session: requests session
+    :param query: OpenSearch query string
+    :param page_workers: number of concurrent page requests
+    :param orderby: optional sort order, e.g. "ingestiondate asc"
+    :return: yields the list of entries of each page
+    """
+    total_results, entries = query_page(session, query, 0, orderby=orderby)
+    logger.info("Total results expected: %s" % total_results)
+
+    if page_workers <= 1:
+        offset = 0
+        while len(entries) > 0:
+            yield entries
+            offset += len(entries)
+            total_results, entries = query_page(session, query, offset, orderby=orderby)
+        return
+
+    if len(entries) == 0:
+        return
+    yield entries
+    offsets = list(range(len(entries), total_results, PAGE_SIZE))
+    logger.info("Fetching {} remaining pages with {} workers".format(len(offsets), page_workers))
+    pool = ThreadPoolExecutor(max_workers=page_workers)
+    # keep a bounded window of requests in flight, so at most that many pages are buffered
+    window = 2 * page_workers
+    pending = deque()
+    try:
+        for offset in offsets:
+            pending.append(pool.submit(query_page, session, query, offset, orderby=orderby))
+            if len(pending) < window:
+                continue
+            # pages are handed on in submission order, i.e. by offset
+            total_results, entries = pending.popleft().result()
+            if len(entries) == 0:
+                return
+            yield entries
+        while pending:
+            total_results, entries = pending.popleft().result()
+            if len(entries) == 0:
+                return
+            yield entries
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def get_window_pages(session, queries, page_workers=1, window_workers=1, orderby=None):
+    """
+    Generator over the result pages of a list of sub-window queries, in window order.
+    With window_workers > 1 the sub-windows are fetched concurrently, each one
+    collected in full before its pages are handed on.
+    :param session: requests session
+    :param queries: OpenSearch query strings, one per sub-window
+    :param page_workers: number of concurrent page requests per sub-window
+    :param window_workers: number of sub-windows fetched concurrently
+    :param orderby: optional sort order, e.g. "ingestiondate asc"
+    :return: yields the list of entries of each page
+    """
+    if window_workers <= 1 or len(queries) == 1:
+        for query in queries:
+            for entries in get_pages(session, query, page_workers, orderby):
+                yield entries
+        return
+
+    pool = ThreadPoolExecutor(max_workers=window_workers)
+    try:
+        for pages in pool.map(lambda query: list(get_pages(session, query, page_workers, orderby)), queries):
+            for entries in pages:
+                yield entries
+    finally:
+        pool.shutdown(wait=False)
+
+
+def prefetch(iterable, size=2):
+    """
+    Run an iterable in a background thread, buffering at most size items in a
+    bounded queue, so the producer works ahead while the consumer is busy.
+    :param iterable: e.g. a page generator
+    :param size: queue size
+    :return: yields the items of iterable
+    """
+    done = object()
+    items = Queue(maxsize=size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=1)
+                        break
+                    except Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def record_failed_ingest(met, still_missing, failed_ingestion_dates):
+    """Add an acquisition that failed to ingest to the still missing list."""
+    slc_id = met['data_product_name']
+    logger.info("Adding {} to still missing list".format(slc_id))
+    still_missing.append(slc_id)
+    failed_ingestion_dates.append(met.get('ingestiondate'))
+    logger.info("Failed to create and ingest %s\n" % met['id'])
+
+
+def record_ingest(met, ok, still_missing, failed_ingestion_dates):
+    """Log the result of an ingest, adding it to the still missing list if it failed."""
+    if ok:
+        logger.info("Created and ingested %s\n" % met['id'])
     else:
-        existing_acqs = get_existing_acqs(start_time=starttime, end_time=endtime)
-    
-    # query
-    prods_all = {}
-    offset = 0
-    loop = True
-    total_results_expected = None
-    ids_by_track = {}
+        record_failed_ingest(met, still_missing, failed_ingestion_dates)
+
+
+def ingest_one(ds, met, ds_cfg, bulk, pool, still_missing, failed_ingestion_dates):
+    """
+    Ingest a missing acquisition: queue it on the BulkIngester or IngestPool,
+    or ingest it right away if there is neither, recording the ingests that
+    failed on the still missing list.
+    """
+    if bulk is not None:
+        for failed in bulk.add(ds, met):
+            record_failed_ingest(failed, still_missing, failed_ingestion_dates)
+    elif pool is not None:
+        for done, ok in pool.submit(met, scrape_acquisition_opensearch.ingest_acq_dataset, ds, met, ds_cfg):
+            record_ingest(done, ok, still_missing, failed_ingestion_dates)
+    else:
+        record_ingest(met, scrape_acquisition_opensearch.ingest_acq_dataset(ds, met, ds_cfg),
+                      still_missing, failed_ingestion_dates)
+
+
+def drain(bulk, pool, still_missing, failed_ingestion_dates):
+    """Finish the ingests still queued on the BulkIngester or IngestPool, recording those that failed."""
+    if bulk is not None:
+        for failed in bulk.flush():
+            record_failed_ingest(failed, still_missing, failed_ingestion_dates)
+    if pool is not None:
+        for done, ok in pool.close():
+            record_ingest(done, ok, still_missing, failed_ingestion_dates)
+
+
+def stream_scrape(pages, existing_acqs, version, ds_cfg, ingest_missing=False, create_only=False, browse=False,
+                  bulk=None, pool=None, aoi=None):
+    """
+    Streaming counterpart of the scrape() loop: every entry goes through
+    massage, existence check and ingest (or create) as soon as its page
+    arrives, and only ids and counters are kept. Missing acquisitions that
+    come after the job deadline are recorded as failed instead of ingested.
+    :param pages: iterable of OpenSearch entry lists
+    :param existing_acqs: set of acquisition ids already in GRQ
+    :param version: dataset version
+    :param ds_cfg: HySDS datasets.json file
+    :param ingest_missing: create and ingest missing datasets
+    :param create_only: only create missing datasets
+    :param browse: create browse images
+    :param bulk: BulkIngester to ingest with, None to ingest one acquisition at a time
+    :param pool: IngestPool to run ingests on, None to run them serially
+    :param aoi: AOIIndex of the exact AOI to keep results of, None to keep all
+    :return: tuple of (product count, missing ids, product count by track, still missing dataset names,
+                       [latest ingestion date], ingestion dates that failed)
+    """
+    seen = set()
+    count = 0
+    track_counts = {}
     prods_missing = []
-    prods_found = []
-    while loop:
-        query_params = {"q": query, "rows": 100, "format": "json", "start": offset }
-        logger.info("query: %s" % json.dumps(query_params, indent=2))
-        response = session.get(url, params=query_params, verify=False)
-        logger.info("query_url: %s" % response.url)
-        if response.status_code != 200:
-            logger.error("Error: %s\n%s" % (response.status_code,response.text))
-        response.raise_for_status()
-        results = response.json()
-        if total_results_expected is None:
-            total_results_expected = int(results['feed']['opensearch:totalResults'])
-        entries = results['feed'].get('entry', None)
-        if entries is None: break
-        with open('res.json', 'w') as f:
-            f.write(json.dumps(entries, indent=2))
-        if isinstance(entries, dict): entries = [ entries ] # if one entry, scihub doesn't return a list
-        count = len(entries)
-        offset += count
-        loop = True if count > 0 else False
-        logger.info("Found: {0} results".format(count))
+    still_missing = []
+    failed_ingestion_dates = []
+    latest_ingestion = None
+    deadline = get_deadline()
+    stopped = False
+    for entries in pages:
+        logger.info("Found: {0} results".format(len(entries)))
+        # pages and sub-window boundaries can overlap
+        new_entries = []
         for met in entries:
-            try: massage_result(met) 
-            except Exception as e:
-                logger.error("Failed to massage result: %s" % json.dumps(met, indent=2, sort_keys=True))
-                logger.error("Extracted entries: %s" % json.dumps(entries, indent=2, sort_keys=True))
-                raise
-            # logger.info(json.dumps(met, indent=2, sort_keys=True))
-            ds = get_dataset_json(met, version)
-            # logger.info(json.dumps(ds, indent=2, sort_keys=True))
-            prods_all[met['id']] = {
-                'met': met,
-                'ds': ds,
-            }
+            if met['id'] in seen:
+                logger.info("Skipping duplicate result: %s" % met['id'])
+                continue
+            seen.add(met['id'])
+            new_entries.append(met)
+        try: geoms = massage_results(new_entries)
+        except Exception as e:
+            logger.error("Failed to massage results: %s" % json.dumps(new_entries, indent=2, sort_keys=True))
+            raise
+        new_entries = filter_aoi(new_entries, geoms, aoi)
+        count += len(new_entries)
+        for met in new_entries:
+            track_counts[met['track_number']] = track_counts.get(met['track_number'], 0) + 1
+            if latest_ingestion is None or \
+                    s1_name.parse_iso(met['ingestiondate']) > s1_name.parse_iso(latest_ingestion):
+                latest_ingestion = met['ingestiondate']
 
             # check if exists
-            if met["id"] not in existing_acqs:
-                prods_missing.append(met["id"])
-            else:
-                prods_found.append(met["id"])
+            if met["id"] in existing_acqs:
+                continue
+            acq_id = met["id"]
+            prods_missing.append(acq_id)
+            ds = get_dataset_json(met, version)
+            if ingest_missing and not create_only:
+                if deadline.expired():
+                    # left as failed, so that the cursor stays before them
+                    if not stopped:
+                        logger.warning("Job time budget exhausted, leaving the rest of the page for the next run")
+                        stopped = True
+                    record_failed_ingest(met, still_missing, failed_ingestion_dates)
+                else:
+                    ingest_one(ds, met, ds_cfg, bulk, pool, still_missing, failed_ingestion_dates)
+            elif create_only:
+                id, ds_dir = create_acq_dataset(ds, met, browse=browse)
+                logger.info("Created %s\n" % acq_id)
+
+    drain(bulk, pool, still_missing, failed_ingestion_dates)
+
+    ingestion_dates = [latest_ingestion] if latest_ingestion is not None else []
+    return count, prods_missing, track_counts, still_missing, ingestion_dates, failed_ingestion_dates
+
+
+def get_ingesters(ds_es_url, ds_cfg, ingest_missing, bulk_size, ingest_workers, ingest_timeout):
+    """
+    BulkIngester and IngestPool for the ingest options, either or both None
+    for one ingest at a time.
+    """
+    # index missing acquisitions into GRQ in batches instead of one at a time
+    bulk = None
+    if bulk_size and ingest_missing:
+        bulk = BulkIngester(ds_es_url, ds_cfg, bulk_size)
 
-            ids_by_track.setdefault(met['track_number'], []).append(met['id'])
+    # otherwise run several dataset ingests at a time
+    pool = None
+    if bulk is None and ingest_workers > 1 and ingest_missing:
+        pool = IngestPool(ingest_workers, ingest_timeout)
+    return bulk, pool
 
-        # don't clobber the connection
-        time.sleep(3)
 
-    list_status(starttime, endtime, len(prods_all), prods_missing, ids_by_track, ds_es_url)
+def ingest_records(records, version, ds_cfg, bulk=None, pool=None):
+    """
+    Create and ingest the datasets of scraped acquisitions.
+    :param records: AcquisitionRecords to ingest
+    :param version: dataset version
+    :param ds_cfg: HySDS datasets.json file
+    :param bulk: BulkIngester to ingest with, None to ingest one acquisition at a time
+    :param pool: IngestPool to run ingests on, None to run them serially
+    :return: tuple of (still missing dataset names, ingestion dates that failed)
+    """
+    still_missing = []
+    failed_ingestion_dates = []
+    deadline = get_deadline()
+    for i, record in enumerate(records):
+        if deadline.expired():
+            # left as failed, so that the cursor stays before them
+            logger.warning("Job time budget exhausted, leaving {} acquisitions for the next run".format(
+                len(records) - i))
+            for record in records[i:]:
+                record_failed_ingest(record.to_met(), still_missing, failed_ingestion_dates)
+            break
+        met = record.to_met()
+        ds = record.to_dataset(version, met['location'])
+        ingest_one(ds, met, ds_cfg, bulk, pool, still_missing, failed_ingestion_dates)
+    drain(bulk, pool, still_missing, failed_ingestion_dates)
+    return still_missing, failed_ingestion_dates
+
+
+def create_records(records, version, browse=False):
+    """Create the datasets of scraped acquisitions without ingesting them."""
+    for record in records:
+        met = record.to_met()
+        id, ds_dir = create_acq_dataset(record.to_dataset(version, met['location']), met, browse=browse)
+        logger.info("Created %s\n" % record.id)
+
+
+def scrape(ds_es_url, ds_cfg, starttime, endtime, polygon=False, user=None, password=None,
+           version="v2.0", ingest_missing=False, create_only=False, browse=False, purpose="scrape", report=False,
+           page_workers=1, cursor=None, max_window_results=MAX_WINDOW_RESULTS, window_workers=1, stream=False,
+           prefetch_pages=2, bulk_size=0, ingest_workers=1, ingest_timeout=INGEST_TIMEOUT,
+           query_geometry_mode=query_geometry.DEFAULT_MODE, query_tolerance=query_geometry.DEFAULT_TOLERANCE):
+    """Query ApiHub (OpenSearch) for S1 SLC scenes and generate acquisition datasets."""
 
     # error check options
     if ingest_missing and create_only:
         raise RuntimeError("Cannot specify ingest_missing=True and create_only=True.")
 
-    # create and ingest missing datasets for ingest
-    still_missing = []
-    if ingest_missing and not create_only:
-        for acq_id in prods_missing:
-            info = prods_all[acq_id]
-            if scrape_acquisition_opensearch.ingest_acq_dataset(info['ds'], info['met'], ds_cfg):
-                logger.info("Created and ingested %s\n" % acq_id)
-            else:
-                slc_id = info['met']['data_product_name']
-                logger.info("Adding {} to still missing list".format(slc_id))
-                still_missing.append(slc_id)
-                logger.info("Failed to create and ingest %s\n" % acq_id)
-
-    # just create missing datasets
-    if not ingest_missing and create_only:
-        for acq_id in prods_missing:
-            info = prods_all[acq_id]
-            id, ds_dir = create_acq_dataset(info['ds'], info['met'], browse=browse)
-            logger.info("Created %s\n" % acq_id)
+    # get session
+    session = get_session(page_workers * window_workers)
+    if None not in (user, password): session.auth = (user, password)
+
+    ctx = json.loads(open("_context.json", "r").read())
+
+    # incremental keep-up: resume from the last fully processed ingestion date
+    cursor = cursor or ctx.get("cursor") or None
+    orderby = None
+    if cursor:
+        if purpose != "scrape":
+            raise RuntimeError("An ingestion date cursor can only be used with purpose=scrape.")
+        cursor_value, cursor_version = ingest_cursor.get_cursor(cursor)
+        if cursor_value is not None:
+            starttime = ingest_cursor.get_query_start(cursor_value)
+            logger.info("Resuming from cursor {} at {}, querying from {}".format(cursor, cursor_value, starttime))
+        orderby = "ingestiondate asc"
+
+    # query SciHub and GRQ with a coarse AOI geometry and keep the results in the exact AOI
+    aoi = None
+    query_polygon = polygon
+    if polygon:
+        aoi_geom = convert_geojson(polygon)
+        aoi = AOIIndex([ctx.get("aoi_name")], [aoi_geom])
+        if query_geometry_mode != "exact":
+            query_polygon = json.dumps(query_geometry.get_query_geometry(
+                aoi_geom, query_geometry_mode, query_tolerance, aoi_id=ctx.get("aoi_name")))
+
+    # split dense windows so that no query pages deep into its result set
+    if max_window_results:
+        windows = time_windows.split_window(
+            starttime, endtime, lambda st, et: count_results(session, get_query(purpose, st, et, query_polygon)),
+            max_window_results)
+    else:
+        windows = [[starttime, endtime]]
+    queries = [get_query(purpose, st, et, query_polygon) for st, et in windows]
+
+    if polygon:
+        existing_acqs = get_existing_acqs(start_time=starttime, end_time=endtime,
+                                          location=json.loads(query_polygon))
+    else:
+        existing_acqs = get_existing_acqs(start_time=starttime, end_time=endtime)
+    
+    bulk, pool = get_ingesters(ds_es_url, ds_cfg, ingest_missing, bulk_size, ingest_workers, ingest_timeout)
+
+    # stop fetching pages at the job deadline, keeping what was scraped so far
+    pages = get_window_pages(session, queries, page_workers, window_workers, orderby)
+    if stream:
+        pages = UntilDeadline(prefetch(pages, prefetch_pages), "result pages")
+        prods_count, prods_missing, track_counts, still_missing, ingestion_dates, failed_ingestion_dates = \
+            stream_scrape(pages, existing_acqs, version, ds_cfg, ingest_missing,
+                          create_only, browse, bulk, pool, aoi)
+        list_status(starttime, endtime, prods_count, prods_missing, track_counts, ds_es_url)
+    else:
+        pages = UntilDeadline(pages, "result pages")
+        # query
+        prods_all = {}
+        ids_by_track = {}
+        prods_missing = []
+        prods_found = []
+        for entries in pages:
+            with open('res.json', 'w') as f:
+                f.write(json.dumps(entries, indent=2))
+            logger.info("Found: {0} results".format(len(entries)))
+            # pages and sub-window boundaries can overlap
+            new_entries = []
+            new_ids = set()
+            for met in entries:
+                if met['id'] in prods_all or met['id'] in new_ids:
+                    logger.info("Skipping duplicate result: %s" % met['id'])
+                    continue
+                new_ids.add(met['id'])
+                new_entries.append(met)
+            try: geoms = massage_results(new_entries)
+            except Exception as e:
+                logger.error("Failed to massage results: %s" % json.dumps(new_entries, indent=2, sort_keys=True))
+                logger.error("Extracted entries: %s" % json.dumps(entries, indent=2, sort_keys=True))
+                raise
+            new_entries = filter_aoi(new_entries, geoms, aoi)
+            for met in new_entries:
+                # logger.info(json.dumps(met, indent=2, sort_keys=True))
+                # keep a compact record, the met and dataset JSON are rebuilt at ingest time
+                prods_all[met['id']] = AcquisitionRecord.from_met(met)
+
+                # check if exists
+                if met["id"] not in existing_acqs:
+                    prods_missing.append(met["id"])
+                else:
+                    prods_found.append(met["id"])
+
+                ids_by_track.setdefault(met['track_number'], []).append(met['id'])
+
+        track_counts = dict((track, len(ids)) for track, ids in ids_by_track.items())
+        list_status(starttime, endtime, len(prods_all), prods_missing, track_counts, ds_es_url)
+
+        # create and ingest missing datasets for ingest
+        still_missing = []
+        failed_ingestion_dates = []
+        if ingest_missing and not create_only:
+            still_missing, failed_ingestion_dates = ingest_records(
+                [prods_all[acq_id] for acq_id in prods_missing], version, ds_cfg, bulk, pool)
+
+        # just create missing datasets
+        if not ingest_missing and create_only:
+            create_records([prods_all[acq_id] for acq_id in prods_missing], version, browse)
+
+        ingestion_dates = [record.ingestion_date for record in prods_all.values()]
+
+    # advance the cursor to the newest ingestion date that was fully processed
+    if cursor and ingest_missing:
+        high_water_mark = ingest_cursor.get_high_water_mark(ingestion_dates, failed_ingestion_dates)
+        if high_water_mark is not None:
+            ingest_cursor.advance_cursor(cursor, high_water_mark, cursor_version)
 
     if report:
         if ctx.get("aoi_name", None) is not None:
@@ -480,6 +902,126 @@ def scrape(ds_es_url, ds_cfg, starttime, endtime, polygon=False, user=None, pass
               polygon = str(polygon)
             create_report(starttime, endtime, polygon, still_missing)
 
+    if pages.stopped:
+        if cursor and ingest_missing:
+            logger.info("Stopped at the job deadline, the next run resumes from cursor {}".format(cursor))
+        else:
+            raise DeadlineExceeded("Job time budget exhausted before {} to {} was fully scraped".format(
+                starttime, endtime))
+
+
+def get_aoi_times(aoi, starttime, endtime):
+    """
+    Time range of an AOI within that of a scrape.
+    :param aoi: {"aoi_name": ..., "location": ...} dict with optional starttime and endtime
+    :param starttime: scrape start in ISO8601 format
+    :param endtime: scrape end in ISO8601 format
+    :return: start and end time of the AOI in ISO8601 format
+    """
+    if aoi.get("starttime") and s1_name.parse_iso(aoi["starttime"]) > s1_name.parse_iso(starttime):
+        starttime = aoi["starttime"]
+    if aoi.get("endtime") and s1_name.parse_iso(aoi["endtime"]) < s1_name.parse_iso(endtime):
+        endtime = aoi["endtime"]
+    return starttime, endtime
+
+
+def scrape_aois(ds_es_url, ds_cfg, starttime, endtime, aois, user=None, password=None, version="v2.0",
+                ingest_missing=False, create_only=False, browse=False, report=False, page_workers=1,
+                max_window_results=MAX_WINDOW_RESULTS, window_workers=1, bulk_size=0, ingest_workers=1,
+                ingest_timeout=INGEST_TIMEOUT):
+    """
+    Scrape several AOIs at once: query ApiHub (OpenSearch) and GRQ once per time
+    window over the bounding box of all AOIs and assign the results to the AOIs
+    locally, so that acquisitions shared by overlapping AOIs are fetched once.
+    An AOI with its own starttime and endtime only gets the acquisitions whose
+    sensing start lies within them.
+    :param aois: list of {"aoi_name": name, "location": geojson polygon} dicts,
+                 optionally with "starttime" and "endtime"
+    """
+
+    # error check options
+    if ingest_missing and create_only:
+        raise RuntimeError("Cannot specify ingest_missing=True and create_only=True.")
+
+    session = get_session(page_workers * window_workers)
+    if None not in (user, password): session.auth = (user, password)
+
+    names = [aoi["aoi_name"] for aoi in aois]
+    polygons = [json.dumps(aoi["location"]) for aoi in aois]
+    times = dict((aoi["aoi_name"], get_aoi_times(aoi, starttime, endtime)) for aoi in aois)
+    time_ranges = dict((aoi["aoi_name"], (s1_name.parse_iso(aoi["starttime"]), s1_name.parse_iso(aoi["endtime"])))
+                       for aoi in aois if aoi.get("starttime") and aoi.get("endtime"))
+    index = AOIIndex(names, [convert_geojson(polygon) for polygon in polygons])
+    region = json.dumps(index.get_region())
+    logger.info("Scraping {} AOIs over {}".format(len(aois), region))
+
+    # split dense windows so that no query pages deep into its result set
+    if max_window_results:
+        windows = time_windows.split_window(
+            starttime, endtime, lambda st, et: count_results(session, get_query("aoi_scrape", st, et, region)),
+            max_window_results)
+    else:
+        windows = [[starttime, endtime]]
+    queries = [get_query("aoi_scrape", st, et, region) for st, et in windows]
+
+    existing_acqs = get_existing_acqs(start_time=starttime, end_time=endtime, location=json.loads(region))
+
+    prods_all = {}
+    ids_by_aoi = dict((name, []) for name in names)
+    pages = UntilDeadline(get_window_pages(session, queries, page_workers, window_workers, None), "result pages")
+    for entries in pages:
+        logger.info("Found: {0} results".format(len(entries)))
+        # pages and sub-window boundaries can overlap
+        new_entries = []
+        new_ids = set()
+        for met in entries:
+            if met['id'] in prods_all or met['id'] in new_ids:
+                continue
+            new_ids.add(met['id'])
+            new_entries.append(met)
+        matches = index.match(massage_results(new_entries))
+        for met, aoi_names in zip(new_entries, matches):
+            sensing_start = s1_name.parse_iso(met['sensingStart'])
+            aoi_names = [name for name in aoi_names if name not in time_ranges or
+                         time_ranges[name][0] <= sensing_start <= time_ranges[name][1]]
+            # in the bounding box but outside every AOI, or outside their time ranges
+            if not aoi_names:
+                continue
+            prods_all[met['id']] = AcquisitionRecord.from_met(met)
+            for name in aoi_names:
+                ids_by_aoi[name].append(met['id'])
+
+    prods_missing = [acq_id for acq_id in prods_all if acq_id not in existing_acqs]
+    for name in names:
+        ids = ids_by_aoi[name]
+        track_counts = {}
+        for acq_id in ids:
+            track = prods_all[acq_id].track_number
+            track_counts[track] = track_counts.get(track, 0) + 1
+        logger.info("AOI {}:".format(name))
+        list_status(times[name][0], times[name][1], len(ids), [acq_id for acq_id in ids if acq_id not in existing_acqs],
+                    track_counts, ds_es_url)
+
+    # each acquisition is ingested once, however many AOIs it falls in
+    still_missing = []
+    if ingest_missing and not create_only:
+        bulk, pool = get_ingesters(ds_es_url, ds_cfg, ingest_missing, bulk_size, ingest_workers, ingest_timeout)
+        still_missing, failed_ingestion_dates = ingest_records(
+            [prods_all[acq_id] for acq_id in prods_missing], version, ds_cfg, bulk, pool)
+    if not ingest_missing and create_only:
+        create_records([prods_all[acq_id] for acq_id in prods_missing], version, browse)
+
+    if report:
+        still_missing = set(still_missing)
+        for name, polygon in zip(names, polygons):
+            aoi_missing = [prods_all[acq_id].data_product_name for acq_id in ids_by_aoi[name]
+                           if prods_all[acq_id].data_product_name in still_missing]
+            create_report(times[name][0], times[name][1], polygon, aoi_missing, aoi_name=name)
+
+    if pages.stopped:
+        raise DeadlineExceeded("Job time budget exhausted before {} to {} was fully scraped".format(
+            starttime, endtime))
+
 
 def convert_geojson(input_geojson):
     '''Attempts to convert the input geojson into a polygon object. Returns the object.'''
@@ -521,6 +1063,14 @@ if __name__ == "__main__":
     parser.add_argument("endtime", help="End time in ISO8601 format", nargs='?',
                         default="%sZ" % datetime.utcnow().isoformat())
     parser.add_argument("--polygon", help="Geojson polygon constraint", default=False, required=False)
+    parser.add_argument("--query_geometry", help="geometry of --polygon to query SciHub and GRQ with, results " +
+                        "are then intersected with the exact polygon", choices=query_geometry.MODES,
+                        default=query_geometry.DEFAULT_MODE, required=False)
+    parser.add_argument("--query_tolerance", help="simplification tolerance in degrees for --query_geometry " +
+                        "simplify", type=float, default=query_geometry.DEFAULT_TOLERANCE, required=False)
+    parser.add_argument("--aois", help="JSON list of {\"aoi_name\": ..., \"location\": ...} AOIs to scrape " +
+                        "together with one query over their bounding box, each optionally with its own " +
+                        "\"starttime\" and \"endtime\"", default=None, required=False)
     parser.add_argument("--dataset_version", help="dataset version",
                         default="v2.0", required=False)
     parser.add_argument("--user", help="SciHub user", default=None, required=False)
@@ -533,13 +1083,41 @@ if __name__ == "__main__":
                        action='store_true')
     parser.add_argument("--purpose", help="scrape or validate or aoi_scrape", default="scrape", required=False)
     parser.add_argument("--report", help="create a report", default=False, action='store_true', required=False)
+    parser.add_argument("--page_workers", help="number of OpenSearch pages to fetch concurrently",
+                        type=int, default=1, required=False)
+    parser.add_argument("--cursor", help="name of the ingestion date cursor to resume from and advance",
+                        default=None, required=False)
+    parser.add_argument("--max_window_results", help="split the time window into sub-windows of at most " +
+                        "this many results, 0 disables splitting", type=int, default=MAX_WINDOW_RESULTS,
+                        required=False)
+    parser.add_argument("--window_workers", help="number of sub-windows to fetch concurrently",
+                        type=int, default=1, required=False)
+    parser.add_argument("--stream", help="ingest each page as it arrives instead of after the whole window",
+                        action='store_true')
+    parser.add_argument("--prefetch_pages", help="number of pages to download ahead of ingest in --stream mode",
+                        type=int, default=2, required=False)
+    parser.add_argument("--bulk_size", help="with --ingest, index missing acquisitions into GRQ in batches " +
+                        "of this size without publishing dataset directories, 0 ingests them one at a time", type=int, default=0, required=False)
+    parser.add_argument("--ingest_workers", help="with --ingest, number of dataset ingests to run concurrently",
+                        type=int, default=1, required=False)
+    parser.add_argument("--ingest_timeout", help="seconds from queueing within which a dataset ingest has to " +
+                        "finish, else it is reported as still missing", type=int, default=INGEST_TIMEOUT, required=False)
     args = parser.parse_args()
     try:
         ds_es_url = app.conf["GRQ_ES_URL"] + "/grq_{}_acquisition-s1-iw_slc/acquisition-S1-IW_SLC".format(
             args.dataset_version)
-        scrape(ds_es_url, args.datasets_cfg, args.starttime, args.endtime,
-               args.polygon, args.user, args.password, args.dataset_version,
-               args.ingest, args.create_only, args.browse, args.purpose, args.report)
+        if args.aois:
+            scrape_aois(ds_es_url, args.datasets_cfg, args.starttime, args.endtime, json.loads(args.aois),
+                        args.user, args.password, args.dataset_version, args.ingest, args.create_only,
+                        args.browse, args.report, args.page_workers, args.max_window_results,
+                        args.window_workers, args.bulk_size, args.ingest_workers, args.ingest_timeout)
+        else:
+            scrape(ds_es_url, args.datasets_cfg, args.starttime, args.endtime,
+                   args.polygon, args.user, args.password, args.dataset_version,
+                   args.ingest, args.create_only, args.browse, args.purpose, args.report,
+                   args.page_workers, args.cursor, args.max_window_results, args.window_workers,
+                   args.stream, args.prefetch_pages, args.bulk_size, args.ingest_workers, args.ingest_timeout,
+                   args.query_geometry, args.query_tolerance)
     except Exception as e:
         with open('_alt_error.txt', 'a') as f:
             f.write("%s\n" % str(e))
@@ -7,11 +7,14 @@ import geojson
 from hysds.celery import app
 from hysds.dataset_ingest import ingest
 import requests
-import re
 import shapely
 import os
 import traceback
 import shutil
+import s1_name
+import footprints
+import grq_scroll
+from deadline import get_timeout
 
 
 # set logger
@@ -27,7 +30,7 @@ class LogFilter(logging.Filter):
 
 
 logger = logging.getLogger('scrape_asf')
-logger.setLevel(logging.INFO, logging.DEBUG)
+logger.setLevel(logging.INFO)
 logger.addFilter(LogFilter())
 
 DATASET_VERSION = "v2.0"
@@ -66,7 +69,7 @@ def get_existing_acqs(start_time, end_time, location=False):
     :param location:
     :param start_time:
     :param end_time:
-    :return:
+    :return: set of existing acquisition ids
     """
     index = "grq_v2.0_acquisition-s1-iw_slc"
 
@@ -101,44 +104,14 @@ def get_existing_acqs(start_time, end_time, location=False):
                 }
         query["query"]["filtered"]["filter"] = geo_shape
 
-    acq_ids = []
-    rest_url = app.conf["GRQ_ES_URL"][:-1] if app.conf["GRQ_ES_URL"].endswith('/') else app.conf["GRQ_ES_URL"]
-    url = "{}/{}/_search?search_type=scan&scroll=60&size=10000".format(rest_url, index)
-    r = requests.post(url, data=json.dumps(query))
-    r.raise_for_status()
-    scan_result = r.json()
-    count = scan_result['hits']['total']
-    if count == 0:
-        return []
-    if '_scroll_id' not in scan_result:
-        print("_scroll_id not found in scan_result. Returning empty array for the query :\n%s" % query)
-        return []
-    scroll_id = scan_result['_scroll_id']
-    hits = []
-    while True:
-        r = requests.post('%s/_search/scroll?scroll=60m' % rest_url, data=scroll_id)
-        res = r.json()
-        scroll_id = res['_scroll_id']
-        if len(res['hits']['hits']) == 0:
-            break
-        hits.extend(res['hits']['hits'])
-
-    for item in hits:
-        acq_ids.append(item.get("_id"))
-
-    return acq_ids
+    return set(hit["_id"] for hit in grq_scroll.scroll(app.conf["GRQ_ES_URL"], index, query, source=False))
 
 
 def not_RAW(product_name):
-    match = re.search(r'([\w.-]+)_([\w.-]+)_([\w.-]+)__([\d])([\w])([\w.-]+)', product_name)
-    if match:
-        product_type = match.group(3)
-
-        if product_type == "RAW":
-            return False
-        else: return True
-    else:
-        return True
+    name = s1_name.parse_name(product_name)
+    if name is not None and name.product_type == "RAW":
+        return False
+    return True
 
 
 def get_area(coords):
@@ -179,11 +152,11 @@ def get_product_class(satellite_name, product_name):
 
     if satellite_name == "Sentinel-1A" or satellite_name == "Sentinel-1B":
         # sample name of S1 file : S1A_IW_SLC__1SDV_20150909T163711_20150909T163746_007640_00A97E_A69D
-        match = re.search(r'([\w.-]+)_([\w.-]+)_([\w.-]+)__([\d])([\w])([\w.-]+)', product_name)
-        if match:
-            product_type = match.group(3)
-            processing_level = match.group(4)
-            product_class = match.group(5)
+        name = s1_name.parse_name(product_name)
+        if name is not None:
+            product_type = name.product_type
+            processing_level = name.level
+            product_class = name.product_class
 
     return product_class, product_type, processing_level
 
@@ -252,13 +225,15 @@ def get_instrument_name(satellite):
     return instrument_name, instrument_short_name
 
 
-def make_met_file(record):
+def make_met_file(record, location=None):
 
     metadata = dict()
 
     metadata["acquisitiontype"] = DEFAULT_ACQ_TYPE
     metadata["archive_filename"] = record["granuleName"] + ".zip"
-    metadata["location"] = valid_es_geometry(get_polygon(record["stringFootprint"]))
+    if location is None:
+        location = valid_es_geometry(get_polygon(record["stringFootprint"]))
+    metadata["location"] = location
     # metadata["bbox"] = metadata["location"]["coordinates"][0]
     if record["flightDirection"] == "ASCENDING":
         direction = "asc"
@@ -334,7 +309,7 @@ def make_met_file(record):
     return folder_name
 
 
-def make_dataset_file(product_name, record, starttime = None, endtime = None):
+def make_dataset_file(product_name, record, starttime = None, endtime = None, location=None):
     folder_name = product_name
     dataset = dict()
 
@@ -346,7 +321,9 @@ def make_dataset_file(product_name, record, starttime = None, endtime = None):
         dataset["endtime"] = endtime
 
     dataset["label"] = product_name
-    dataset["location"] = valid_es_geometry(get_polygon(record["geometry"]))
+    if location is None:
+        location = valid_es_geometry(get_polygon(record["geometry"]))
+    dataset["location"] = location
     dataset["version"] = DATASET_VERSION
 
     dataset_file = open("%s/%s.dataset.json" % (folder_name, product_name), 'w')
@@ -354,11 +331,11 @@ def make_dataset_file(product_name, record, starttime = None, endtime = None):
     dataset_file.close()
 
 
-def create_dataset_from_asf(record):
+def create_dataset_from_asf(record, met_location=None, ds_location=None):
     product_name = record["granuleName"]
     if not_RAW(product_name):
-        product_name = make_met_file(record)
-        make_dataset_file(product_name, record)
+        product_name = make_met_file(record, met_location)
+        make_dataset_file(product_name, record, location=ds_location)
 
 
 def ingest_acq_dataset(starttime, endtime, ds_cfg ="/home/ops/verdi/etc/datasets.json"):
@@ -384,15 +361,21 @@ def scrape_asf(start_time, end_time):
         request_string = 'https://api.daac.asf.alaska.edu/services/search/param?platform=SA,SB&processingLevel=METADATA_SLC' \
                          '&start={}&end={}&output=json'.format(start_time, end_time)
         logger.info("ASF request URL: {}".format(request_string))
-        response = requests.get(request_string)
+        response = requests.get(request_string, timeout=get_timeout())
         response.raise_for_status()
         if response.status_code != 200:
             raise Exception("Request to ASF failed with status {}. {}".format(response.status_code, request_string))
         results = json.loads(response.text)
         logger.debug("Response from ASF: {}".format(response.text))
 
+        # prepare the footprints of all results in one batch
+        met_locations = footprints.get_es_locations(
+            footprints.parse_footprints([result["stringFootprint"] for result in results[0]]))
+        ds_locations = footprints.get_es_locations(
+            footprints.parse_footprints([result["geometry"] for result in results[0]]))
+
         # parse the json and map to scihub fields
-        for result in results[0]:
+        for result, met_location, ds_location in zip(results[0], met_locations, ds_locations):
             st = result["startTime"]
             et = result["stopTime"]
             st_ms_pos = st.rfind(".")
@@ -404,7 +387,7 @@ def scrape_asf(start_time, end_time):
             if len(et) - et_ms_pos > 3:
                 result["stopTime"] = et[:et_ms_pos + 3]
 
-            create_dataset_from_asf(result)
+            create_dataset_from_asf(result, met_location, ds_location)
         ingest_acq_dataset(start_time, end_time)
     except Exception as err:
         logger.info("Failed to ingest acquisitions from ASF : %s. List of failed acquistions" % str(err))
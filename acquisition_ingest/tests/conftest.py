@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the job modules import each other by module name, as on the PGE's PYTHONPATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,115 @@
+import json
+from datetime import timedelta
+import pytest
+
+pytest.importorskip("hysds.celery")
+
+import ingest_cursor
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, doc=None):
+        self.status_code = status_code
+        self.doc = doc
+
+    def json(self):
+        return self.doc
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception("HTTP {}".format(self.status_code))
+
+
+class FakeSession(object):
+    """GRQ holding at most one cursor document, with ES version checks."""
+
+    def __init__(self, ingestiondate=None, version=None):
+        self.ingestiondate = ingestiondate
+        self.version = version
+        self.puts = []
+
+    def get(self, url, **kwargs):
+        if self.ingestiondate is None:
+            return FakeResponse(404)
+        return FakeResponse(200, {"_source": {"ingestiondate": self.ingestiondate}, "_version": self.version})
+
+    def put(self, url, data=None, **kwargs):
+        self.puts.append(url)
+        if url.endswith("?op_type=create"):
+            if self.ingestiondate is not None:
+                return FakeResponse(409)
+        elif not url.endswith("?version={}".format(self.version)):
+            return FakeResponse(409)
+        self.ingestiondate = json.loads(data)["ingestiondate"]
+        self.version = (self.version or 0) + 1
+        return FakeResponse(201)
+
+
+@pytest.fixture(autouse=True)
+def cursor_url(monkeypatch):
+    monkeypatch.setattr(ingest_cursor, "get_cursor_url", lambda name: "http://grq/state/cursor/{}".format(name))
+
+
+def test_get_missing_cursor():
+    assert ingest_cursor.get_cursor("c", FakeSession()) == (None, None)
+
+
+def test_create_cursor():
+    session = FakeSession()
+    assert ingest_cursor.advance_cursor("c", "2019-01-01T00:00:00.000Z", None, session)
+    assert session.puts[-1].endswith("?op_type=create")
+    assert ingest_cursor.get_cursor("c", session) == ("2019-01-01T00:00:00.000Z", 1)
+
+
+def test_advance_cursor():
+    session = FakeSession("2019-01-01T00:00:00.000Z", 3)
+    assert ingest_cursor.advance_cursor("c", "2019-01-02T00:00:00.000Z", 3, session)
+    assert session.puts[-1].endswith("?version=3")
+    assert session.ingestiondate == "2019-01-02T00:00:00.000Z"
+
+
+def test_cursor_never_moves_backwards():
+    session = FakeSession("2019-01-02T00:00:00.000Z", 3)
+    assert not ingest_cursor.advance_cursor("c", "2019-01-01T00:00:00.000Z", 3, session)
+    assert not ingest_cursor.advance_cursor("c", "2019-01-02T00:00:00.000Z", 3, session)
+    assert session.puts == []
+    assert session.ingestiondate == "2019-01-02T00:00:00.000Z"
+
+
+def test_cursor_updated_by_another_run():
+    session = FakeSession("2019-01-02T00:00:00.000Z", 4)
+    assert not ingest_cursor.advance_cursor("c", "2019-01-03T00:00:00.000Z", 3, session)
+    assert session.puts == []
+    assert session.ingestiondate == "2019-01-02T00:00:00.000Z"
+
+
+def test_cursor_created_by_another_run():
+    session = FakeSession()
+    original_get = session.get
+
+    def get(url, **kwargs):
+        # another run creates the cursor between the read and the write
+        response = original_get(url, **kwargs)
+        session.ingestiondate, session.version = "2019-01-05T00:00:00.000Z", 1
+        return response
+    session.get = get
+    assert not ingest_cursor.advance_cursor("c", "2019-01-03T00:00:00.000Z", None, session)
+    assert session.ingestiondate == "2019-01-05T00:00:00.000Z"
+
+
+def test_high_water_mark_is_min_failed():
+    dates = ["2019-01-01T00:00:00.000Z", "2019-01-03T00:00:00.000Z", "2019-01-02T00:00:00.000Z"]
+    failed = ["2019-01-02T00:00:00.000Z", "2019-01-01T12:00:00.000Z"]
+    assert ingest_cursor.get_high_water_mark(dates, failed) == "2019-01-01T12:00:00.000Z"
+
+
+def test_high_water_mark_is_max_seen():
+    dates = ["2019-01-01T00:00:00.000Z", "2019-01-03T00:00:00.000Z", "2019-01-02T00:00:00.000Z"]
+    assert ingest_cursor.get_high_water_mark(dates, []) == "2019-01-03T00:00:00.000Z"
+    assert ingest_cursor.get_high_water_mark([], []) is None
+
+
+def test_query_start_overlap():
+    assert ingest_cursor.get_query_start("2019-01-01T00:10:00.000Z") == "2018-12-31T23:40:00.000Z"
+    assert ingest_cursor.DEFAULT_OVERLAP == timedelta(minutes=30)
+    assert ingest_cursor.get_query_start("2019-01-01T00:10:00.000Z", timedelta(0)) == "2019-01-01T00:10:00.000Z"
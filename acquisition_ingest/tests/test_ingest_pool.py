@@ -0,0 +1,65 @@
+import threading
+import time
+import pytest
+
+import ingest_pool
+from ingest_pool import IngestPool
+
+
+@pytest.fixture
+def release():
+    """Event the hanging fake ingests wait on, set at the end of the test."""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+@pytest.fixture(autouse=True)
+def poll_interval(monkeypatch):
+    monkeypatch.setattr(ingest_pool, "POLL_INTERVAL", 0.02)
+
+
+def run(pool, fn, count):
+    results = []
+    for i in range(count):
+        results.extend(pool.submit(i, fn, i))
+    results.extend(pool.close())
+    return results
+
+
+def test_results_in_submission_order():
+    def ingest(n):
+        time.sleep(0.01 * (n % 3))
+        if n == 4:
+            raise ValueError("bad dataset")
+        return True
+    results = run(IngestPool(3), ingest, 10)
+    assert results == [(i, i != 4) for i in range(10)]
+
+
+def test_queued_ingests_move_off_hung_workers(release):
+    def ingest(n):
+        if n < 2:
+            release.wait(10)
+        return True
+    t0 = time.time()
+    results = run(IngestPool(2, timeout=0.3), ingest, 10)
+    assert results == [(0, False), (1, False)] + [(i, True) for i in range(2, 10)]
+    assert time.time() - t0 < 5
+
+
+def test_hung_ingests_fail_in_order_past_max_abandoned(release):
+    started = []
+
+    def ingest(n):
+        started.append(n)
+        release.wait(10)
+        return True
+    pool = IngestPool(2, timeout=0.3, max_abandoned=1)
+    t0 = time.time()
+    results = run(pool, ingest, 10)
+    assert results == [(i, False) for i in range(10)]
+    assert time.time() - t0 < 5
+    # one executor replaced, the ingests after the second hang are never run
+    assert pool.abandoned == 2
+    assert sorted(started) == [0, 1, 2, 3]
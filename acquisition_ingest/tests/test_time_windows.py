@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from time_windows import split_window, parse_time, MIN_WINDOW
+
+
+def density_count(times):
+    """Count probe over a fixed set of result times."""
+    probes = []
+
+    def count_fn(starttime, endtime):
+        probes.append((starttime, endtime))
+        start, end = parse_time(starttime), parse_time(endtime)
+        return len([t for t in times if start <= t < end])
+    return count_fn, probes
+
+
+def assert_covers(windows, starttime, endtime):
+    assert windows[0][0] == starttime
+    assert windows[-1][1] == endtime
+    for previous, window in zip(windows, windows[1:]):
+        assert previous[1] == window[0]
+
+
+def test_sparse_window_is_not_split():
+    count_fn, probes = density_count([parse_time("2019-01-01T12:00:00Z")])
+    windows = split_window("2019-01-01T00:00:00.000Z", "2019-01-02T00:00:00.000Z", count_fn, 10)
+    assert windows == [["2019-01-01T00:00:00.000Z", "2019-01-02T00:00:00.000Z"]]
+    assert len(probes) == 1
+
+
+def test_dense_period_is_split():
+    start = parse_time("2019-01-01T06:00:00Z")
+    times = [start + timedelta(minutes=10 * i) for i in range(30)]
+    count_fn, probes = density_count(times)
+    windows = split_window("2019-01-01T00:00:00.000Z", "2019-01-02T00:00:00.000Z", count_fn, 10)
+    assert_covers(windows, "2019-01-01T00:00:00.000Z", "2019-01-02T00:00:00.000Z")
+    assert len(windows) > 1
+    for window in windows:
+        assert count_fn(*window) <= 10
+
+
+def test_bisection_stops_at_min_window():
+    # all results in one second: never under the limit, however small the window
+    times = [parse_time("2019-01-01T06:00:00Z")] * 100
+    count_fn, probes = density_count(times)
+    windows = split_window("2019-01-01T00:00:00.000Z", "2019-01-02T00:00:00.000Z", count_fn, 10)
+    assert_covers(windows, "2019-01-01T00:00:00.000Z", "2019-01-02T00:00:00.000Z")
+    over = [w for w in windows if count_fn(*w) > 10]
+    assert len(over) == 1
+    length = parse_time(over[0][1]) - parse_time(over[0][0])
+    assert MIN_WINDOW <= length < 2 * MIN_WINDOW
+    for window in windows:
+        assert parse_time(window[1]) - parse_time(window[0]) >= MIN_WINDOW
+
+
+def test_window_never_under_limit():
+    # every probe reports too many results: bisection ends at MIN_WINDOW everywhere
+    probes = []
+
+    def count_fn(starttime, endtime):
+        probes.append((starttime, endtime))
+        return 100
+    windows = split_window("2019-01-01T00:00:00.000Z", "2019-01-01T02:00:00.000Z", count_fn, 10)
+    assert_covers(windows, "2019-01-01T00:00:00.000Z", "2019-01-01T02:00:00.000Z")
+    assert len(windows) == 8
+    for window in windows:
+        assert parse_time(window[1]) - parse_time(window[0]) == timedelta(minutes=15)
+    assert len(probes) == 15
+
+
+def test_short_window_is_not_split():
+    windows = split_window("2019-01-01T00:00:00.000Z", "2019-01-01T00:15:00.000Z", lambda st, et: 100, 10)
+    assert windows == [["2019-01-01T00:00:00.000Z", "2019-01-01T00:15:00.000Z"]]
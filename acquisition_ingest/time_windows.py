@@ -0,0 +1,49 @@
+"""
+Split a query time window into sub-windows by result density.
+
+Sub-windows are found by recursive bisection with a caller supplied count
+probe, so dense periods end up in small windows and sparse ones stay whole.
+"""
+
+import logging
+from datetime import timedelta
+import dateutil.parser
+
+
+logger = logging.getLogger('time_windows')
+logger.setLevel(logging.INFO)
+
+# never bisect below this window length
+MIN_WINDOW = timedelta(minutes=10)
+
+
+def format_time(dt):
+    return "{}Z".format(dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3])
+
+
+def parse_time(time_str):
+    return dateutil.parser.parse(time_str).replace(tzinfo=None)
+
+
+def split_window(starttime, endtime, count_fn, max_count, min_window=MIN_WINDOW):
+    """
+    Recursively bisect [starttime, endtime] until every sub-window holds at
+    most max_count results or can't be split further.
+    :param starttime: window start in ISO8601 format
+    :param endtime: window end in ISO8601 format
+    :param count_fn: callable (starttime, endtime) returning the result count of a window
+    :param max_count: maximum number of results per sub-window
+    :param min_window: timedelta below which a window is not split any further
+    :return: list of [starttime, endtime] pairs covering the window in order
+    """
+    count = count_fn(starttime, endtime)
+    start = parse_time(starttime)
+    end = parse_time(endtime)
+    if count <= max_count or end - start < 2 * min_window:
+        logger.info("Window {} to {}: {} results".format(starttime, endtime, count))
+        return [[starttime, endtime]]
+
+    mid = format_time(start + (end - start) // 2)
+    logger.info("Window {} to {}: {} results, splitting at {}".format(starttime, endtime, count, mid))
+    return split_window(starttime, mid, count_fn, max_count, min_window) + \
+        split_window(mid, endtime, count_fn, max_count, min_window)
@@ -36,7 +36,7 @@ def validate_temporal_input(starttime, hours_delta, days_delta):
                         .format(starttime, hours_delta, days_delta))
 
 
-def get_job_params(job_type, job_name, starttime, endtime):
+def get_job_params(job_type, job_name, starttime, endtime, cursor=None):
 
     rule = {
         "rule_name": job_type.lstrip('job-'),
@@ -76,6 +76,17 @@ def get_job_params(job_type, job_name, starttime, endtime):
             }
         ]
 
+        params = params + add_params
+    else:
+        # empty cursor name disables incremental scraping
+        add_params = [
+            {
+                "name": "cursor",
+                "from": "value",
+                "value": cursor or ""
+            }
+        ]
+
         params = params + add_params
     return rule, params
 
@@ -100,6 +111,8 @@ if __name__ == "__main__":
                                       "or branch) to propagate",
                         default="master", required=True)
     parser.add_argument("--polygon", required=False)
+    parser.add_argument("--cursor", help="name of the ingestion date cursor for incremental scraping, "
+                                         "the start time is only used until the cursor exists", required=False)
 
     args = parser.parse_args()
     qtype = args.qtype
@@ -136,7 +149,7 @@ if __name__ == "__main__":
     job_name = job_name.lstrip('job-')
 
     # Setup input arguments here
-    rule, params = get_job_params(job_type, job_name, starttime, endtime)
+    rule, params = get_job_params(job_type, job_name, starttime, endtime, args.cursor)
 
     print("submitting job of type {} for {}".format(job_spec, qtype))
     submit_mozart_job({}, rule,
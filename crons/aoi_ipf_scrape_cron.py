@@ -1,14 +1,20 @@
 import json
 import os
-import requests
+import sys
 import elasticsearch
 from hysds.celery import app
 from hysds_commons.job_utils import submit_mozart_job
 
 BASE_PATH = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(BASE_PATH, "..", "acquisition_ingest"))
+
+import grq_scroll
 
 es_url = app.conf["GRQ_ES_URL"]
 _type = "area_of_interest"
+
+# acquisitions per batch IPF job
+IPF_BATCH_SIZE = 50
 ES = elasticsearch.Elasticsearch(es_url)
 
 
@@ -37,29 +43,7 @@ def get_aois():
     }
 
     aoi_list = []
-    rest_url = es_url[:-1] if es_url.endswith('/') else es_url
-    url = "{}/{}/_search?search_type=scan&scroll=60&size=10000".format(rest_url, index)
-    r = requests.post(url, data=json.dumps(query))
-    r.raise_for_status()
-    scan_result = r.json()
-    count = scan_result['hits']['total']
-    if count == 0:
-        return []
-    if '_scroll_id' not in scan_result:
-        print("_scroll_id not found in scan_result. Returning empty array for the query :\n%s" % query)
-        return []
-    scroll_id = scan_result['_scroll_id']
-    hits = []
-    while True:
-        r = requests.post('%s/_search/scroll?scroll=60m' % rest_url, data=scroll_id)
-        res = r.json()
-        scroll_id = res['_scroll_id']
-        if len(res['hits']['hits']) == 0:
-            break
-        hits.extend(res['hits']['hits'])
-
-
-    for item in hits:
+    for item in grq_scroll.scroll(es_url, index, query, source=["location", "starttime", "endtime"]):
         aoi_info = dict()
         aoi_info["id"] = item.get("_id")
         aoi_info["location"] = item.get("_source").get("location")
@@ -91,6 +75,11 @@ def submit_aoi_ipf(aoi):
             "name": "end_time",
             "from": "value",
             "value": aoi.get("endtime")
+        },
+        {
+            "name": "batch_size",
+            "from": "value",
+            "value": IPF_BATCH_SIZE
         }
     ]
 
@@ -6,8 +6,11 @@ from hysds_commons.job_utils import submit_mozart_job
 
 BASE_PATH = os.path.dirname(__file__)
 
+# acquisitions per batch IPF job
+IPF_BATCH_SIZE = 50
 
-def submit_global_ipf(spatial_extent, start_time, end_time, release):
+
+def submit_global_ipf(spatial_extent, start_time, end_time, release, batch_size=IPF_BATCH_SIZE):
     params = [
         {
             "name": "AOI_name",
@@ -28,6 +31,11 @@ def submit_global_ipf(spatial_extent, start_time, end_time, release):
             "name": "end_time",
             "from": "value",
             "value": end_time
+        },
+        {
+            "name": "batch_size",
+            "from": "value",
+            "value": batch_size
         }
     ]
 
@@ -53,6 +61,8 @@ if __name__ == "__main__":
     parser.add_argument("--tag", help="PGE docker image tag (release, version, " +
                                       "or branch) to propagate",
                         default="master", required=False)
+    parser.add_argument("--batch_size", help="acquisitions per IPF scraper job, 1 for a job per acquisition",
+                        type=int, default=IPF_BATCH_SIZE, required=False)
     args = parser.parse_args()
 
     tag = args.tag
@@ -65,5 +75,5 @@ if __name__ == "__main__":
 
     start_time = "{}Z".format((datetime.utcnow()-timedelta(days=5)).isoformat())
     end_time = "{}Z".format(datetime.utcnow().isoformat())
-    submit_global_ipf(global_extent, start_time, end_time, tag)
+    submit_global_ipf(global_extent, start_time, end_time, tag, args.batch_size)
 
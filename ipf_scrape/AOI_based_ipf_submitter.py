@@ -1,60 +1,109 @@
 import json
 import os
-import requests
 import dateutil.parser
 from datetime import datetime, timedelta
 import elasticsearch
+from shapely.geometry import shape, box
 from hysds.celery import app
 from hysds_commons.job_utils import submit_mozart_job
+import grq_scroll
+import ipf_timeline
+import ipf_failures
+from ipf_store import update_ipfs
 
 BASE_PATH = os.path.dirname(__file__)
 
 es_url = app.conf["GRQ_ES_URL"]
 ES = elasticsearch.Elasticsearch(es_url)
 
+# parallel shard scans when listing the acquisitions of an AOI
+SCROLL_SLICES = 4
+
+# acquisition metadata used by the IPF scraper jobs: the ASF granule id, the SciHub
+# product links and what ipf_version.get_dataset_json() reads, plus the platform
+# and ingestion date the IPF timeline is looked up by
+IPF_JOB_FIELDS = [
+    "metadata.id",
+    "metadata.platform",
+    "metadata.ingestiondate",
+    "metadata.identifier",
+    "metadata.alternative",
+    "metadata.filename",
+    "metadata.location",
+    "metadata.sensingStart",
+    "metadata.sensingStop"
+]
+
+GLOBE = box(-180, -90, 180, 90)
+
+# acquisitions per batch IPF job, 1 submits a job per acquisition
+IPF_BATCH_SIZE = 50
+
 job_types = {
     "asf": "job-ipf-scraper-asf",
     "scihub": "job-ipf-scraper-scihub"
 }
 
+batch_job_types = {
+    "asf": "job-ipf-scraper-batch-asf",
+    "scihub": "job-ipf-scraper-batch-scihub"
+}
+
 job_queues = {
     "asf": "ipf-scraper-asf",
     "scihub": "ipf-scraper-scihub"
 }
 
 
+def is_global(location):
+    """
+    Check if an extent covers the whole globe, so that filtering on it selects everything.
+    :param location: geojson geometry
+    :return: True if location is empty or global
+    """
+    return not location or shape(location).covers(GLOBE)
+
+
 def get_non_ipf_acquisitions(location, start_time, end_time):
     """
     This function would query for all the acquisitions that
-    temporally and spatially overlap with the AOI
+    temporally and spatially overlap with the AOI and don't
+    have an IPF version yet
     :param location:
     :param start_time:
     :param end_time:
     :return:
     """
     index = "grq_v2.0_acquisition-s1-iw_slc"
+    filters = [
+        {
+            "range": {
+                "metadata.sensingStart": {
+                    "to": end_time,
+                    "from": start_time
+                }
+            }
+        },
+        {
+            "missing": {
+                "field": "metadata.processing_version"
+            }
+        }
+    ]
+    if not is_global(location):
+        filters.append({
+            "geo_shape": {
+                "location": {
+                    "shape": location
+                }
+            }
+        })
     query = {
         "query": {
             "filtered": {
                 "filter": {
-                    "geo_shape": {
-                        "location": {
-                            "shape": location
-                        }
-                    }
-                },
-                "query": {
                     "bool": {
-                        "must": [
-                            {
-                                "range": {
-                                    "metadata.sensingStart": {
-                                        "to": end_time,
-                                        "from": start_time
-                                    }
-                                }
-                            }
-                        ]
+                        "must": filters
                     }
                 }
             }
@@ -62,34 +111,11 @@ def get_non_ipf_acquisitions(location, start_time, end_time):
     }
 
     acq_list = []
-    rest_url = es_url[:-1] if es_url.endswith('/') else es_url
-    url = "{}/{}/_search?search_type=scan&scroll=60&size=10000".format(rest_url, index)
-    r = requests.post(url, data=json.dumps(query))
-    r.raise_for_status()
-    scan_result = r.json()
-    count = scan_result['hits']['total']
-    if count == 0:
-        return []
-    if '_scroll_id' not in scan_result:
-        print("_scroll_id not found in scan_result. Returning empty array for the query :\n%s" % query)
-        return []
-    scroll_id = scan_result['_scroll_id']
-    hits = []
-    while True:
-        r = requests.post('%s/_search/scroll?scroll=60m' % rest_url, data=scroll_id)
-        res = r.json()
-        scroll_id = res['_scroll_id']
-        if len(res['hits']['hits']) == 0:
-            break
-        hits.extend(res['hits']['hits'])
-
-    for item in hits:
-        ipf_version = item.get("_source").get("metadata").get("processing_version")
-        if ipf_version is None:
-            acq_info = dict()
-            acq_info["id"] = item.get("_id")
-            acq_info["metadata"] = item.get("_source").get("metadata")
-            acq_list.append(acq_info)
+    for item in grq_scroll.scroll(es_url, index, query, source=IPF_JOB_FIELDS, slices=SCROLL_SLICES):
+        acq_info = dict()
+        acq_info["id"] = item.get("_id")
+        acq_info["metadata"] = item.get("_source").get("metadata")
+        acq_list.append(acq_info)
 
     return acq_list
 
@@ -145,11 +171,117 @@ def submit_ipf_scraper(acq, tag, endpoint):
     print("For {} , IPF scrapper Job ID: {}".format(acq.get("id"), mozart_job_id))
 
 
+def submit_ipf_batch(acqs, tag, endpoint):
+    """Submit one batch IPF scraper job for a list of acquisitions."""
+    params = [
+        {
+            "name": "acq_ids",
+            "from": "value",
+            "value": [acq.get("id") for acq in acqs]
+        },
+        {
+            "name": "acq_mets",
+            "from": "value",
+            "value": [acq.get("metadata") for acq in acqs]
+        },
+        {
+            "name": "index",
+            "from": "value",
+            "value": "grq_v2.0_acquisition-s1-iw_slc"
+        },
+        {
+            "name": "dataset_type",
+            "from": "value",
+            "value": "acquisition-S1-IW_SLC"
+        },
+        {
+            "name": "endpoint",
+            "from": "value",
+            "value": endpoint
+        },
+        {
+            "name": "workers",
+            "from": "value",
+            "value": 4
+        },
+        {
+            "name": "ds_cfg",
+            "from": "value",
+            "value": "datasets.json"
+        }
+    ]
+
+    rule = {
+        "rule_name": "ipf_scraper_batch_{}".format(endpoint),
+        "queue": job_queues.get(endpoint),
+        "priority": '5',
+        "kwargs": '{}'
+    }
+
+    job_type = batch_job_types.get(endpoint)
+    print('submitting batch job for {} acquisitions'.format(len(acqs)))
+    mozart_job_id = submit_mozart_job({}, rule, hysdsio={"id": "internal-temporary-wiring", "params": params,
+                                                         "job-specification": "{}:{}".format(job_type, tag)},
+                                      job_name='%s-%s-%s-%s' % (job_type, acqs[0].get("id"), len(acqs), tag))
+    print("For {} acquisitions from {}, IPF scraper batch Job ID: {}".format(len(acqs), acqs[0].get("id"),
+                                                                            mozart_job_id))
+
+
+def fill_inferred(acqs):
+    """
+    Fill in the IPF of the acquisitions the IPF timeline determines.
+    :param acqs: list of {"id", "metadata"}
+    :return: list of the acquisitions that still need a lookup
+    """
+    try:
+        timelines = ipf_timeline.get_timelines(acq.get("metadata").get("platform") for acq in acqs
+                                               if acq.get("metadata").get("platform"))
+        inferred, remaining = ipf_timeline.infer_ipfs(acqs, timelines)
+        if not inferred:
+            return remaining
+        failed = update_ipfs(inferred, "grq_v2.0_acquisition-s1-iw_slc", "acquisition-S1-IW_SLC", inferred=True)
+    except Exception as e:
+        print("Failed to infer IPF versions from the IPF timeline, submitting all acquisitions: {}".format(e))
+        return acqs
+    print("Filled in IPF of {} acquisitions from the IPF timeline, {} failed".format(
+        len(inferred) - len(failed), len(failed)))
+    return remaining + [acq for acq in acqs if acq.get("id") in failed]
+
+
+def skip_failed(acqs):
+    """
+    Drop the acquisitions whose last IPF lookup failed and aren't due for a retry yet.
+    :param acqs: list of {"id", "metadata"}
+    :return: list of the acquisitions to submit jobs for
+    """
+    try:
+        blocked = ipf_failures.get_blocked([acq.get("id") for acq in acqs])
+    except Exception as e:
+        print("Failed to read the IPF failure cache, submitting all acquisitions: {}".format(e))
+        return acqs
+    reasons = {}
+    for failure in blocked.values():
+        reasons[failure.get("reason")] = reasons.get(failure.get("reason"), 0) + 1
+    if blocked:
+        print("Skipping {} acquisitions with recently failed IPF lookups: {}".format(
+            len(blocked), json.dumps(reasons, sort_keys=True)))
+    return [acq for acq in acqs if acq.get("id") not in blocked]
+
+
+def get_endpoint(acq):
+    """ASF for acquisitions older than a day, SciHub for recent ones."""
+    acq_date = acq.get("metadata").get("sensingStart")
+    start_time = dateutil.parser.parse(acq_date)
+    if start_time.replace(tzinfo=None) < datetime.now() - timedelta(days=1):
+        return "asf"
+    return "scihub"
+
+
 if __name__ == "__main__":
     """
     This script will find all acquisitions without IPF versions
     overlapping with a specific AOI. It will then submit IPF scraper
-    jobs for each acquisition.
+    jobs for them, batch_size acquisitions per job.
     """
 
     ctx = json.loads(open("_context.json", "r").read())
@@ -157,15 +289,22 @@ if __name__ == "__main__":
     start_time = ctx.get("start_time")
     end_time = ctx.get("end_time")
     tag = ctx.get("container_specification").get("version")
+    batch_size = int(ctx.get("batch_size", IPF_BATCH_SIZE))
     acqs_list = get_non_ipf_acquisitions(location, start_time, end_time)
 
-    for acq in acqs_list:
-        print(json.dumps(acq))
-        print("Date:" + acq.get("metadata").get("sensingStart"))
-        acq_date = acq.get("metadata").get("sensingStart")
-        start_time = dateutil.parser.parse(acq_date)
-        if start_time.replace(tzinfo=None) < datetime.now() - timedelta(days=1):
-            endpoint = "asf"
-        else:
-            endpoint = "scihub"
-        submit_ipf_scraper(acq, tag, endpoint)
+    # fill in the IPF of acquisitions the IPF timeline determines, only the rest need a job
+    acqs_list = fill_inferred(acqs_list)
+    acqs_list = skip_failed(acqs_list)
+
+    if batch_size <= 1:
+        for acq in acqs_list:
+            print(json.dumps(acq))
+            print("Date:" + acq.get("metadata").get("sensingStart"))
+            submit_ipf_scraper(acq, tag, get_endpoint(acq))
+    else:
+        acqs_by_endpoint = {}
+        for acq in acqs_list:
+            acqs_by_endpoint.setdefault(get_endpoint(acq), []).append(acq)
+        for endpoint, acqs in sorted(acqs_by_endpoint.items()):
+            for i in range(0, len(acqs), batch_size):
+                submit_ipf_batch(acqs[i:i + batch_size], tag, endpoint)
@@ -0,0 +1,156 @@
+"""
+Negative cache of failed IPF lookups.
+
+An acquisition whose product SciHub has moved to long-term archive, or whose
+lookup was throttled or failed, still has no processing_version, so every run
+of the IPF submitter would queue another job for it that is bound to fail the
+same way. The IPF jobs record each failed lookup here with its reason and a
+retry-after time that backs off exponentially with the number of consecutive
+failures, and clear the entry once the IPF is found. The submitter skips the
+acquisitions whose retry-after time has not passed yet.
+
+Entries are documents in GRQ keyed by acquisition id, so they are shared by
+all jobs and workers.
+"""
+
+import json
+import logging
+from datetime import datetime, timedelta
+from hysds.celery import app
+import s1_name
+import grq_scroll
+
+
+logger = logging.getLogger('ipf_failures')
+logger.setLevel(logging.INFO)
+
+FAILURE_INDEX = "acquisition_ingest_state"
+FAILURE_TYPE = "ipf_failure"
+
+# ids per _mget request
+MGET_SIZE = 1000
+
+# backoff after the first failure, per reason; doubled with every consecutive failure
+BACKOFFS = {
+    "lta": timedelta(hours=6),
+    "throttled": timedelta(minutes=30),
+    "not_found": timedelta(hours=12),
+    "error": timedelta(hours=2)
+}
+MAX_BACKOFF = timedelta(days=2)
+
+
+def get_es_url():
+    return app.conf["GRQ_ES_URL"].rstrip('/')
+
+
+def to_iso(dt):
+    return "{}Z".format(dt.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def classify(error):
+    """
+    Failure reason of a lookup error message from ipf_version.
+    :param error: error message
+    :return: lta, throttled, not_found, error, or deadline for lookups skipped at the job deadline
+    """
+    error = str(error).lower()
+    if "time budget exhausted" in error:
+        return "deadline"
+    if "long term archive" in error or "got 202" in error:
+        return "lta"
+    if "exceeding max concurrent" in error or "got code 503" in error or "got code 429" in error:
+        return "throttled"
+    if "not found" in error or "got code 404" in error:
+        return "not_found"
+    return "error"
+
+
+def get_backoff(reason, failures):
+    """Time to wait before retrying after failures consecutive failures."""
+    backoff = BACKOFFS.get(reason, BACKOFFS["error"]) * 2 ** min(max(failures - 1, 0), 16)
+    return min(backoff, MAX_BACKOFF)
+
+
+def get_failures(ids, session=None):
+    """
+    Read the cached failures of acquisitions.
+    :param ids: acquisition ids
+    :param session: requests session, the pooled GRQ session by default
+    :return: dict of id to failure entry, for the acquisitions that have one
+    """
+    session = session or grq_scroll.grq_session
+    ids = list(ids)
+    failures = {}
+    for i in range(0, len(ids), MGET_SIZE):
+        r = session.post("{}/{}/{}/_mget".format(get_es_url(), FAILURE_INDEX, FAILURE_TYPE),
+                         data=json.dumps({"ids": ids[i:i + MGET_SIZE]}))
+        if r.status_code == 404:
+            # nothing has failed yet
+            return {}
+        r.raise_for_status()
+        for doc in r.json()["docs"]:
+            if doc.get("found"):
+                failures[doc["_id"]] = doc["_source"]
+    return failures
+
+
+def get_blocked(ids, now=None, session=None):
+    """
+    Acquisitions whose last IPF lookup failed and aren't due for a retry yet.
+    :param ids: acquisition ids
+    :param now: current time, utcnow by default
+    :return: dict of id to failure entry
+    """
+    now = now or datetime.utcnow()
+    return dict((id, failure) for id, failure in get_failures(ids, session).items()
+                if s1_name.parse_iso(failure["retry_after"]) > now)
+
+
+def record_failures(errors, previous=None, now=None, session=None):
+    """
+    Record failed lookups, backing off from the failures already recorded.
+    :param errors: dict of acquisition id to error message
+    :param previous: result of get_failures() for these ids, read from GRQ if None
+    :param now: current time, utcnow by default
+    :param session: requests session, the pooled GRQ session by default
+    :return: dict of id to the failure entry written
+    """
+    if not errors:
+        return {}
+    session = session or grq_scroll.grq_session
+    now = now or datetime.utcnow()
+    if previous is None:
+        previous = get_failures(errors, session)
+    entries = {}
+    lines = []
+    for id, error in errors.items():
+        reason = classify(error)
+        last = previous.get(id) or {}
+        # a different reason starts the backoff over
+        failures = last.get("failures", 0) + 1 if last.get("reason") == reason else 1
+        entries[id] = {
+            "acq_id": id,
+            "reason": reason,
+            "error": str(error),
+            "failures": failures,
+            "failed_at": to_iso(now),
+            "retry_after": to_iso(now + get_backoff(reason, failures))
+        }
+        lines.append(json.dumps({"index": {"_index": FAILURE_INDEX, "_type": FAILURE_TYPE, "_id": id}}))
+        lines.append(json.dumps(entries[id]))
+    r = session.post("{}/_bulk".format(get_es_url()), data="\n".join(lines) + "\n")
+    r.raise_for_status()
+    logger.info("Recorded {} failed IPF lookups".format(len(entries)))
+    return entries
+
+
+def clear_failures(ids, session=None):
+    """Remove the entries of acquisitions whose IPF has been found."""
+    ids = list(ids)
+    if not ids:
+        return
+    session = session or grq_scroll.grq_session
+    lines = [json.dumps({"delete": {"_index": FAILURE_INDEX, "_type": FAILURE_TYPE, "_id": id}}) for id in ids]
+    r = session.post("{}/_bulk".format(get_es_url()), data="\n".join(lines) + "\n")
+    r.raise_for_status()
@@ -0,0 +1,87 @@
+"""
+Batched reads and writes of acquisition IPF versions in GRQ.
+
+Checking and writing processing_version one acquisition at a time costs an
+ES round trip each. get_ipf_versions reads the versions of many acquisitions
+with _mget against the concrete acquisition index, and update_ipfs writes
+many versions with one _bulk partial update, reporting failures per item.
+
+Every write also records when the version was filled in, and whether it was
+inferred from the IPF timeline rather than looked up, so that the timeline
+can pick up versions filled in late and leave out its own guesses.
+"""
+
+import json
+import logging
+from datetime import datetime
+from hysds.celery import app
+import grq_scroll
+
+
+logger = logging.getLogger('ipf_store')
+logger.setLevel(logging.INFO)
+
+ACQ_INDEX = "grq_v2.0_acquisition-s1-iw_slc"
+ACQ_TYPE = "acquisition-S1-IW_SLC"
+
+# ids per _mget request
+MGET_SIZE = 1000
+
+
+def get_es_url():
+    return app.conf["GRQ_ES_URL"].rstrip('/')
+
+
+def get_ipf_versions(ids, index=ACQ_INDEX, typ=ACQ_TYPE, session=None):
+    """
+    Read the processing_version of acquisitions.
+    :param ids: acquisition ids
+    :param index: acquisition index
+    :param typ: acquisition dataset type
+    :param session: requests session, the pooled GRQ session by default
+    :return: dict of id to processing_version (None if it has none) of the acquisitions found
+    """
+    session = session or grq_scroll.grq_session
+    ids = list(ids)
+    versions = {}
+    for i in range(0, len(ids), MGET_SIZE):
+        r = session.post("{}/{}/{}/_mget".format(get_es_url(), index, typ),
+                         params={"_source": "metadata.processing_version"},
+                         data=json.dumps({"ids": ids[i:i + MGET_SIZE]}))
+        r.raise_for_status()
+        for doc in r.json()["docs"]:
+            if doc.get("found"):
+                versions[doc["_id"]] = doc.get("_source", {}).get("metadata", {}).get("processing_version")
+    return versions
+
+
+def update_ipfs(ipfs, index=ACQ_INDEX, typ=ACQ_TYPE, session=None, inferred=False):
+    """
+    Write IPF versions with one _bulk request.
+    :param ipfs: dict of acquisition id to IPF version
+    :param index: acquisition index
+    :param typ: acquisition dataset type
+    :param session: requests session, the pooled GRQ session by default
+    :param inferred: the versions were inferred from the IPF timeline rather than looked up
+    :return: dict of acquisition id to error of the updates that failed
+    """
+    if not ipfs:
+        return {}
+    session = session or grq_scroll.grq_session
+    updated = "{}Z".format(datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"))
+    lines = []
+    for id, ipf_version in ipfs.items():
+        logger.info("Updating IPF Version of {}. IPF Version: {}".format(id, ipf_version))
+        lines.append(json.dumps({"update": {"_index": index, "_type": typ, "_id": id}}))
+        lines.append(json.dumps({"doc": {"metadata": {"processing_version": ipf_version,
+                                                      "processing_version_updated": updated,
+                                                      "processing_version_inferred": inferred}}}))
+    r = session.post("{}/_bulk".format(get_es_url()), data="\n".join(lines) + "\n")
+    r.raise_for_status()
+    failed = {}
+    for item in r.json()['items']:
+        result = item['update']
+        if result.get('error') or result.get('status', 200) >= 300:
+            failed[result['_id']] = "Update failed: {}".format(result.get('error'))
+            logger.error("Failed to update IPF of {}: {}".format(result['_id'], result.get('error')))
+    return failed
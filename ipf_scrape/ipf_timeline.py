@@ -0,0 +1,237 @@
+"""
+IPF version timeline of each Sentinel-1 platform.
+
+Every product a platform's ground segment processes in a given period gets
+the same IPF version, and the version changes only a few times a year. The
+timeline records, per ingestion day, the processing versions seen on the
+acquisitions in GRQ that already have one. An acquisition's IPF is inferred
+from it only when the answer is unambiguous: its own ingestion day and the
+nearest days with known versions on either side all show the same single
+version. Acquisitions near a version change, or newer than anything known,
+still get their IPF from SciHub or ASF.
+
+Versions the timeline inferred are tagged as such on the acquisitions and are
+not read back into it, so a guess never reinforces itself, and a version is
+only inferred between known days at most MAX_GAP apart.
+
+The timeline of each platform is a document in GRQ, updated incrementally
+from the acquisitions ingested, or given their version, since the last
+update, with ES optimistic concurrency so that concurrent updates don't
+overwrite each other.
+"""
+
+import json
+import bisect
+import logging
+from datetime import datetime, timedelta
+from hysds.celery import app
+import s1_name
+import grq_scroll
+
+
+logger = logging.getLogger('ipf_timeline')
+logger.setLevel(logging.INFO)
+
+TIMELINE_INDEX = "acquisition_ingest_state"
+TIMELINE_TYPE = "ipf_timeline"
+
+ACQ_INDEX = "grq_v2.0_acquisition-s1-iw_slc"
+
+# re-read this much before the last update for late indexed or late IPF-filled acquisitions
+UPDATE_OVERLAP = timedelta(days=2)
+
+# longest span between the known days around an acquisition to infer its version across
+MAX_GAP = timedelta(days=7)
+
+
+def get_timeline_url(platform):
+    return "{}/{}/{}/{}".format(app.conf["GRQ_ES_URL"].rstrip('/'), TIMELINE_INDEX, TIMELINE_TYPE, platform)
+
+
+def get_day(ingestiondate):
+    """Ingestion day of an ISO8601 ingestiondate, None if it can't be parsed."""
+    try:
+        return s1_name.parse_iso(ingestiondate).strftime("%Y-%m-%d")
+    except Exception:
+        return None
+
+
+class IPFTimeline(object):
+    """IPF versions seen per ingestion day on the acquisitions of one platform."""
+
+    def __init__(self, platform, days=None, built_until=None, version=None, updated_at=None, max_gap=MAX_GAP):
+        """
+        :param platform: platform name, e.g. Sentinel-1A
+        :param days: dict of ingestion day (YYYY-MM-DD) to set of IPF versions
+        :param built_until: latest ingestiondate included
+        :param version: ES document version the timeline was read at, None if it is new
+        :param updated_at: when the last update started
+        :param max_gap: longest span between known days to infer across
+        """
+        self.platform = platform
+        self.days = days or {}
+        self.built_until = built_until
+        self.version = version
+        self.updated_at = updated_at
+        self.max_gap = max_gap
+        self._sorted_days = None
+
+    @classmethod
+    def load(cls, platform):
+        """Read the timeline of a platform from GRQ, an empty one if there is none yet."""
+        r = grq_scroll.grq_session.get(get_timeline_url(platform))
+        if r.status_code == 404:
+            logger.info("No IPF timeline for {} found".format(platform))
+            return cls(platform)
+        r.raise_for_status()
+        doc = r.json()
+        days = dict((entry["day"], set(entry["versions"])) for entry in doc["_source"].get("days", []))
+        return cls(platform, days, doc["_source"].get("built_until"), doc["_version"],
+                   doc["_source"].get("updated_at"))
+
+    def add(self, ingestiondate, ipf):
+        """
+        Record the IPF version of an acquisition.
+        :return: True if the timeline changed
+        """
+        day = get_day(ingestiondate)
+        if day is None or not ipf:
+            return False
+        if self.built_until is None or s1_name.parse_iso(ingestiondate) > s1_name.parse_iso(self.built_until):
+            self.built_until = ingestiondate
+        versions = self.days.setdefault(day, set())
+        if ipf in versions:
+            return False
+        versions.add(ipf)
+        self._sorted_days = None
+        return True
+
+    def update(self, index=ACQ_INDEX, rebuild=False):
+        """
+        Add the IPF versions of the acquisitions ingested, or given their
+        version, since the last update. Inferred versions are left out.
+        :param index: acquisition index
+        :param rebuild: read all acquisitions instead
+        :return: number of acquisitions read
+        """
+        updated_at = "{}Z".format(datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"))
+        filters = [
+            {"term": {"metadata.platform.raw": self.platform}},
+            {"exists": {"field": "metadata.processing_version"}}
+        ]
+        if self.built_until and not rebuild:
+            since = s1_name.parse_iso(self.built_until) - UPDATE_OVERLAP
+            recent = [{"range": {"metadata.ingestiondate": {"gte": "{}Z".format(since.isoformat())}}}]
+            # older acquisitions whose IPF was filled in since
+            if self.updated_at:
+                filled_since = s1_name.parse_iso(self.updated_at) - UPDATE_OVERLAP
+                recent.append({"range": {"metadata.processing_version_updated": {
+                    "gte": "{}Z".format(filled_since.isoformat())}}})
+            filters.append({"bool": {"should": recent}})
+        query = {"query": {"filtered": {"filter": {"bool": {
+            "must": filters,
+            "must_not": [{"term": {"metadata.processing_version_inferred": True}}]
+        }}}}}
+        count = 0
+        for hit in grq_scroll.scroll(app.conf["GRQ_ES_URL"], index, query,
+                                     source=["metadata.ingestiondate", "metadata.processing_version"]):
+            met = hit["_source"]["metadata"]
+            self.add(met.get("ingestiondate"), met.get("processing_version"))
+            count += 1
+        self.updated_at = updated_at
+        logger.info("Read {} acquisitions into the {} IPF timeline, {} days known".format(
+            count, self.platform, len(self.days)))
+        return count
+
+    def save(self):
+        """
+        Write the timeline back, unless it was updated by someone else since it was read.
+        :return: True if it was written
+        """
+        doc = {
+            "platform": self.platform,
+            "built_until": self.built_until,
+            "updated_at": self.updated_at,
+            "days": [{"day": day, "versions": sorted(self.days[day])} for day in sorted(self.days)]
+        }
+        if self.version is None:
+            url = "{}?op_type=create".format(get_timeline_url(self.platform))
+        else:
+            url = "{}?version={}".format(get_timeline_url(self.platform), self.version)
+        r = grq_scroll.grq_session.put(url, data=json.dumps(doc))
+        if r.status_code == 409:
+            logger.info("IPF timeline {} was updated by another run, leaving it".format(self.platform))
+            return False
+        r.raise_for_status()
+        self.version = r.json().get("_version")
+        return True
+
+    def infer(self, ingestiondate):
+        """
+        IPF version of an acquisition if the timeline determines it.
+        :param ingestiondate: ingestiondate of the acquisition
+        :return: IPF version, None if it is ambiguous or unknown
+        """
+        day = get_day(ingestiondate)
+        if day is None:
+            return None
+        if self._sorted_days is None:
+            self._sorted_days = sorted(self.days)
+        days = self._sorted_days
+        i = bisect.bisect_left(days, day)
+        # nearest known days strictly before and after, plus the day itself if known
+        neighbours = []
+        if i > 0:
+            neighbours.append(days[i - 1])
+        if i < len(days) and days[i] == day:
+            neighbours.append(day)
+            i += 1
+        if i < len(days):
+            neighbours.append(days[i])
+        if len(neighbours) < 2 or neighbours[0] >= day or neighbours[-1] <= day:
+            return None
+        # a version change could hide in a long stretch without known days
+        if s1_name.parse_iso(neighbours[-1] + "T00:00:00") - s1_name.parse_iso(neighbours[0] + "T00:00:00") > \
+                self.max_gap:
+            return None
+        versions = set()
+        for neighbour in neighbours:
+            versions |= self.days[neighbour]
+        if len(versions) != 1:
+            return None
+        return versions.pop()
+
+
+def get_timelines(platforms, index=ACQ_INDEX):
+    """
+    Load and update the timelines of platforms, saving the updates.
+    :param platforms: platform names
+    :return: dict of platform to IPFTimeline
+    """
+    timelines = {}
+    for platform in sorted(set(platforms)):
+        timeline = IPFTimeline.load(platform)
+        timeline.update(index, rebuild=timeline.version is None)
+        timeline.save()
+        timelines[platform] = timeline
+    return timelines
+
+
+def infer_ipfs(acqs, timelines):
+    """
+    Split acquisitions into those whose IPF the timelines determine and the rest.
+    :param acqs: list of {"id", "metadata"} with metadata platform and ingestiondate
+    :param timelines: dict of platform to IPFTimeline
+    :return: tuple of (dict of id to inferred IPF version, list of the other acqs)
+    """
+    inferred = {}
+    remaining = []
+    for acq in acqs:
+        met = acq.get("metadata") or {}
+        timeline = timelines.get(met.get("platform"))
+        ipf = timeline.infer(met.get("ingestiondate")) if timeline and met.get("ingestiondate") else None
+        if ipf is None:
+            remaining.append(acq)
+        else:
+            inferred[acq.get("id")] = ipf
+    return inferred, remaining
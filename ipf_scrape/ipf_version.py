@@ -1,13 +1,16 @@
 from builtins import str
 import json
-from lxml.etree import fromstring, ElementTree
-import re
-import requests
+from lxml.etree import fromstring, XMLPullParser, QName
 import logging
-import elasticsearch
 import traceback
 import sys
-from hysds.celery import app
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import get_limiter
+from concurrency_governor import admit
+from hedged_requests import hedged_request, get_mirror_urls, get_tracker
+from deadline import DeadlineSession, get_deadline, get_timeout, get_session
+from ipf_store import ACQ_INDEX, ACQ_TYPE, get_ipf_versions, update_ipfs
+import ipf_failures
 
 log_format = "[%(asctime)s: %(levelname)s/%(funcName)s] %(message)s"
 logging.basicConfig(format=log_format, level=logging.INFO)
@@ -23,20 +26,26 @@ logger = logging.getLogger('ipf_scrape')
 logger.setLevel(logging.INFO)
 logger.addFilter(LogFilter())
 
-es_url = app.conf["GRQ_ES_URL"]
-_index = None
-_type = None
-ES = elasticsearch.Elasticsearch(es_url)
+_index = ACQ_INDEX
+_type = ACQ_TYPE
 
+# concurrent IPF lookups in a batch job
+IPF_WORKERS = 4
 
-def check_ipf_avail(id):
-    result = ES.search(index="grq",body={"query": {"term": {"_id": id}}})
-    ipf_version = result.get("hits").get("hits")[0].get("_source").get("metadata").get("processing_version", None)
+# manifest bytes read at a time while looking for the IPF version
+MANIFEST_CHUNK_SIZE = 4096
 
-    if ipf_version is not None:
-        return True
-    else:
-        return False
+ASF_SEARCH_URL = "https://api.daac.asf.alaska.edu/services/search/param"
+
+# granules per ASF search request
+ASF_BATCH_SIZE = 200
+
+
+def check_ipf_avail(id):
+    versions = get_ipf_versions([id], _index, _type)
+    if id not in versions:
+        raise Exception("Acquisition {} not found in {}".format(id, _index))
+    return versions[id] is not None
 
 
 def check_prod_avail(session, link):
@@ -48,50 +57,64 @@ def check_prod_avail(session, link):
     """
 
     product_url = "{}$value".format(link)
-    response = session.head(product_url, verify=False, timeout=180)
 
-    return response.status_code
+    def send(url):
+        return get_limiter("scihub").issue(session.head, url, verify=False, timeout=get_timeout())
 
+    response = hedged_request(send, get_mirror_urls(product_url), get_tracker("scihub-head"), admit=admit)
 
-def get_scihub_manifest(session, info):
-    """Get manifest information."""
+    return response.status_code
 
-    # disable extraction of manifest (takes too long); will be
-    # extracted when needed during standard product pipeline
 
-    # logger.info("info: {}".format(json.dumps(info, indent=2)))
+def get_manifest_urls(info):
+    """manifest.safe urls of a product, the dhus mirror first."""
     manifest_url = "{}Nodes('{}')/Nodes('manifest.safe')/$value".format(info['met']['alternative'],
                                                                              info['met']['filename'])
-    manifest_url2 = manifest_url.replace('/apihub/', '/dhus/')
-    for url in (manifest_url2, manifest_url):
-        response = session.get(url, verify=False, timeout=180)
-        logger.info("url: %s" % response.url)
-        if response.status_code == 200:
-            break
-    response.raise_for_status()
-    return response.content
+    return [manifest_url.replace('/apihub/', '/dhus/'), manifest_url]
 
 
-def get_scihub_namespaces(xml):
-    """Take an xml string and return a dict of namespace prefixes to
-       namespaces mapping."""
+def is_ipf_software(element):
+    """Check for the xmlData/safe:processing/safe:facility/safe:software element holding the IPF version."""
+    names = []
+    while element is not None and len(names) < 4:
+        names.append(QName(element).localname)
+        element = element.getparent()
+    return names == ["software", "facility", "processing", "xmlData"]
 
-    nss = {}
-    matches = re.findall(r'\s+xmlns:?(\w*?)\s*=\s*[\'"](.*?)[\'"]', xml)
-    for match in matches:
-        prefix = match[0]; ns = match[1]
-        if prefix == '': prefix = '_default'
-        nss[prefix] = ns
-    return nss
 
+def parse_scihub_ipf(chunks):
+    """
+    Read the IPF version from manifest.safe as it arrives, stopping at the
+    first processing facility software element.
+    :param chunks: iterable of manifest bytes
+    :return: IPF version, None if the manifest has none
+    """
+    parser = XMLPullParser(events=("end",))
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if is_ipf_software(element):
+                return element.get("version")
+    return None
 
-def get_scihub_ipf(manifest):
-    # append processing version (ipf)
-    ns = get_scihub_namespaces(manifest)
-    x = fromstring(manifest)
-    ipf = x.xpath('.//xmlData/safe:processing/safe:facility/safe:software/@version', namespaces=ns)[0]
 
-    return ipf
+def get_scihub_manifest_ipf(session, info):
+    """
+    Get the IPF version from the product manifest. The manifest is streamed
+    and the download stops as soon as the IPF version has been read.
+    Each request holds its connection slot until its streamed response is closed.
+    """
+    def send(url):
+        return get_limiter("scihub").issue(session.get, url, verify=False, timeout=get_timeout(), stream=True)
+
+    response = hedged_request(send, get_manifest_urls(info), get_tracker("scihub-manifest"),
+                              usable=lambda r: r.status_code == 200, admit=admit, stream=True)
+    logger.info("url: %s" % response.url)
+    try:
+        response.raise_for_status()
+        return parse_scihub_ipf(response.iter_content(chunk_size=MANIFEST_CHUNK_SIZE))
+    finally:
+        response.close()
 
 
 def get_dataset_json(met, version):
@@ -106,56 +129,122 @@ def get_dataset_json(met, version):
     }
 
 
-def extract_asf_ipf(id):
-    ipf = None
-    try:
-        # query the asf search api to find the download url for the .iso.xml file
-        request_string = 'https://api.daac.asf.alaska.edu/services/search/param?platform=SA,SB&processingLevel=METADATA_SLC' \
-                         '&granule_list=%s&output=json' % id
-        logger.info("ASF request URL: {}".format(request_string))
-        response = requests.get(request_string)
+def get_asf_metadata_urls(granules, session):
+    """
+    Find the .iso.xml download urls of granules, ASF_BATCH_SIZE granules per ASF search request.
+    :param granules: granule ids
+    :param session: requests session
+    :return: dict of granule id to .iso.xml url, for the granules ASF has
+    """
+    urls = {}
+    wanted = set(granules)
+    for i in range(0, len(granules), ASF_BATCH_SIZE):
+        chunk = granules[i:i + ASF_BATCH_SIZE]
+        # the granule list doesn't fit in a query string for large batches, so POST it
+        params = {
+            "platform": "SA,SB",
+            "processingLevel": "METADATA_SLC",
+            "granule_list": ",".join(chunk),
+            "output": "json"
+        }
+        logger.info("ASF search for {} granules".format(len(chunk)))
+        response = session.post(ASF_SEARCH_URL, data=params, timeout=get_timeout())
         response.raise_for_status()
         results = json.loads(response.text)
-        logger.info("Response from ASF: {}".format(response.text))
-        # download the .iso.xml file, assumes earthdata login credentials are in your .netrc file
-        if len(results[0]) == 0:
-            raise Exception("Acquisition not found at ASF.")
-        response = requests.get(results[0][0]['downloadUrl'])
-        response.raise_for_status()
-        if response.status_code != 200:
-            raise Exception("Request to ASF failed with status {}.".format(response.status_code))
-        # parse the xml file to extract the ipf version string
-        root = fromstring(response.text.encode('utf-8'))
-        ns = {'gmd': 'http://www.isotc211.org/2005/gmd', 'gmi': 'http://www.isotc211.org/2005/gmi',
-              'gco': 'http://www.isotc211.org/2005/gco'}
-        try:
-            ipf_string = root.find(
-                'gmd:composedOf/gmd:DS_DataSet/gmd:has/gmi:MI_Metadata/gmd:dataQualityInfo/gmd:DQ_DataQuality/gmd:lineage/gmd:LI_Lineage/gmd:processStep/gmd:LI_ProcessStep/gmd:description/gco:CharacterString',
-                ns).text
-        except AttributeError:
-            raise Exception("IPF not found in XML from download URL. Failed to extract IPF version from ASF.")
-        if ipf_string:
-            ipf = ipf_string.split('version')[1].split(')')[0].strip()
-    except Exception as err:
-        logger.info("get_processing_version_from_asf: %s" % str(err))
-        raise Exception("{}".format(str(err)))
+        records = results[0] if results else []
+        for record in records:
+            for name in (record.get("granuleName"), record.get("sceneId"), record.get("productName")):
+                if name in wanted:
+                    urls[name] = record['downloadUrl']
+                    break
+        # a single granule lookup takes the first result, as one search per granule always did
+        if len(chunk) == 1 and records and chunk[0] not in urls:
+            urls[chunk[0]] = records[0]['downloadUrl']
+    return urls
+
+
+def parse_asf_ipf(xml):
+    """Extract the IPF version from an ASF .iso.xml file."""
+    root = fromstring(xml)
+    ns = {'gmd': 'http://www.isotc211.org/2005/gmd', 'gmi': 'http://www.isotc211.org/2005/gmi',
+          'gco': 'http://www.isotc211.org/2005/gco'}
+    try:
+        ipf_string = root.find(
+            'gmd:composedOf/gmd:DS_DataSet/gmd:has/gmi:MI_Metadata/gmd:dataQualityInfo/gmd:DQ_DataQuality/gmd:lineage/gmd:LI_Lineage/gmd:processStep/gmd:LI_ProcessStep/gmd:description/gco:CharacterString',
+            ns).text
+    except AttributeError:
+        raise Exception("IPF not found in XML from download URL. Failed to extract IPF version from ASF.")
+    if ipf_string:
+        return ipf_string.split('version')[1].split(')')[0].strip()
+    return None
+
+
+def download_asf_ipf(url, session):
+    # download the .iso.xml file, assumes earthdata login credentials are in your .netrc file
+    get_deadline().check()
+    response = session.get(url, timeout=get_timeout())
+    response.raise_for_status()
+    if response.status_code != 200:
+        raise Exception("Request to ASF failed with status {}.".format(response.status_code))
+    return parse_asf_ipf(response.text.encode('utf-8'))
 
-    return ipf
+
+def resolve_asf_ipfs(granules, session=None, workers=IPF_WORKERS):
+    """
+    Look up the IPF versions of many granules at ASF: one search request per
+    ASF_BATCH_SIZE granules, then the .iso.xml files downloaded concurrently.
+    :param granules: granule ids
+    :param session: requests session, pooled for workers connections
+    :param workers: number of concurrent downloads
+    :return: tuple of (dict of granule id to IPF version, dict of granule id to error)
+    """
+    session = session or get_session(workers)
+    granules = sorted(set(granules))
+    urls = get_asf_metadata_urls(granules, session)
+    ipfs = {}
+    errors = dict((granule, "Acquisition not found at ASF.") for granule in granules if granule not in urls)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = [(granule, executor.submit(download_asf_ipf, urls[granule], session))
+                   for granule in granules if granule in urls]
+        for granule, future in futures:
+            try:
+                ipf = future.result()
+            except Exception as e:
+                errors[granule] = str(e)
+                continue
+            if ipf is None:
+                errors[granule] = "Found null IPF"
+            else:
+                ipfs[granule] = ipf
+    finally:
+        executor.shutdown()
+    logger.info("Resolved IPF of {} of {} granules at ASF".format(len(ipfs), len(granules)))
+    return ipfs, errors
+
+
+def extract_asf_ipf(id, session=None):
+    ipfs, errors = resolve_asf_ipfs([id], session, workers=1)
+    if id in errors:
+        logger.info("get_processing_version_from_asf: %s" % errors[id])
+        raise Exception(errors[id])
+    return ipfs[id]
 
 
 def update_ipf(id, ipf_version):
-    logger.info("Updating IPF Version of {}. IPF Version: {}".format(id, ipf_version))
-    ES.update(index=_index, doc_type=_type, id=id,
-              body={"doc": {"metadata": {"processing_version": ipf_version}}})
+    failed = update_ipfs({id: ipf_version}, _index, _type)
+    if id in failed:
+        raise Exception(failed[id])
 
 
-def extract_scihub_ipf(met):
+def extract_scihub_ipf(met, session=None):
     user = None
     password = None
 
     # get session
-    session = requests.session()
-    if None not in (user, password): session.auth = (user, password)
+    if session is None:
+        session = DeadlineSession()
+        if None not in (user, password): session.auth = (user, password)
 
     ds = get_dataset_json(met, version="v2.0")
 
@@ -166,7 +255,7 @@ def extract_scihub_ipf(met):
 
     prod_avail = check_prod_avail(session, info['met']['alternative'])
     if prod_avail == 200:
-        manifest = get_scihub_manifest(session, info)
+        ipf = get_scihub_manifest_ipf(session, info)
     elif prod_avail == 202:
         logger.info("Got 202 from SciHub. Product moved to long term archive.")
         raise Exception("Got 202. Product moved to long term archive.")
@@ -177,19 +266,145 @@ def extract_scihub_ipf(met):
         logger.info("Got code {} from SciHub".format(prod_avail))
         raise Exception("Got code {}".format(prod_avail))
 
-    ipf = get_scihub_ipf(manifest)
     return ipf
 
 
+def get_ipf(met, endpoint, session=None):
+    """
+    Look up the IPF version of an acquisition.
+    :param met: acquisition metadata
+    :param endpoint: asf or scihub
+    :param session: requests session to look it up with
+    :return: IPF version
+    """
+    # lookups not started by the job deadline are left for a later job
+    get_deadline().check()
+    if endpoint == "asf":
+        ipf = extract_asf_ipf(met.get("identifier"), session)
+    else:
+        ipf = extract_scihub_ipf(met, session)
+    if ipf is None:
+        raise Exception("Found null IPF")
+    return ipf
+
+
+def process_batch(acq_ids, mets, endpoint, index, typ, workers=IPF_WORKERS):
+    """
+    Look up the IPF versions of a batch of acquisitions over a shared session.
+    The IPF versions already in GRQ are read with one _mget and the new ones
+    written back with one _bulk update.
+    :param acq_ids: acquisition ids
+    :param mets: acquisition metadata, in the order of acq_ids
+    :param endpoint: asf or scihub
+    :param index: acquisition index
+    :param typ: acquisition dataset type
+    :param workers: number of concurrent lookups
+    :return: tuple of (dict of id to IPF version found, dict of id to error)
+    """
+    session = get_session(workers)
+    ipfs = {}
+    errors = {}
+
+    try:
+        versions = get_ipf_versions(acq_ids, index, typ)
+    except Exception as e:
+        # look them all up rather than fail the batch, the writes are idempotent
+        logger.error("Failed to check IPF of the batch: {}".format(e))
+        versions = dict((id, None) for id in acq_ids)
+    pending = []
+    for id, met in zip(acq_ids, mets):
+        if id not in versions:
+            errors[id] = "Acquisition not found in {}".format(index)
+        elif versions[id] is not None:
+            logger.info("{} already has IPF, skipping".format(id))
+        else:
+            pending.append((id, met))
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        if endpoint == "asf":
+            # a few ASF searches for the whole batch instead of one per granule
+            try:
+                found, failed = resolve_asf_ipfs([met.get("identifier") for id, met in pending], session, workers)
+            except Exception as e:
+                found, failed = {}, dict((met.get("identifier"), str(e)) for id, met in pending)
+            for id, met in pending:
+                granule = met.get("identifier")
+                if granule in found:
+                    ipfs[id] = found[granule]
+                else:
+                    errors[id] = failed.get(granule, "Acquisition not found at ASF.")
+        else:
+            futures = [(id, executor.submit(get_ipf, met, endpoint, session)) for id, met in pending]
+            for id, future in futures:
+                try:
+                    ipfs[id] = future.result()
+                except Exception as e:
+                    errors[id] = str(e)
+        for id in sorted(errors):
+            logger.error("Failed to get IPF for {}: {}".format(id, errors[id]))
+    finally:
+        executor.shutdown()
+
+    failed = update_ipfs(ipfs, index, typ)
+    for id in failed:
+        del ipfs[id]
+    errors.update(failed)
+    return ipfs, errors
+
+
+def update_failure_cache(ipfs, errors):
+    """
+    Record failed lookups in the IPF failure cache and clear the entries of the
+    acquisitions found. The cache only saves jobs, so failing to update it isn't fatal.
+    :param ipfs: dict of acquisition id to IPF version found
+    :param errors: dict of acquisition id to error
+    """
+    # lookups skipped at the job deadline didn't fail
+    errors = dict((id, error) for id, error in errors.items() if ipf_failures.classify(error) != "deadline")
+    try:
+        previous = ipf_failures.get_failures(list(ipfs) + list(errors))
+        ipf_failures.record_failures(errors, previous)
+        ipf_failures.clear_failures([id for id in ipfs if id in previous])
+    except Exception as e:
+        logger.error("Failed to update the IPF failure cache: {}".format(e))
+
+
+def run_batch(ctx):
+    """Batch IPF job: look up and write the IPF versions of ctx acq_ids."""
+    acq_ids = ctx["acq_ids"]
+    ipfs, errors = process_batch(acq_ids, ctx["acq_mets"], ctx["endpoint"], ctx.get("index", ACQ_INDEX),
+                                 ctx.get("dataset_type", ACQ_TYPE), int(ctx.get("workers", IPF_WORKERS)))
+    logger.info("Updated IPF of {} of {} acquisitions".format(len(ipfs), len(acq_ids)))
+    update_failure_cache(ipfs, errors)
+    # acquisitions skipped at the job deadline are picked up by the next submitter run
+    skipped = [id for id, error in errors.items() if ipf_failures.classify(error) == "deadline"]
+    if skipped:
+        logger.warning("Job time budget exhausted, left {} acquisitions for a later job".format(len(skipped)))
+        for id in skipped:
+            del errors[id]
+    if errors:
+        with open('_alt_error.txt', 'w') as f:
+            f.write("Failed to get IPF for {} of {} acquisitions".format(len(errors), len(acq_ids)))
+        with open('_alt_traceback.txt', 'w') as f:
+            for id, error in sorted(errors.items()):
+                f.write("{}: {}\n".format(id, error))
+        raise Exception("Failed to get IPF for {} of {} acquisitions.".format(len(errors), len(acq_ids)))
+
+
 if __name__ == "__main__":
     '''
     Main program that find IPF version for acquisition
     '''
     ctx = json.loads(open("_context.json", "r").read())
+    if "acq_ids" in ctx:
+        run_batch(ctx)
+        sys.exit(0)
+
     id = ctx["acq_id"]
     met = ctx["acq_met"]
-    _index = ctx.get("index")
-    _type = ctx.get("dataset_type")
+    _index = ctx.get("index", ACQ_INDEX)
+    _type = ctx.get("dataset_type", ACQ_TYPE)
     endpoint = ctx["endpoint"]
 
     if check_ipf_avail(id):
@@ -205,6 +420,7 @@ if __name__ == "__main__":
             if ipf is None:
                 raise Exception("Found null IPF")
         except Exception as ex:
+                update_failure_cache({}, {id: str(ex)})
                 with open('_alt_error.txt', 'w') as f:
                     f.write("{}".format(ex))
                 with open('_alt_traceback.txt', 'w') as f:
@@ -216,6 +432,7 @@ if __name__ == "__main__":
             if ipf is None:
                 raise Exception("Found null IPF")
         except Exception as ex:
+            update_failure_cache({}, {id: str(ex)})
             with open('_alt_error.txt', 'w') as f:
                 f.write("{}".format(ex))
             with open('_alt_traceback.txt', 'w') as f:
@@ -223,3 +440,4 @@ if __name__ == "__main__":
             raise Exception("Failed to get IPF for {}. {}.".format(id, ex))
 
     update_ipf(id, ipf)
+    update_failure_cache({id: ipf}, {})
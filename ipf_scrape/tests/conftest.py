@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the job modules import each other by module name, as on the PGE's PYTHONPATH
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path[:0] = [os.path.join(root, "ipf_scrape"), os.path.join(root, "acquisition_ingest")]
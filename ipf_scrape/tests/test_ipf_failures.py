@@ -0,0 +1,41 @@
+from datetime import timedelta
+import pytest
+
+pytest.importorskip("hysds.celery")
+
+from ipf_failures import classify, get_backoff, BACKOFFS, MAX_BACKOFF
+
+
+@pytest.mark.parametrize("error, reason", [
+    ("Got 202. Product moved to long term archive.", "lta"),
+    ("Failed to get IPF for S1A_X. Got 202. Product moved to long term archive..", "lta"),
+    ("Exceeding max concurrent SciHub connections.", "throttled"),
+    ("Got code 503", "throttled"),
+    ("Got code 429", "throttled"),
+    ("Got code 404", "not_found"),
+    ("Acquisition S1A_X not found in grq", "not_found"),
+    ("Got code 500", "error"),
+    ("Job time budget exhausted", "deadline"),
+])
+def test_classify(error, reason):
+    assert classify(Exception(error)) == reason
+
+
+@pytest.mark.parametrize("reason", sorted(BACKOFFS))
+def test_backoff_doubles_per_reason(reason):
+    assert get_backoff(reason, 0) == BACKOFFS[reason]
+    assert get_backoff(reason, 1) == BACKOFFS[reason]
+    for failures in range(2, 5):
+        expected = min(BACKOFFS[reason] * 2 ** (failures - 1), MAX_BACKOFF)
+        assert get_backoff(reason, failures) == expected
+
+
+def test_backoff_capped_at_two_days():
+    assert MAX_BACKOFF == timedelta(days=2)
+    for reason in BACKOFFS:
+        assert get_backoff(reason, 10) == MAX_BACKOFF
+        assert get_backoff(reason, 1000) == MAX_BACKOFF
+
+
+def test_unknown_reason_backs_off_as_error():
+    assert get_backoff("deadline", 3) == get_backoff("error", 3)
@@ -0,0 +1,93 @@
+import pytest
+
+pytest.importorskip("hysds.celery")
+
+import ipf_timeline
+from ipf_timeline import IPFTimeline, infer_ipfs
+
+
+def timeline(days, **kwargs):
+    return IPFTimeline("Sentinel-1A", dict((day, set(versions)) for day, versions in days.items()), **kwargs)
+
+
+def test_infer_between_days_of_one_version():
+    t = timeline({"2019-05-01": ["002.91"], "2019-05-04": ["002.91"]})
+    assert t.infer("2019-05-02T10:00:00.000Z") == "002.91"
+
+
+def test_infer_on_a_known_day():
+    t = timeline({"2019-05-01": ["002.91"], "2019-05-02": ["002.91"], "2019-05-03": ["002.91"]})
+    assert t.infer("2019-05-02T10:00:00.000Z") == "002.91"
+
+
+def test_no_inference_across_a_version_change():
+    t = timeline({"2019-05-01": ["002.91"], "2019-05-04": ["003.10"]})
+    assert t.infer("2019-05-02T10:00:00.000Z") is None
+
+
+def test_no_inference_during_an_interleaved_rollout():
+    # both versions on the neighbouring days and on the day itself
+    t = timeline({"2019-05-01": ["002.91"], "2019-05-02": ["002.91", "003.10"], "2019-05-03": ["003.10"]})
+    assert t.infer("2019-05-02T10:00:00.000Z") is None
+    t = timeline({"2019-05-01": ["002.91", "003.10"], "2019-05-03": ["002.91"]})
+    assert t.infer("2019-05-02T10:00:00.000Z") is None
+
+
+def test_no_inference_across_a_long_gap():
+    t = timeline({"2019-05-01": ["002.91"], "2019-05-09": ["002.91"]})
+    assert t.infer("2019-05-05T10:00:00.000Z") is None
+    t = timeline({"2019-05-01": ["002.91"], "2019-05-08": ["002.91"]})
+    assert t.infer("2019-05-05T10:00:00.000Z") == "002.91"
+
+
+def test_no_inference_outside_the_known_days():
+    t = timeline({"2019-05-01": ["002.91"], "2019-05-04": ["002.91"]})
+    assert t.infer("2019-04-30T10:00:00.000Z") is None
+    assert t.infer("2019-05-04T10:00:00.000Z") is None
+    assert t.infer("2019-05-05T10:00:00.000Z") is None
+    assert t.infer("not a date") is None
+
+
+def test_infer_ipfs_splits_acquisitions():
+    timelines = {"Sentinel-1A": timeline({"2019-05-01": ["002.91"], "2019-05-04": ["002.91"]})}
+    acqs = [
+        {"id": "a", "metadata": {"platform": "Sentinel-1A", "ingestiondate": "2019-05-02T10:00:00.000Z"}},
+        {"id": "b", "metadata": {"platform": "Sentinel-1B", "ingestiondate": "2019-05-02T10:00:00.000Z"}},
+        {"id": "c", "metadata": {"platform": "Sentinel-1A", "ingestiondate": "2019-05-06T10:00:00.000Z"}},
+    ]
+    inferred, remaining = infer_ipfs(acqs, timelines)
+    assert inferred == {"a": "002.91"}
+    assert [acq["id"] for acq in remaining] == ["b", "c"]
+
+
+def matches(met, query):
+    """Evaluate the must_not filter of an update() query on an acquisition's metadata."""
+    bool_filter = query["query"]["filtered"]["filter"]["bool"]
+    for clause in bool_filter["must_not"]:
+        for field, value in clause["term"].items():
+            if met.get(field.split(".", 1)[1]) == value:
+                return False
+    return True
+
+
+def test_inferred_versions_do_not_feed_update(monkeypatch):
+    acqs = [
+        {"ingestiondate": "2019-05-01T10:00:00.000Z", "processing_version": "002.91"},
+        {"ingestiondate": "2019-05-02T10:00:00.000Z", "processing_version": "002.91",
+         "processing_version_inferred": True},
+        {"ingestiondate": "2019-05-03T10:00:00.000Z", "processing_version": "002.91"},
+    ]
+    queries = []
+
+    def scroll(es_url, index, query, source=None, **kwargs):
+        queries.append(query)
+        return [{"_source": {"metadata": met}} for met in acqs if matches(met, query)]
+    monkeypatch.setattr(ipf_timeline.grq_scroll, "scroll", scroll)
+    monkeypatch.setitem(ipf_timeline.app.conf, "GRQ_ES_URL", "http://grq:9200")
+
+    t = IPFTimeline("Sentinel-1A")
+    assert t.update() == 2
+    assert sorted(t.days) == ["2019-05-01", "2019-05-03"]
+    assert {"term": {"metadata.processing_version_inferred": True}} in \
+        queries[0]["query"]["filtered"]["filter"]["bool"]["must_not"]
+    assert t.built_until == "2019-05-03T10:00:00.000Z"
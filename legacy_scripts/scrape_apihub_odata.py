@@ -25,6 +25,7 @@ import hysds.orchestrator
 from hysds.celery import app
 from hysds.dataset_ingest import ingest
 from osaka.main import get
+from rate_limiter import get_limiter
 
 #from notify_by_email import send_email
 
@@ -210,7 +211,7 @@ def scrape(ds_es_url, ds_cfg, starttime, endtime, email_to, user=None, password=
         logger.info("query: %s" % json.dumps(query_params, indent=2))
         #query_url = url + "&".join(["%s=%s" % (i, query_params[i]) for i in query_params]).replace(" ", "%20").replace("'", "%27")
         #logger.info("query_url: %s" % query_url)
-        response = session.get(url, params=query_params, verify=False)
+        response = get_limiter("scihub").request(session.get, url, params=query_params, verify=False)
         logger.info("query_url: %s" % response.url)
         if response.status_code != 200:
             logger.error("Error: %s\n%s" % (response.status_code,response.text))
@@ -243,9 +244,6 @@ def scrape(ds_es_url, ds_cfg, starttime, endtime, email_to, user=None, password=
             }
             ids_by_track.setdefault(met['trackNumber'], []).append(met['data_product_name'])
 
-        # don't clobber the connection
-        time.sleep(3)
-
     # check if exists
     prods_missing = []
     prods_found = []
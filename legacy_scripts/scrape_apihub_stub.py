@@ -24,6 +24,7 @@ import hysds.orchestrator
 from hysds.celery import app
 from hysds.dataset_ingest import ingest
 from osaka.main import get
+from rate_limiter import get_limiter
 
 #from notify_by_email import send_email
 
@@ -189,7 +190,8 @@ def scrape(ds_es_url, ds_cfg, starttime, endtime, email_to, user=None, password=
         "filter": query, 
     }
     logger.info("count query: %s" % json.dumps(count_params, indent=2))
-    response = session.get("%s/count?" % url, params=count_params, verify=False)
+    limiter = get_limiter("scihub")
+    response = limiter.request(session.get, "%s/count?" % url, params=count_params, verify=False)
     logger.info("count_url: %s" % response.url)
     if response.status_code != 200:
         logger.error("Error: %s\n%s" % (response.status_code,response.text))
@@ -211,7 +213,7 @@ def scrape(ds_es_url, ds_cfg, starttime, endtime, email_to, user=None, password=
             "order": "desc"
         }
         logger.info("query: %s" % json.dumps(query_params, indent=2))
-        response = session.get("%s?" % url, params=query_params, verify=False)
+        response = limiter.request(session.get, "%s?" % url, params=query_params, verify=False)
         logger.info("query_url: %s" % response.url)
         if response.status_code != 200:
             logger.error("Error: %s\n%s" % (response.status_code,response.text))
@@ -239,9 +241,6 @@ def scrape(ds_es_url, ds_cfg, starttime, endtime, email_to, user=None, password=
             }
             ids_by_track.setdefault(met['trackNumber'], []).append(met['data_product_name'])
 
-        # don't clobber the connection
-        time.sleep(3)
-
     # check if exists
     prods_missing = []
     prods_found = []
@@ -5,6 +5,7 @@ from datetime import datetime
 
 from hysds_commons.job_utils import submit_mozart_job
 from hysds.celery import app
+from s1_name import parse_iso
 
 
 # set logger
@@ -24,8 +25,7 @@ logger.addFilter(LogFilter())
 def get_date(dt):
     """Return datetime from string."""
 
-    return datetime.strptime(dt[:-1] if dt.endswith('Z') else dt,
-                             "%Y-%m-%dT%H:%M:%S.%f")
+    return parse_iso(dt)
     
 
 def submit_sling(ctx_file):
@@ -8,6 +8,7 @@ from hysds_commons.job_utils import submit_mozart_job
 from hysds.celery import app
 
 from .sling_acquisition import get_date
+import grq_scroll
 
 
 # set logger
@@ -46,26 +47,13 @@ def submit_sling(ctx_file):
                 "type" : "acquisition-S1-IW_SLC",
                 "values" : ids,
             }
-        },
-        "partial_fields" : {
-            "partial" : {
-                "exclude" : ["city", "context", "metadata.context"],
-            }
         }
     }
 
     # query
-    r = requests.post("%s/grq_*_acquisition-s1-iw_slc/_search?search_type=scan&scroll=60&size=100" % es_url, data=json.dumps(query))
-    r.raise_for_status()
-    scan_result = r.json()
-    scroll_id = scan_result['_scroll_id']
-    matches = []
-    while True:
-        r = requests.post('%s/_search/scroll?scroll=60m' % es_url, data=scroll_id)
-        res = r.json()
-        scroll_id = res['_scroll_id']
-        if len(res['hits']['hits']) == 0: break
-        matches.extend([i['fields']['partial'][0] for i in res['hits']['hits']])
+    matches = [hit['_source'] for hit in
+               grq_scroll.scroll(es_url, "grq_*_acquisition-s1-iw_slc", query, size=100,
+                                 source={"exclude": ["city", "context", "metadata.context"]})]
     #logger.info("matches: {}".format([m['_id'] for m in matches]))
     logger.info("matches: {}".format(len(matches)))
     #logger.info("matches[-1]: {}".format(json.dumps(matches[-1], indent=2)))
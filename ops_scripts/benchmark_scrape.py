@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the acquisition scrape path, run on synthetic OpenSearch
+entries so that no SciHub or GRQ access is needed.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import re
+import json
+import time
+import argparse
+import tracemalloc
+import dateutil.parser
+import shapely.wkt
+import geojson
+
+BASE_PATH = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(BASE_PATH, "..", "acquisition_ingest"))
+
+import scrape_apihub_opensearch
+import footprints
+import scrape_asf
+from acquisition_record import AcquisitionRecord
+
+
+def make_entry(i):
+    """Synthetic OpenSearch JSON entry shaped like an S1 IW SLC result."""
+    platform = "A" if i % 2 == 0 else "B"
+    orbit = 10000 + i
+    track = (orbit - (73 if platform == "A" else 27)) % 175 + 1
+    day = 1 + (i // 3600) % 28
+    hour = (i // 60) % 24
+    second = i % 60
+    start = "2019-05-%02dT%02d:00:%02d" % (day, hour, second)
+    stop = "2019-05-%02dT%02d:00:%02d" % (day, hour, min(second + 25, 59))
+    title = "S1%s_IW_SLC__1SDV_%s_%s_%06d_%06X_%04X" % (platform, start.replace("-", "").replace(":", ""),
+                                                        stop.replace("-", "").replace(":", ""), orbit, i, i % 65536)
+    x = (i % 340) - 170.0
+    y = (i % 160) - 80.0
+    footprint = "POLYGON ((%s %s,%s %s,%s %s,%s %s,%s %s))" % (x, y, x + 2.5, y + 0.3, x + 2.1, y + 2.0,
+                                                           x - 0.4, y + 1.7, x, y)
+    alternative = "https://scihub.copernicus.eu/apihub/odata/v1/Products('uuid-%d')/" % i
+    return {
+        "id": "uuid-%d" % i,
+        "title": title,
+        "summary": "Date: %s, Instrument: SAR-C SAR, Mode: VV VH, Satellite: Sentinel-1, Size: 7.5 GB" % start,
+        "int": [{"name": "orbitnumber", "content": str(orbit)},
+                {"name": "relativeorbitnumber", "content": str(track)},
+                {"name": "slicenumber", "content": str(i % 20)}],
+        "link": [{"href": alternative + "$value"},
+                 {"rel": "alternative", "href": alternative},
+                 {"rel": "icon", "href": alternative + "Products('Quicklook')/$value"}],
+        "str": [{"name": "orbitdirection", "content": "ASCENDING" if i % 3 else "DESCENDING"},
+                {"name": "footprint", "content": footprint},
+                {"name": "filename", "content": title + ".SAFE"},
+                {"name": "platformname", "content": "Sentinel-1"},
+                {"name": "polarisationmode", "content": "VV VH"},
+                {"name": "sensoroperationalmode", "content": "IW"},
+                {"name": "uuid", "content": "uuid-%d" % i}],
+        "date": [{"name": "beginposition", "content": start + ".123Z"},
+                 {"name": "endposition", "content": stop + ".456Z"},
+                 {"name": "ingestiondate", "content": start + ".789Z"}],
+    }
+
+
+def make_pages(count, page_size=scrape_apihub_opensearch.PAGE_SIZE):
+    """Synthetic OpenSearch result pages as the JSON text SciHub returns."""
+    entries = [make_entry(i) for i in range(count)]
+    return [json.dumps(entries[i:i + page_size]) for i in range(0, count, page_size)]
+
+
+def iter_entries(pages):
+    for page in pages:
+        for met in json.loads(page):
+            yield met
+
+
+def measure(build, pages):
+    """Return (current, peak) bytes allocated while building and holding build(pages)."""
+    gc.collect()
+    tracemalloc.start()
+    held = build(pages)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    return current, peak
+
+
+def build_dicts(pages):
+    prods_all = {}
+    for met in iter_entries(pages):
+        scrape_apihub_opensearch.massage_result(met)
+        prods_all[met['id']] = {
+            'met': met,
+            'ds': scrape_apihub_opensearch.get_dataset_json(met, "v2.0"),
+        }
+    return prods_all
+
+
+def build_records(pages):
+    prods_all = {}
+    for met in iter_entries(pages):
+        scrape_apihub_opensearch.massage_result(met)
+        prods_all[met['id']] = AcquisitionRecord.from_met(met)
+    return prods_all
+
+
+def bench_memory(count):
+    """Compare memory held by prods_all as met/ds dicts and as AcquisitionRecords."""
+    pages = make_pages(count)
+    results = []
+    for name, build in (("met/ds dicts", build_dicts), ("AcquisitionRecord", build_records)):
+        current, peak = measure(build, pages)
+        results.append((name, current, peak))
+    print("prods_all memory for {} entries:".format(count))
+    for name, current, peak in results:
+        print("  {:<20} held: {:8.1f} MB  peak: {:8.1f} MB".format(name, current / 1e6, peak / 1e6))
+
+
+def get_accurate_times_regex(filename_str, starttime_str, endtime_str):
+    """get_accurate_times() as it was before s1_name: per-call regex and dateutil parsing."""
+    match_pattern = "(?P<spacecraft>S1\\w)_IW_SLC__(?P<misc>.*?)_(?P<s_year>\\d{4})(?P<s_month>\\d{2})(?P<s_day>\\d{2})T(?P<s_hour>\\d{2})(?P<s_minute>\\d{2})(?P<s_seconds>\\d{2})_(?P<e_year>\\d{4})(?P<e_month>\\d{2})(?P<e_day>\\d{2})T(?P<e_hour>\\d{2})(?P<e_minute>\\d{2})(?P<e_seconds>\\d{2})(?P<misc2>.*?)$"
+    m = re.match(match_pattern, filename_str)
+    dateutil.parser.parse(starttime_str).strftime('%Y-%m-%dT%H:%M:%S')
+    dateutil.parser.parse(endtime_str).strftime('%Y-%m-%dT%H:%M:%S')
+    start_microseconds = dateutil.parser.parse(starttime_str).strftime('.%f').rstrip('0').ljust(4, '0') + 'Z'
+    end_microseconds = dateutil.parser.parse(endtime_str).strftime('.%f').rstrip('0').ljust(4, '0') + 'Z'
+    starttime = "{}-{}-{}T{}:{}:{}{}".format(m.group("s_year"), m.group("s_month"), m.group("s_day"), m.group("s_hour"),
+                                            m.group("s_minute"), m.group("s_seconds"), start_microseconds)
+    endtime = "{}-{}-{}T{}:{}:{}{}".format(m.group("e_year"), m.group("e_month"), m.group("e_day"), m.group("e_hour"),
+                                          m.group("e_minute"), m.group("e_seconds"), end_microseconds)
+    return starttime, endtime
+
+
+def time_massage(entries):
+    """Return seconds per entry spent in massage_result()."""
+    mets = [json.loads(json.dumps(met)) for met in entries]
+    t0 = time.time()
+    for met in mets:
+        scrape_apihub_opensearch.massage_result(met)
+    return (time.time() - t0) / len(mets)
+
+
+def bench_parse(count, repeat):
+    """Compare massage_result() cost with the old regex/dateutil parsing and with s1_name."""
+    entries = [make_entry(i) for i in range(count)]
+    get_accurate_times = scrape_apihub_opensearch.get_accurate_times
+    results = []
+    for name, fn in (("regex/dateutil", get_accurate_times_regex), ("s1_name", get_accurate_times)):
+        scrape_apihub_opensearch.get_accurate_times = fn
+        try:
+            best = None
+            for _ in range(repeat):
+                per_entry = time_massage(entries)
+                best = per_entry if best is None else min(best, per_entry)
+        finally:
+            scrape_apihub_opensearch.get_accurate_times = get_accurate_times
+        results.append((name, best))
+    print("massage_result cost for {} entries (best of {}):".format(count, repeat))
+    for name, per_entry in results:
+        print("  {:<20} {:8.1f} us/entry".format(name, per_entry * 1e6))
+
+
+def footprints_per_entry(wkts):
+    """Footprint handling as massage_result() and scrape_asf did it, one entry at a time."""
+    for wkt in wkts:
+        g = shapely.wkt.loads(wkt)
+        geojson.Feature(geometry=g, properties={}).geometry
+        geojson.Feature(geometry=g.envelope, properties={}).geometry.coordinates[0]
+        scrape_asf.valid_es_geometry(scrape_asf.get_polygon(wkt))
+
+
+def footprints_batch(wkts):
+    """The same footprint handling for a whole page with the footprints module."""
+    geoms = footprints.parse_footprints(wkts)
+    footprints.get_locations(geoms)
+    footprints.get_bboxes(geoms)
+    footprints.get_es_locations(footprints.parse_footprints(wkts))
+
+
+def bench_geometry(pages, repeat):
+    """Compare per-page footprint cost of per-entry shapely/geojson calls and the batch footprints module."""
+    wkt_pages = []
+    for p in range(pages):
+        entries = [make_entry(p * scrape_apihub_opensearch.PAGE_SIZE + i)
+                   for i in range(scrape_apihub_opensearch.PAGE_SIZE)]
+        wkt_pages.append([e['str'][1]['content'] for e in entries])
+    results = []
+    for name, fn in (("per entry", footprints_per_entry), ("footprints batch", footprints_batch)):
+        best = None
+        for _ in range(repeat):
+            t0 = time.time()
+            for wkts in wkt_pages:
+                fn(wkts)
+            per_page = (time.time() - t0) / pages
+            best = per_page if best is None else min(best, per_page)
+        results.append((name, best))
+    print("footprint cost per page of {} entries, {} pages (best of {}, shapely vectorized: {}):".format(
+        scrape_apihub_opensearch.PAGE_SIZE, pages, repeat, footprints.VECTORIZED))
+    for name, per_page in results:
+        print("  {:<20} {:8.2f} ms/page".format(name, per_page * 1e3))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark")
+    memory_parser = subparsers.add_parser("memory", help="memory held by prods_all")
+    memory_parser.add_argument("--count", help="number of synthetic entries", type=int, default=50000)
+    parse_parser = subparsers.add_parser("parse", help="per-entry cost of massage_result")
+    parse_parser.add_argument("--count", help="number of synthetic entries", type=int, default=20000)
+    parse_parser.add_argument("--repeat", help="number of timed runs", type=int, default=3)
+    geometry_parser = subparsers.add_parser("geometry", help="per-page cost of footprint processing")
+    geometry_parser.add_argument("--pages", help="number of synthetic pages", type=int, default=200)
+    geometry_parser.add_argument("--repeat", help="number of timed runs", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.benchmark == "memory":
+        bench_memory(args.count)
+    elif args.benchmark == "parse":
+        bench_parse(args.count, args.repeat)
+    elif args.benchmark == "geometry":
+        bench_geometry(args.pages, args.repeat)
+    else:
+        parser.print_help()
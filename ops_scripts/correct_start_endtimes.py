@@ -4,23 +4,45 @@
 This script is for correcting SciHub acquisition
 metadata. For discrepencies where endtime is less than
 startime.
+
+Acquisitions are streamed from GRQ one time window at a time, checked as
+they arrive and corrected with _bulk update requests. A checkpoint file
+records the windows that are done, so an interrupted sweep picks up where
+it stopped. A full sweep ends with a pass over the acquisitions the windows
+can't reach: those without a starttime or with one outside the swept range.
 '''
 
+from __future__ import print_function
 import os
-from datetime import datetime
-import re
-from hysds.celery import app
-import requests
+import sys
 import json
-import elasticsearch
-import dateutil.parser
+import argparse
+from datetime import datetime, timedelta
+from hysds.celery import app
 
 BASE_PATH = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(BASE_PATH, "..", "acquisition_ingest"))
+
+import s1_name
+import grq_scroll
 
 es_url = app.conf["GRQ_ES_URL"]
 _index = "grq_v2.0_acquisition-s1-iw_slc"
 _type = "acquisition-S1-IW_SLC"
-ES = elasticsearch.Elasticsearch(es_url)
+
+# start of the sweep, before the first Sentinel-1 acquisitions
+SWEEP_START = "2014-04-01T00:00:00Z"
+
+# days of acquisitions per window, the checkpoint advances a window at a time
+WINDOW_DAYS = 30
+
+# number of corrections per _bulk request
+BULK_SIZE = 1000
+
+# parallel shard scans per window
+SLICES = 4
+
+CHECKPOINT_FILE = "correct_start_endtimes.checkpoint.json"
 
 
 def get_index_and_type():
@@ -36,155 +58,286 @@ def get_index_and_type():
     return index, typ
 
 
-def update_document_by_id(acq_id, body, index=_index, typ=_type):
+class BulkUpdater(object):
+    """Buffer partial document updates and send them in _bulk batches."""
+
+    def __init__(self, index=_index, typ=_type, bulk_size=BULK_SIZE, session=None):
+        self.bulk_url = "{}/_bulk".format(es_url.rstrip('/'))
+        self.index = index
+        self.typ = typ
+        self.bulk_size = bulk_size
+        self.session = session or grq_scroll.grq_session
+        self.pending = []
+
+    def add(self, doc_id, doc, index=None, typ=None):
+        """
+        Queue an update, sending the batch once it is full.
+        :param index: concrete index of the document, the updater's index by default
+        :param typ: type of the document, the updater's type by default
+        :return: tuple of (number updated, number failed) of the batch sent, if any
+        """
+        self.pending.append((index or self.index, typ or self.typ, doc_id, doc))
+        if len(self.pending) >= self.bulk_size:
+            return self.flush()
+        return 0, 0
+
+    def flush(self):
+        """
+        Send all queued updates. Raises if the _bulk request itself fails.
+        :return: tuple of (number updated, number failed)
+        """
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0, 0
+        lines = []
+        for index, typ, doc_id, doc in pending:
+            lines.append(json.dumps({"update": {"_index": index, "_type": typ, "_id": doc_id}}))
+            lines.append(json.dumps(doc))
+        r = self.session.post(self.bulk_url, data="\n".join(lines) + "\n")
+        r.raise_for_status()
+        failed = 0
+        for (index, typ, doc_id, doc), item in zip(pending, r.json()['items']):
+            result = item['update']
+            if result.get('error') or result.get('status', 200) >= 300:
+                print("Failed to update {}: {}".format(doc_id, result.get('error')))
+                failed += 1
+        return len(pending) - failed, failed
+
+
+def get_windows(starttime, endtime, days=WINDOW_DAYS):
     """
-    Delete documents in ES by ID
-    :param index:
-    :param typ:
-    :param acq_id:
-    :return:
+    Split a sweep into consecutive time windows.
+    :return: list of [start, end] ISO strings
     """
-    ES.update(index=index, doc_type=typ, id=acq_id, body=body)
+    start = s1_name.parse_iso(starttime)
+    end = s1_name.parse_iso(endtime)
+    windows = []
+    while start < end:
+        window_end = min(start + timedelta(days=days), end)
+        windows.append(["{}Z".format(start.isoformat()), "{}Z".format(window_end.isoformat())])
+        start = window_end
+    return windows
+
+
+def get_window_query(start_time, end_time):
+    """Acquisitions that start within [start_time, end_time)."""
+    return {
+        "query": {
+            "filtered": {
+                "filter": {
+                    "range": {
+                        "starttime": {
+                            "gte": start_time,
+                            "lt": end_time
+                        }
+                    }
+                }
+            }
+        }
+    }
 
 
-def query_ES_acqs(query, es_index=_index):
+def get_outside_query(start_time, end_time):
+    """Acquisitions without a starttime or with one outside [start_time, end_time)."""
+    return {
+        "query": {
+            "filtered": {
+                "filter": {
+                    "bool": {
+                        "should": [
+                            {"missing": {"field": "starttime"}},
+                            {"range": {"starttime": {"lt": start_time}}},
+                            {"range": {"starttime": {"gte": end_time}}}
+                        ]
+                    }
+                }
+            }
+        }
+    }
+
+
+def check_acq(item):
     """
-    This function creates a list of acquisition IDs that are in the past.
-    :param query:
-    :param es_index:
-    :return:
+    Check an acquisition document for an endtime before its starttime.
+    :param item: ES hit with starttime, endtime and metadata.title in its _source
+    :return: acq info dict if it is incorrect, None otherwise
+    """
+    source = item.get("_source", {})
+    if not source.get("starttime") or not source.get("endtime"):
+        return None
+    start_time = s1_name.parse_iso(source["starttime"])
+    end_time = s1_name.parse_iso(source["endtime"])
+    if end_time >= start_time:
+        return None
+    file_name = source.get("metadata", {}).get("title")
+    print("ID: {}  Start time: {}, End time: {}".format(file_name, start_time, end_time))
+    return {
+        "id": item.get("_id"),
+        "index": item.get("_index"),
+        "type": item.get("_type"),
+        "start_time": start_time,
+        "end_time": end_time,
+        "file_name": file_name
+    }
+
+
+def get_correction(acq_info):
+    """
+    Build the partial update that sets the start and end times from the file name.
+    :param acq_info: result of check_acq()
+    :return: update body, None if the file name times are inconsistent too
+    """
+    acq_id = acq_info.get("file_name")
+    name = s1_name.parse_name(acq_id) if acq_id else None
+    if name is None:
+        print("Unrecognized file name {} for {}. Aborting correction".format(acq_id, acq_info.get("id")))
+        return None
+    file_starttime = "{}Z".format(name.start)
+    file_endtime = "{}Z".format(name.stop)
+    if s1_name.parse_iso(file_starttime) >= s1_name.parse_iso(file_endtime):
+        print("Inconsistency in filename too. Aborting correction")
+        return None
+    print("For ID: {}".format(acq_id))
+    print("File Start Time: {}, File End Time: {}".format(file_starttime, file_endtime))
+    print("Metadata Start Time : {}, Metadata End Time: {}".format(acq_info.get("start_time"),
+                                                                    acq_info.get("end_time")))
+    return {
+        "doc": {
+            "starttime": file_starttime,
+            "endtime": file_endtime,
+            "metadata": {
+                "sensingStart": file_starttime,
+                "sensingStop": file_endtime
+            }
+        }
+    }
+
+
+def load_checkpoint(checkpoint_file):
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint_file, state):
+    tmp_file = "{}.tmp".format(checkpoint_file)
+    with open(tmp_file, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, checkpoint_file)
+
+
+def correct_hits(hits, updater, counts, dry_run=False):
+    """
+    Check acquisition hits and queue the corrections of the incorrect ones.
+    :param hits: ES hits with starttime, endtime and metadata.title in their _source
+    :param updater: BulkUpdater to queue the corrections with
+    :param counts: dict of counts to update
+    :param dry_run: only count the incorrect acquisitions, update nothing
     """
-    print "Querying ES"
-    acq_list = []
-    rest_url = es_url[:-1] if es_url.endswith('/') else es_url
-    url = "{}/_search".format(rest_url)
-    if es_index:
-        url = "{}/{}/_search".format(rest_url, es_index)
-    print(url)
-    print(query)
-    hits = query_es(url, query)
-    print('completed query')
-    count = 0
     for item in hits:
-        acq_id = item.get("_id")
-        # print acq_id
-        acq_info = dict()
-        try:
-            start_time = dateutil.parser.parse(item.get("fields").get("starttime")[0])
-        except:
-            start_time = dateutil.parser.parse(item.get("fields").get("starttime")[0])
-
-        try:
-            end_time = dateutil.parser.parse(item.get("fields").get("endtime")[0])
-        except:
-            end_time = dateutil.parser.parse(item.get("fields").get("endtime")[0])
-
-        if end_time < start_time:
-            count += 1
-            print("ID: {}  Start time: {}, End time: {}".format(item.get("fields").get("metadata.title")[0], start_time,
-                                                                end_time))
-            acq_info["id"] = acq_id
-            acq_info["start_time"] = start_time
-            acq_info["end_time"] = end_time
-            acq_info["file_name"] = item.get("fields").get("metadata.title")[0]
-            acq_list.append(acq_info)
-
-    print "Count of incorrect acqs: {}".format(count)
-    return acq_list
-
-def query_es(grq_url, es_query):
-    '''
-        Runs the query through Elasticsearch, iterates until
-        all results are generated, & returns the compiled result
-        '''
-    # make sure the fields from & size are in the es_query
-    if 'size' in es_query.keys():
-        iterator_size = es_query['size']
-    else:
-        iterator_size = 10000
-        es_query['size'] = iterator_size
-    if 'from' in es_query.keys():
-        from_position = es_query['from']
-    else:
-        from_position = 0
-        es_query['from'] = from_position
-    # run the query and iterate until all the results have been returned
-    print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-    response = requests.post(grq_url, data=json.dumps(es_query), verify=False)
-    # print('status code: {}'.format(response.status_code))
-    # print('response text: {}'.format(response.text))
-    response.raise_for_status()
-    results = json.loads(response.text, encoding='ascii')
-    results_list = results.get('hits', {}).get('hits', [])
-    total_count = results.get('hits', {}).get('total', 0)
-    for i in range(iterator_size, total_count, iterator_size):
-        es_query['from'] = i
-        print('querying: {}\n{}'.format(grq_url, json.dumps(es_query)))
-        response = requests.post(grq_url, data=json.dumps(es_query), timeout=60, verify=False)
-        response.raise_for_status()
-        results = json.loads(response.text, encoding='ascii')
-        results_list.extend(results.get('hits', {}).get('hits', []))
-    return results_list
-
-
-def acqs_to_update(update_list):
+        counts["checked"] += 1
+        source = item.get("_source", {})
+        if not source.get("starttime") or not source.get("endtime"):
+            print("ID: {} has no start or end time, skipping".format(item.get("_id")))
+            counts["missing_times"] += 1
+            continue
+        acq_info = check_acq(item)
+        if acq_info is None:
+            continue
+        counts["incorrect"] += 1
+        doc = get_correction(acq_info)
+        if doc is None:
+            counts["uncorrectable"] += 1
+        elif not dry_run:
+            updated, failed = updater.add(acq_info["id"], doc, acq_info["index"], acq_info["type"])
+            counts["updated"] += updated
+            counts["failed"] += failed
+    updated, failed = updater.flush()
+    counts["updated"] += updated
+    counts["failed"] += failed
+
+
+def correct_acqs(starttime=SWEEP_START, endtime=None, es_index=_index, window_days=WINDOW_DAYS,
+                 checkpoint_file=CHECKPOINT_FILE, dry_run=False, bulk_size=BULK_SIZE, slices=SLICES):
     """
-    find acquisitions with a specific status
-    :param index:
-    :param status:
-    :return:
+    Sweep the index for acquisitions with an endtime before their starttime and correct them.
+    A sweep from SWEEP_START or earlier to now ends with a pass over the acquisitions
+    without a starttime or with one outside the swept range.
+    :param starttime: start of the sweep
+    :param endtime: end of the sweep, now by default
+    :param es_index: acquisition index
+    :param window_days: days per window
+    :param checkpoint_file: file to resume from and record finished windows in, None to not checkpoint
+    :param dry_run: only count the incorrect acquisitions, update nothing
+    :param bulk_size: number of corrections per _bulk request
+    :param slices: parallel shard scans per window
+    :return: dict of counts
     """
-    for item in update_list:
-        doc_id = item.get("id")
-        acq_id = item.get("file_name")
-        match_pattern = "(?P<spacecraft>S1\w)_IW_SLC__(?P<misc>.*?)_(?P<s_year>\d{4})(?P<s_month>\d{2})(?P<s_day>\d{2})T(?P<s_hour>\d{2})(?P<s_minute>\d{2})(?P<s_seconds>\d{2})_(?P<e_year>\d{4})(?P<e_month>\d{2})(?P<e_day>\d{2})T(?P<e_hour>\d{2})(?P<e_minute>\d{2})(?P<e_seconds>\d{2})(?P<misc2>.*?)$"
-        m = re.match(match_pattern, acq_id)
-        file_starttime = "{}-{}-{}T{}:{}:{}Z".format(m.group("s_year"), m.group("s_month"), m.group("s_day"),
-                                                     m.group("s_hour"), m.group("s_minute"), m.group("s_seconds"))
-        s_time = datetime.strptime(file_starttime, "%Y-%m-%dT%H:%M:%SZ")
-        file_endtime = "{}-{}-{}T{}:{}:{}Z".format(m.group("e_year"), m.group("e_month"), m.group("e_day"),
-                                                   m.group("e_hour"), m.group("e_minute"), m.group("e_seconds"))
-        e_time = datetime.strptime(file_endtime, "%Y-%m-%dT%H:%M:%SZ")
-        if s_time < e_time:
-            print "For ID: {}".format(acq_id)
-            print "File Start Time: {}, File End Time: {}".format(file_starttime, file_endtime)
-            print "Metadata Start Time : {}, Metadata End Time: {}".format(item.get("start_time"), item.get("end_time"))
-            print "Submitting for update"
-            doc = dict()
-            body = dict()
-            body["starttime"] = file_starttime
-            body["endtime"] = file_endtime
-            metadata = dict()
-            metadata["sensingStart"] = file_starttime
-            metadata["sensingStop"] = file_endtime
-            body["metadata"] = metadata
-            doc["doc"] = body
-            print json.dumps(doc)
-            update_document_by_id(doc_id, body=doc)
-        else:
-            print "Inconsistency in filename too. Aborting correction"
-
-    return
+    # only a full sweep is meant to reach every acquisition
+    full_sweep = endtime is None and s1_name.parse_iso(starttime) <= s1_name.parse_iso(SWEEP_START)
+    sweep_start = starttime
+    if endtime is None:
+        endtime = "{}Z".format(datetime.utcnow().isoformat())
+    counts = {"checked": 0, "incorrect": 0, "uncorrectable": 0, "missing_times": 0, "updated": 0, "failed": 0}
+
+    # dry runs neither resume from nor advance the checkpoint
+    if dry_run:
+        checkpoint_file = None
+    state = load_checkpoint(checkpoint_file)
+    if state:
+        print("Resuming from checkpoint {} at {}".format(checkpoint_file, state["starttime"]))
+        starttime = state["starttime"]
+        sweep_start = state.get("sweep_start", sweep_start)
+        full_sweep = state.get("full_sweep", full_sweep)
+        counts.update(state["counts"])
+
+    updater = BulkUpdater(index=es_index, bulk_size=bulk_size)
+    source = ["starttime", "endtime", "metadata.title"]
+    for window_start, window_end in get_windows(starttime, endtime, window_days):
+        correct_hits(grq_scroll.scroll(es_url, es_index, get_window_query(window_start, window_end),
+                                       source=source, slices=slices), updater, counts, dry_run)
+        print("Checked {} to {}: {}".format(window_start, window_end, json.dumps(counts, sort_keys=True)))
+        if checkpoint_file:
+            save_checkpoint(checkpoint_file, {"starttime": window_end, "endtime": endtime, "sweep_start": sweep_start,
+                                              "full_sweep": full_sweep, "counts": counts})
+
+    if full_sweep:
+        correct_hits(grq_scroll.scroll(es_url, es_index, get_outside_query(sweep_start, endtime),
+                                       source=source, slices=slices), updater, counts, dry_run)
+        print("Checked acquisitions outside {} to {}: {}".format(sweep_start, endtime,
+                                                                 json.dumps(counts, sort_keys=True)))
+
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return counts
 
 
 if __name__ == "__main__":
     '''
-    Main program to delete  planned or predicted
-    acquisitions from bos sarcat acq index
+    Main program to correct acquisitions whose metadata
+    end time is before their start time
     '''
+    parser = argparse.ArgumentParser(description="Correct acquisitions with an endtime before their starttime.")
+    parser.add_argument("--starttime", help="start of the sweep in ISO8601 format", default=SWEEP_START)
+    parser.add_argument("--endtime", help="end of the sweep in ISO8601 format, now by default", default=None)
+    parser.add_argument("--index", help="acquisition index", default=_index)
+    parser.add_argument("--window_days", help="days of acquisitions per window", type=int, default=WINDOW_DAYS)
+    parser.add_argument("--checkpoint", help="checkpoint file to resume an interrupted sweep from",
+                        default=CHECKPOINT_FILE)
+    parser.add_argument("--bulk_size", help="number of corrections per _bulk request", type=int, default=BULK_SIZE)
+    parser.add_argument("--slices", help="parallel shard scans per window", type=int, default=SLICES)
+    parser.add_argument("--dry_run", help="only count the incorrect acquisitions", action='store_true')
+    args = parser.parse_args()
 
-    # find and delete past planned acquisitions
-    query = {
-        "query": {
-        "match_all": {}
-          },
-          "fields": [
-            "_id"
-          ]
-    }
-    acq_list = query_ES_acqs(query=query)
-    if len(acq_list) != 0:
-        print("Updating following acquisitions :::")
-        acqs_to_update(update_list= acq_list)
+    counts = correct_acqs(args.starttime, args.endtime, args.index, args.window_days, args.checkpoint,
+                          args.dry_run, args.bulk_size, args.slices)
+    print("Count of incorrect acqs: {}".format(counts["incorrect"]))
+    if counts["missing_times"]:
+        print("Acquisitions without a start or end time: {}".format(counts["missing_times"]))
+    if args.dry_run:
+        print("Correctable from their file names: {}".format(counts["incorrect"] - counts["uncorrectable"]))
+    elif counts["incorrect"] == 0:
+        print("No acquisitions to correct")
     else:
-        print("No acquisitions to correct")
\ No newline at end of file
+        print("Updated {} acquisitions, {} failed".format(counts["updated"], counts["failed"]))